@@ -8,31 +8,52 @@ import time
 import math
 import json
 import base64
+import gzip
+import heapq
+import random
+import queue
 import logging
 import threading
+import contextvars
+from contextlib import contextmanager
 from threading import Lock
+from dataclasses import asdict, dataclass
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeoutError
 import secrets
 import hashlib
+import hmac
 import smtplib
 import urllib.parse
 import urllib.request
 from datetime import datetime, timedelta
-from typing import Any, Dict, List, Optional, Tuple
+from typing import Any, Dict, List, Optional, Set, Tuple
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.mime.base import MIMEBase
 from email import encoders
 
+import numpy as np
+try:
+    import orjson
+except ImportError:  # 未安裝時退回標準 json
+    orjson = None
+try:
+    import brotli
+except ImportError:  # 未安裝時只提供 gzip
+    brotli = None
 import qrcode
 import firebase_admin
 from firebase_admin import credentials, db
-from fastapi import FastAPI, HTTPException, Response, Query
+from fastapi import FastAPI, Header, HTTPException, Request, Response, Query
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse
 from pydantic import BaseModel, Field, validator
 import gspread
 import google.auth
-from google.auth import default
-from googleapiclient.discovery import build
+import google.auth.exceptions
+from google.auth.transport.requests import AuthorizedSession, Request as GoogleAuthRequest
+import requests
+from requests.adapters import HTTPAdapter
 
 # ========== 日誌設定 ==========
 logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
@@ -51,6 +72,7 @@ SPREADSHEET_ID = "1o_kLeuwP5_G08YYLlZKIgcYzlU1NIZD5SQnHoO59YUw"
 SHEET_NAME_MAIN = "預約審核(櫃台)"
 SHEET_NAME_CAP = "可預約班次(web)"
 SHEET_NAME_SYSTEM = "系統"
+SHEET_NAME_SUB_TICKETS = "子票"
 DEFAULT_SHEET = "可預約班次(web)"
 DEFAULT_RANGE = "A1:Z"
 HEADER_ROW_MAIN = 2
@@ -67,6 +89,19 @@ LOCK_STALE_SECONDS = 30
 LOCK_POLL_INTERVAL = 2.0
 GPS_TIMEOUT_SECONDS = 15 * 60
 AUTO_SHUTDOWN_MS = 40 * 60 * 1000
+PATH_SIMPLIFY_EPSILON_M = 5.0
+ROUTE_MATCH_WINDOW_BACK = 5
+ROUTE_MATCH_WINDOW_FWD = 80
+ROUTE_REACQUIRE_M = 100.0
+STATION_EXIT_FACTOR = 1.5
+STATION_PASS_MARGIN = 2
+ETA_DEFAULT_SPEED_MPS = 5.5
+ETA_MIN_SPEED_MPS = 2.0
+ETA_MAX_SPEED_MPS = 30.0
+ETA_SPEED_ALPHA = 0.3
+ETA_DETOUR_FACTOR = 1.3
+ETA_PUBLISH_INTERVAL = 30.0
+ETA_STATS_MAX_WEIGHT = 50
 
 HEADER_KEYS = {
     "申請日期", "最後操作時間", "預約編號", "往返", "日期", "班次", "車次",
@@ -100,6 +135,45 @@ STATION_COORDS = {
     "福泰大飯店(回) Forte Hotel (Back)": {"lat": 25.054800375417987, "lng": 121.63117576557792},
 }
 
+TRIP_STATION_MAP = {
+    "1. 福泰大飯店 (去)": "福泰大飯店 Forte Hotel",
+    "2. 南港捷運站": "南港展覽館捷運站 Nangang Exhibition Center - MRT Exit 3",
+    "3. 南港火車站": "南港火車站 Nangang Train Station",
+    "4. LaLaport 購物中心": "LaLaport Shopping Park",
+    "5. 福泰大飯店 (回)": "福泰大飯店(回) Forte Hotel (Back)",
+}
+
+TRIP_STATIONS = [
+    "福泰大飯店 Forte Hotel",
+    "南港展覽館捷運站 Nangang Exhibition Center - MRT Exit 3",
+    "南港火車站 Nangang Train Station",
+    "LaLaport Shopping Park",
+    "福泰大飯店(回) Forte Hotel (Back)",
+]
+
+ROUTE_CACHE_TTL_SECONDS = 7 * 24 * 3600
+DIRECTIONS_TIMEOUT_SECONDS = 10
+TRIP_IO_TIMEOUT_SECONDS = 12
+SHEET_NAMES_TRIP_MGMT = ("車次管理(櫃台)", "車次管理(備品)")
+HEADER_ROW_TRIP_MGMT = 6
+TRIP_MGMT_CACHE_TTL_SECONDS = 600
+# 查無班次時重新載入的最短間隔，避免未知班次每次查找都整張重讀
+TRIP_MGMT_MISS_RELOAD_SECONDS = 60
+# 快照載入後這段時間內直接依列號寫入（不讀取）；超過後寫入前先讀回該列的日期 / 時間確認列號
+TRIP_MGMT_VERIFY_AFTER_SECONDS = 60
+# 子票表僅由本服務寫入；其他實例的寫入最遲在 TTL 後可見
+SUB_TICKET_CACHE_TTL_SECONDS = 30
+MAIN_PROJECTION_RECHECK_SECONDS = 600
+MAIN_PROJECTION_MAX_GAP = 2
+# 離線核銷名單簽章金鑰（HMAC-SHA256），需與司機端 App 共用同一把；未設定時不附簽章標頭
+MANIFEST_SIGNING_KEY: Optional[bytes] = os.environ.get("MANIFEST_SIGNING_KEY", "").encode("utf-8") or None
+# 核銷時間窗：主班次前 30 分鐘至後 60 分鐘
+CHECKIN_WINDOW_BEFORE_SECONDS = 30 * 60
+CHECKIN_WINDOW_AFTER_SECONDS = 60 * 60
+# 本機狀態目錄（主表快照、待寫入佇列、核銷日誌）；預設值只供本機開發。
+# Cloud Run 的 /tmp 為記憶體檔案系統，重啟即遺失，正式環境必須指向掛載的持久 volume（見 README「本機狀態目錄」）
+STATE_DIR = os.environ.get("SHUTTLE_STATE_DIR", "/tmp/shuttle-state")
+
 # ========== 快取和鎖 ==========
 SHEET_CACHE: Dict[str, Any] = {
     "values": None,
@@ -110,10 +184,23 @@ SHEET_CACHE: Dict[str, Any] = {
 }
 CACHE_LOCK = threading.Lock()
 
+# /api/sheet 任意工作表 / 範圍的短期快取，只保存最近一次讀取的範圍
+RANGE_CACHE: Dict[str, Any] = {
+    "values": None,
+    "fetched_at": None,
+    "sheet_name": None,
+    "range_name": None,
+}
+# 系統設定格（GPS 開關 E19），由 _refresh_sheets 隨主表一併刷新；獨立保存，不會被 /api/sheet 擠掉
+SYSTEM_CONFIG_CACHE: Dict[str, Any] = {"values": None, "fetched_at": None}
+
 # ========== 核銷快取隊列（用於批量寫回 Sheet）==========
 # 結構：{booking_id: {sub_index: {"status": "checked_in", "checked_at": str, "checked_by": str}}}
 CHECKIN_CACHE: Dict[str, Dict[int, Dict[str, Any]]] = {}
 CHECKIN_CACHE_LOCK = threading.Lock()
+# flush 時從 CHECKIN_CACHE 換出、正在寫回 Sheet 的批次；寫回完成前查詢核銷狀態仍需納入
+CHECKIN_INFLIGHT: Dict[str, Dict[int, Dict[str, Any]]] = {}
+CHECKIN_FLUSH_LOCK = threading.Lock()
 CHECKIN_FLUSH_INTERVAL = 3.0  # 3 秒後批量寫回
 _last_flush_time = 0.0
 
@@ -124,6 +211,28 @@ CAP_SHEET_CACHE: Dict[str, Any] = {
     "fetched_at": None,
 }
 
+# 車次管理表快照：index 以 (YYYY-MM-DD, HH:MM) 對應列號，寫入後就地更新，不重新讀取
+TRIP_MGMT_CACHE: Dict[str, Any] = {
+    "sheet_name": None,
+    "values": None,
+    "cols": None,
+    "index": None,
+    "fetched_at": None,
+}
+TRIP_MGMT_LOCK = Lock()
+
+# 子票表快照：index 以 (預約編號, 子票索引) 對應列號，by_booking / summary 為各預約的子票與 (已上車人數, 總人數)，
+# version 為整張表內容的雜湊（離線核銷名單的快取 key 與 ETag 使用）
+SUB_TICKET_CACHE: Dict[str, Any] = {
+    "values": None,
+    "index": None,
+    "by_booking": None,
+    "summary": None,
+    "version": None,
+    "fetched_at": None,
+}
+SUB_TICKET_LOCK = Lock()
+
 DRIVER_LOCATION_CACHE: Dict[str, Any] = {
     "lat": 0.0,
     "lng": 0.0,
@@ -132,11 +241,12 @@ DRIVER_LOCATION_CACHE: Dict[str, Any] = {
 }
 LOCATION_LOCK = Lock()
 
-_gc_cache: Optional[gspread.Client] = None
-_gc_lock = Lock()
 _ws_cache: Dict[str, gspread.Worksheet] = {}
 _ws_lock = Lock()
 
+# 並行 I/O（Sheet / RTDB / Maps）用的共用執行緒池
+IO_EXECUTOR = ThreadPoolExecutor(max_workers=8, thread_name_prefix="io")
+
 # ========== 工具函數 ==========
 def _email_hash6(email: str) -> str:
     return hashlib.sha256((email or "").encode("utf-8")).hexdigest()[:6]
@@ -231,11 +341,12 @@ def _safe_int(v: Any, default: int = 0) -> int:
     except Exception:
         return default
 
+MAIN_DT_PATTERN = re.compile(r'^(\d{4})[/-](\d{1,2})[/-](\d{1,2})\s+(\d{1,2}):(\d{2})(?::(\d{2}))?$')
+
 def _normalize_main_dt_format(main_raw: str) -> str:
     if not main_raw:
         return main_raw
-    pattern = r'^(\d{4})[/-](\d{1,2})[/-](\d{1,2})\s+(\d{1,2}):(\d{2})(?::(\d{2}))?$'
-    match = re.match(pattern, main_raw.strip())
+    match = MAIN_DT_PATTERN.match(main_raw.strip())
     if match:
         year, month, day, hour, minute, second = match.groups()
         normalized_hour = hour.zfill(2)
@@ -252,8 +363,7 @@ def _parse_main_dt(raw: str) -> Optional[datetime]:
         return None
     original_raw = raw
     raw = raw.strip()
-    pattern = r'^(\d{4})[/-](\d{1,2})[/-](\d{1,2})\s+(\d{1,2}):(\d{2})(?::(\d{2}))?$'
-    match = re.match(pattern, raw)
+    match = MAIN_DT_PATTERN.match(raw)
     if match:
         year = match.group(1)
         month = match.group(2).zfill(2)
@@ -280,6 +390,187 @@ def _parse_main_dt(raw: str) -> Optional[datetime]:
     log.warning(f"無法解析主班次時間格式: {original_raw}")
     return None
 
+class TTLResultCache:
+    """以 key 保存處理結果一段時間；超過筆數上限時淘汰最早寫入的項目"""
+
+    def __init__(self, ttl_seconds: float, max_entries: int = 10000):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._items: Dict[str, Tuple[float, Any]] = {}
+        self._lock = Lock()
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            if item[0] < time.monotonic():
+                del self._items[key]
+                return None
+            return item[1]
+
+    def put(self, key: str, value: Any) -> None:
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = (time.monotonic() + self.ttl_seconds, value)
+            while len(self._items) > self.max_entries:
+                self._items.pop(next(iter(self._items)))
+
+# ========== 主表型別欄位（快照載入時解析一次） ==========
+# main_dt[i]：values[i] 的主班次時間解析結果 MainDt，無法解析時為 None
+# car_date[i]：values[i] 的車次日期 (date_iso, time_hm, 當日 00:00 datetime 或 None)，供 query 過濾一個月內的紀錄
+class MainDt:
+    __slots__ = ("dt", "epoch_min", "trip_id", "date_str", "time_str")
+
+    def __init__(self, dt: datetime, trip_id: str):
+        self.dt = dt
+        self.epoch_min = _epoch_minutes(dt)
+        self.trip_id = trip_id
+        self.date_str = dt.strftime("%Y-%m-%d")
+        self.time_str = dt.strftime("%H:%M")
+
+_EPOCH_ORDINAL = datetime(1970, 1, 1).toordinal()
+
+def _epoch_minutes(dt: datetime) -> int:
+    """以台北當地時間計的 epoch 分鐘（與 _tz_now() 同基準，只用於比較）"""
+    return (dt.toordinal() - _EPOCH_ORDINAL) * 1440 + dt.hour * 60 + dt.minute
+
+def _cutoff_epoch_minutes(cutoff: datetime) -> int:
+    """epoch_min < 此值 等同於 dt < cutoff（整分鐘的班次時間）"""
+    return _epoch_minutes(cutoff) + (1 if cutoff.second or cutoff.microsecond else 0)
+
+def _parse_main_dt_fast(raw: str) -> Optional[MainDt]:
+    """常見格式直接由 regex 分組建立 datetime，不經 strptime；其餘格式交給 _parse_main_dt"""
+    match = MAIN_DT_PATTERN.match(raw)
+    if match:
+        year, month, day, hour, minute, second = match.groups()
+        try:
+            dt = datetime(int(year), int(month), int(day), int(hour), int(minute), int(second or 0))
+        except ValueError:
+            return None
+        trip_id = f"{year}/{month.zfill(2)}/{day.zfill(2)} {hour.zfill(2)}:{minute}"
+        return MainDt(dt, f"{trip_id}:{second}" if second else trip_id)
+    dt = _parse_main_dt(raw)
+    return MainDt(dt, raw) if dt else None
+
+def _parse_car_date(car_dt_str: str, date_raw: str, time_raw: str) -> Tuple[str, str, Optional[datetime]]:
+    if car_dt_str:
+        parts = car_dt_str.strip().split()
+        date_iso = parts[0].replace("/", "-") if parts else ""
+        time_hm = _time_hm_from_any(parts[1]) if len(parts) > 1 else ""
+    else:
+        date_iso = date_raw
+        time_hm = _time_hm_from_any(time_raw)
+    try:
+        day = datetime.strptime(date_iso, "%Y-%m-%d")
+    except Exception:
+        day = None
+    return date_iso, time_hm, day
+
+def _build_main_typed_columns(values: List[List[str]], hmap: Dict[str, int]) -> Dict[str, Any]:
+    """每個不同的原始字串只解析一次（同一班次通常有數十到數百列）；另建預約編號 → 列號索引"""
+    idx_main_dt = _col_index(hmap, "主班次時間")
+    idx_car_dt = _col_index(hmap, "車次-日期時間")
+    idx_date = _col_index(hmap, "日期")
+    idx_time = _col_index(hmap, "班次")
+    idx_booking = _col_index(hmap, "預約編號")
+    main_memo: Dict[str, Optional[MainDt]] = {}
+    car_memo: Dict[Tuple[str, str, str], Tuple[str, str, Optional[datetime]]] = {}
+    main_dt: List[Optional[MainDt]] = [None] * len(values)
+    car_date: List[Optional[Tuple[str, str, Optional[datetime]]]] = [None] * len(values)
+    booking_row: Dict[str, int] = {}
+    for i in range(HEADER_ROW_MAIN, len(values)):
+        row = values[i]
+        booking_id = _get_cell(row, idx_booking)
+        if booking_id and booking_id not in booking_row:
+            booking_row[booking_id] = i + 1
+        main_raw = _get_cell(row, idx_main_dt)
+        if main_raw:
+            parsed = main_memo.get(main_raw, False)
+            if parsed is False:
+                parsed = main_memo[main_raw] = _parse_main_dt_fast(main_raw)
+            main_dt[i] = parsed
+        car_dt_str = row[idx_car_dt] if 0 <= idx_car_dt < len(row) else ""
+        key = (car_dt_str, "", "") if car_dt_str else ("", row[idx_date] if 0 <= idx_date < len(row) else "", row[idx_time] if 0 <= idx_time < len(row) else "")
+        parsed_car = car_memo.get(key)
+        if parsed_car is None:
+            parsed_car = car_memo[key] = _parse_car_date(*key)
+        car_date[i] = parsed_car
+    return {"main_dt": main_dt, "car_date": car_date, "booking_row": booking_row}
+
+MAIN_TYPED_CACHE: Dict[str, Any] = {"values": None, "columns": None}
+MAIN_TYPED_LOCK = Lock()
+
+def _main_typed_columns(values: List[List[str]], hmap: Dict[str, int]) -> Dict[str, Any]:
+    """返回與 values 對齊的型別欄位；同一份快照（同一個 values 物件）只建立一次"""
+    with MAIN_TYPED_LOCK:
+        if MAIN_TYPED_CACHE["values"] is values:
+            return MAIN_TYPED_CACHE["columns"]
+    columns = _build_main_typed_columns(values, hmap)
+    with MAIN_TYPED_LOCK:
+        MAIN_TYPED_CACHE["values"] = values
+        MAIN_TYPED_CACHE["columns"] = columns
+    return columns
+
+def _patch_main_typed_columns(previous: List[List[str]], values: List[List[str]], hmap: Dict[str, int], rownos: List[int]) -> None:
+    """values 為 previous 修補數列後的新快照：只重新解析這些列並登記為 values 的型別欄位，不重建整份"""
+    with MAIN_TYPED_LOCK:
+        columns = MAIN_TYPED_CACHE["columns"] if MAIN_TYPED_CACHE["values"] is previous else None
+    if columns is None or len(values) != len(previous):
+        return
+    idx_booking = _col_index(hmap, "預約編號")
+    if any(_get_cell(previous[r - 1], idx_booking) != _get_cell(values[r - 1], idx_booking) for r in rownos):
+        return  # 預約編號改變需重建列號索引，交由 _main_typed_columns 整份重建
+    idx_main_dt = _col_index(hmap, "主班次時間")
+    idx_car_dt = _col_index(hmap, "車次-日期時間")
+    idx_date = _col_index(hmap, "日期")
+    idx_time = _col_index(hmap, "班次")
+    # 舊快照的型別欄位可能仍被其他請求使用，複製後再修改
+    main_dt = list(columns["main_dt"])
+    car_date = list(columns["car_date"])
+    for rowno in rownos:
+        i = rowno - 1
+        row = values[i]
+        main_raw = _get_cell(row, idx_main_dt)
+        main_dt[i] = _parse_main_dt_fast(main_raw) if main_raw else None
+        car_dt_str = row[idx_car_dt] if 0 <= idx_car_dt < len(row) else ""
+        key = (car_dt_str, "", "") if car_dt_str else ("", row[idx_date] if 0 <= idx_date < len(row) else "", row[idx_time] if 0 <= idx_time < len(row) else "")
+        car_date[i] = _parse_car_date(*key)
+    with MAIN_TYPED_LOCK:
+        if MAIN_TYPED_CACHE["values"] is previous:
+            MAIN_TYPED_CACHE["values"] = values
+            MAIN_TYPED_CACHE["columns"] = {"main_dt": main_dt, "car_date": car_date, "booking_row": columns["booking_row"]}
+
+def benchmark_main_dt_parsing(rows: int = 50000, distinct_trips: int = 600) -> Dict[str, float]:
+    """合成主表的解析微基準：逐列 _parse_main_dt + _normalize_main_dt_format 與快照型別欄位的比較"""
+    base = datetime(2025, 1, 1, 7, 0)
+    header = [""] * len(HEADER_KEYS)
+    hmap = {"主班次時間": 1, "車次-日期時間": 2}
+    values: List[List[str]] = [list(header) for _ in range(HEADER_ROW_MAIN)]
+    for i in range(rows):
+        dt = base + timedelta(minutes=30 * (i % distinct_trips))
+        main_raw = f"{dt.year}/{dt.month}/{dt.day} {dt.hour}:{dt.minute:02d}"
+        values.append([main_raw, dt.strftime("%Y/%m/%d %H:%M")])
+    t0 = time.perf_counter()
+    for row in values[HEADER_ROW_MAIN:]:
+        _parse_main_dt(row[0])
+        _normalize_main_dt_format(row[0])
+        try:
+            datetime.strptime(row[1].split()[0].replace("/", "-"), "%Y-%m-%d")
+        except Exception:
+            pass
+    per_row = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    columns = _build_main_typed_columns(values, hmap)
+    typed_build = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    cutoff = _epoch_minutes(base)
+    hits = sum(1 for m in columns["main_dt"] if m is not None and m.epoch_min >= cutoff)
+    typed_scan = time.perf_counter() - t0
+    result = {"rows": rows, "per_row_s": round(per_row, 4), "typed_build_s": round(typed_build, 4), "typed_scan_s": round(typed_scan, 4), "hits": hits}
+    log.info(f"[bench] main_dt parsing: {result}")
+    return result
+
 def haversine_distance(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
     R = 6371000
     phi1 = math.radians(lat1)
@@ -290,6 +581,122 @@ def haversine_distance(lat1: float, lon1: float, lat2: float, lon2: float) -> fl
     c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
     return R * c
 
+def _decode_polyline(poly: str) -> List[Dict[str, float]]:
+    """解碼 Google Encoded Polyline（精度 1e5），返回 [{"lat", "lng"}]"""
+    coords: List[Dict[str, float]] = []
+    index, lat, lng = 0, 0, 0
+    while index < len(poly):
+        result, shift = 0, 0
+        while True:
+            b = ord(poly[index]) - 63
+            index += 1
+            result |= (b & 0x1f) << shift
+            shift += 5
+            if b < 0x20:
+                break
+        dlat = ~(result >> 1) if (result & 1) else (result >> 1)
+        lat += dlat
+        result, shift = 0, 0
+        while True:
+            b = ord(poly[index]) - 63
+            index += 1
+            result |= (b & 0x1f) << shift
+            shift += 5
+            if b < 0x20:
+                break
+        dlng = ~(result >> 1) if (result & 1) else (result >> 1)
+        lng += dlng
+        coords.append({"lat": lat / 1e5, "lng": lng / 1e5})
+    return coords
+
+def _encode_polyline_value(v: int) -> str:
+    v = ~(v << 1) if v < 0 else (v << 1)
+    chunks: List[str] = []
+    while v >= 0x20:
+        chunks.append(chr((0x20 | (v & 0x1f)) + 63))
+        v >>= 5
+    chunks.append(chr(v + 63))
+    return "".join(chunks)
+
+def _encode_polyline(points: List[Dict[str, float]]) -> str:
+    """編碼為 Google Encoded Polyline，與 _decode_polyline 互逆"""
+    out: List[str] = []
+    prev_lat, prev_lng = 0, 0
+    for p in points:
+        lat = int(round(float(p.get("lat", 0)) * 1e5))
+        lng = int(round(float(p.get("lng", 0)) * 1e5))
+        out.append(_encode_polyline_value(lat - prev_lat))
+        out.append(_encode_polyline_value(lng - prev_lng))
+        prev_lat, prev_lng = lat, lng
+    return "".join(out)
+
+def _encode_delta_ints(values: List[int]) -> str:
+    """以 polyline 相同字元編碼整數差分序列（第一個值為絕對值）"""
+    out: List[str] = []
+    prev = 0
+    for v in values:
+        out.append(_encode_polyline_value(v - prev))
+        prev = v
+    return "".join(out)
+
+def _simplify_path_dp(points: List[Dict[str, float]], epsilon_m: float) -> List[int]:
+    """
+    Douglas–Peucker 簡化，返回保留點的索引（遞增）
+    使用以第一點為原點的等距投影（公尺），短距離路徑誤差可忽略
+    """
+    n = len(points)
+    if n <= 2:
+        return list(range(n))
+    lat0 = math.radians(float(points[0].get("lat", 0)))
+    kx = 6371000 * math.cos(lat0) * math.pi / 180
+    ky = 6371000 * math.pi / 180
+    xy = [(float(p.get("lng", 0)) * kx, float(p.get("lat", 0)) * ky) for p in points]
+    keep = [False] * n
+    keep[0] = keep[-1] = True
+    stack = [(0, n - 1)]
+    while stack:
+        s, e = stack.pop()
+        if e - s < 2:
+            continue
+        x1, y1 = xy[s]
+        x2, y2 = xy[e]
+        dx, dy = x2 - x1, y2 - y1
+        seg_len = math.hypot(dx, dy)
+        best_i, best_d = -1, -1.0
+        for i in range(s + 1, e):
+            px, py = xy[i]
+            if seg_len == 0:
+                d = math.hypot(px - x1, py - y1)
+            else:
+                d = abs(dy * px - dx * py + x2 * y1 - y2 * x1) / seg_len
+            if d > best_d:
+                best_i, best_d = i, d
+        if best_d > epsilon_m:
+            keep[best_i] = True
+            stack.append((s, best_i))
+            stack.append((best_i, e))
+    return [i for i in range(n) if keep[i]]
+
+def _encode_path_history(history: List[Dict[str, Any]], since: Optional[int] = None, epsilon_m: float = PATH_SIMPLIFY_EPSILON_M) -> Dict[str, Any]:
+    """
+    將 current_trip_path_history 壓縮為精簡格式（RTDB 仍保留原始點）
+    - points：Douglas–Peucker 簡化後的 Google Encoded Polyline（可直接用 _decode_polyline 解碼）
+    - timestamps：各保留點的時間戳（毫秒），以相同字元編碼的差分序列表示
+    - cursor：原始歷史最後一點的時間戳，下次以 since= 帶回只取增量
+    """
+    pts = [p for p in (history or []) if isinstance(p, dict) and "lat" in p and "lng" in p]
+    if since:
+        pts = [p for p in pts if _safe_int(p.get("timestamp"), 0) > since]
+    cursor = _safe_int(pts[-1].get("timestamp"), 0) if pts else (since or 0)
+    kept = [pts[i] for i in _simplify_path_dp(pts, epsilon_m)]
+    return {
+        "points": _encode_polyline(kept),
+        "timestamps": _encode_delta_ints([_safe_int(p.get("timestamp"), 0) for p in kept]),
+        "count": len(kept),
+        "raw_count": len(pts),
+        "cursor": cursor,
+    }
+
 def get_next_station(stops: list, completed_stops: list) -> str:
     for stop in stops:
         stop_name = stop if isinstance(stop, str) else stop.get("name", "")
@@ -298,14 +705,344 @@ def get_next_station(stops: list, completed_stops: list) -> str:
     return ""
 
 # ========== Google Sheets 操作 ==========
+# ---- 配額節流與重試 ----
+# Sheets API 每使用者每分鐘 60 次請求；所有讀寫（gspread 與 values API）都經過同一個 token bucket，
+# 等待中的請求依優先序取得 token：司機核銷 > 一般寫入 > 網頁班表讀取
+SHEETS_QUOTA_PER_MINUTE = int(os.environ.get("SHEETS_QUOTA_PER_MINUTE", "60"))
+SHEETS_QUOTA_BURST = int(os.environ.get("SHEETS_QUOTA_BURST", "10"))
+SHEETS_MAX_RETRIES = 5
+SHEETS_BACKOFF_BASE_SECONDS = 1.0
+SHEETS_BACKOFF_MAX_SECONDS = 32.0
+SHEETS_RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+SHEETS_BREAKER_FAILURE_THRESHOLD = 3
+SHEETS_BREAKER_OPEN_SECONDS = 30.0
+
+SHEETS_PRIORITY_CHECKIN = 0
+SHEETS_PRIORITY_WRITE = 1
+SHEETS_PRIORITY_READ = 2
+SHEETS_PRIORITY_NAMES = {SHEETS_PRIORITY_CHECKIN: "checkin", SHEETS_PRIORITY_WRITE: "write", SHEETS_PRIORITY_READ: "read"}
+
+_SHEETS_PRIORITY: contextvars.ContextVar[Optional[int]] = contextvars.ContextVar("sheets_priority", default=None)
+
+@contextmanager
+def sheets_priority(level: int):
+    """指定區塊內 Sheets 請求的優先序；也可作為端點裝飾器使用"""
+    token = _SHEETS_PRIORITY.set(level)
+    try:
+        yield
+    finally:
+        _SHEETS_PRIORITY.reset(token)
+
+# 5xx / 逾時 / 連線錯誤時伺服器可能已套用請求：預設只有 GET 重試；
+# 覆寫固定儲存格的寫入（values:batchUpdate、逐格 batch_update）重送結果相同，可用 sheets_idempotent() 開放重試。
+# append 類請求重送會多出一列，只在 429（請求未被處理）時重試
+_SHEETS_IDEMPOTENT: contextvars.ContextVar[bool] = contextvars.ContextVar("sheets_idempotent", default=False)
+
+@contextmanager
+def sheets_idempotent():
+    """區塊內的寫入請求重送無副作用，5xx 與連線錯誤也可重試"""
+    token = _SHEETS_IDEMPOTENT.set(True)
+    try:
+        yield
+    finally:
+        _SHEETS_IDEMPOTENT.reset(token)
+
+class SheetsRateLimiter:
+    """Token bucket；token 不足時依 (優先序, 到達順序) 排隊，只有隊首可以取用"""
+
+    def __init__(self, per_minute: int, burst: int):
+        self.rate = per_minute / 60.0
+        self.capacity = float(max(1, burst))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._cond = threading.Condition(Lock())
+        self._waiters: List[Tuple[int, int]] = []
+        self._seq = 0
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, priority: int) -> float:
+        """取得一個 token，返回等待秒數"""
+        start = time.monotonic()
+        with self._cond:
+            self._seq += 1
+            me = (priority, self._seq)
+            heapq.heappush(self._waiters, me)
+            try:
+                while True:
+                    now = time.monotonic()
+                    self._refill(now)
+                    if self._waiters[0] == me and self.tokens >= 1.0:
+                        self.tokens -= 1.0
+                        break
+                    wait = (1.0 - self.tokens) / self.rate if self.tokens < 1.0 else 0.05
+                    self._cond.wait(timeout=max(0.01, wait))
+            finally:
+                self._waiters.remove(me)
+                heapq.heapify(self._waiters)
+                self._cond.notify_all()
+        return time.monotonic() - start
+
+    def available(self) -> float:
+        with self._cond:
+            self._refill(time.monotonic())
+            return self.tokens
+
+SHEETS_LIMITER = SheetsRateLimiter(SHEETS_QUOTA_PER_MINUTE, SHEETS_QUOTA_BURST)
+SHEETS_METRICS_LOCK = Lock()
+SHEETS_METRICS: Dict[str, Any] = {
+    "requests": {name: 0 for name in SHEETS_PRIORITY_NAMES.values()},
+    "throttled": {name: 0 for name in SHEETS_PRIORITY_NAMES.values()},
+    "throttle_wait_ms_total": {name: 0.0 for name in SHEETS_PRIORITY_NAMES.values()},
+    "throttle_wait_ms_max": {name: 0.0 for name in SHEETS_PRIORITY_NAMES.values()},
+    "retries": 0,
+    "status_429": 0,
+    "status_5xx": 0,
+    "exhausted": 0,
+}
+
+def _record_sheets_request(priority_name: str, waited_s: float) -> None:
+    wait_ms = waited_s * 1000.0
+    with SHEETS_METRICS_LOCK:
+        SHEETS_METRICS["requests"][priority_name] += 1
+        if wait_ms >= 1.0:
+            SHEETS_METRICS["throttled"][priority_name] += 1
+            SHEETS_METRICS["throttle_wait_ms_total"][priority_name] += wait_ms
+            if wait_ms > SHEETS_METRICS["throttle_wait_ms_max"][priority_name]:
+                SHEETS_METRICS["throttle_wait_ms_max"][priority_name] = wait_ms
+
+def _sheets_metrics_snapshot() -> Dict[str, Any]:
+    with SHEETS_METRICS_LOCK:
+        snap = json.loads(json.dumps(SHEETS_METRICS))
+    snap["tokens_available"] = round(SHEETS_LIMITER.available(), 2)
+    snap["quota_per_minute"] = SHEETS_QUOTA_PER_MINUTE
+    return snap
+
+def _sheets_backoff_seconds(attempt: int, retry_after: Optional[str]) -> float:
+    """Full jitter 指數退避；伺服器給 Retry-After 時以其為下限"""
+    delay = random.uniform(0, min(SHEETS_BACKOFF_MAX_SECONDS, SHEETS_BACKOFF_BASE_SECONDS * (2 ** attempt)))
+    if retry_after:
+        try:
+            delay = max(delay, float(retry_after))
+        except ValueError:
+            pass
+    return delay
+
+def _is_sheets_quota_error(e: Exception) -> bool:
+    resp = getattr(e, "response", None)
+    return getattr(resp, "status_code", None) == 429
+
+class SheetsUnavailable(Exception):
+    """斷路器開啟中，Sheets 請求直接拒絕不送出"""
+
+class SheetsCircuitBreaker:
+    """
+    連續 SHEETS_BREAKER_FAILURE_THRESHOLD 次連線錯誤 / 逾時 / 5xx 後開啟，期間所有請求立即失敗；
+    SHEETS_BREAKER_OPEN_SECONDS 後進入半開，只放行一個探測請求，成功則關閉
+    """
+
+    def __init__(self, failure_threshold: int, open_seconds: float):
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.probe_in_flight = False
+        self.last_error: Optional[str] = None
+        self._lock = Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open" and time.monotonic() - self.opened_at >= self.open_seconds:
+                self.state = "half_open"
+                log.info("[sheets_breaker] half-open, probing")
+            if self.state == "half_open" and not self.probe_in_flight:
+                self.probe_in_flight = True
+                return True
+            return False
+
+    def record_success(self) -> None:
+        with self._lock:
+            recovered = self.state != "closed"
+            self.state = "closed"
+            self.failures = 0
+            self.opened_at = None
+            self.probe_in_flight = False
+        if recovered:
+            log.info("[sheets_breaker] closed, Sheets recovered")
+
+    def record_failure(self, error: str) -> None:
+        with self._lock:
+            self.failures += 1
+            self.last_error = error
+            self.probe_in_flight = False
+            if self.state == "half_open" or (self.state == "closed" and self.failures >= self.failure_threshold):
+                self.state = "open"
+                self.opened_at = time.monotonic()
+                log.warning(f"[sheets_breaker] open after {self.failures} failures: {error}")
+
+    def release_probe(self) -> None:
+        """請求以非 Sheets 因素結束（例如程式錯誤）時釋放探測名額，狀態不變"""
+        with self._lock:
+            self.probe_in_flight = False
+
+    def is_closed(self) -> bool:
+        with self._lock:
+            return self.state == "closed"
+
+    def status(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "state": self.state,
+                "consecutive_failures": self.failures,
+                "open_for_seconds": round(time.monotonic() - self.opened_at, 1) if self.opened_at is not None else None,
+                "last_error": self.last_error,
+            }
+
+SHEETS_BREAKER = SheetsCircuitBreaker(SHEETS_BREAKER_FAILURE_THRESHOLD, SHEETS_BREAKER_OPEN_SECONDS)
+
+class ThrottledAuthorizedSession(AuthorizedSession):
+    """每次送出前經過 SHEETS_BREAKER 與 SHEETS_LIMITER；429 一律以 jitter 退避重試，
+    5xx 與連線錯誤只在 GET 或 sheets_idempotent() 區塊內重試"""
+
+    def request(self, method, url, *args, **kwargs):
+        priority = _SHEETS_PRIORITY.get()
+        if priority is None:
+            priority = SHEETS_PRIORITY_READ if method.upper() == "GET" else SHEETS_PRIORITY_WRITE
+        priority_name = SHEETS_PRIORITY_NAMES.get(priority, "read")
+        kwargs.setdefault("timeout", SHEETS_HTTP_TIMEOUT_SECONDS)
+        retry_transient = method.upper() == "GET" or _SHEETS_IDEMPOTENT.get()
+        attempt = 0
+        while True:
+            if not SHEETS_BREAKER.allow():
+                raise SheetsUnavailable(f"Sheets circuit open: {SHEETS_BREAKER.last_error}")
+            settled = False
+            try:
+                _record_sheets_request(priority_name, SHEETS_LIMITER.acquire(priority))
+                resp = super().request(method, url, *args, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                SHEETS_BREAKER.record_failure(type(e).__name__)
+                settled = True
+                if not retry_transient:
+                    raise
+                if attempt >= SHEETS_MAX_RETRIES:
+                    with SHEETS_METRICS_LOCK:
+                        SHEETS_METRICS["exhausted"] += 1
+                    raise
+                delay = _sheets_backoff_seconds(attempt, None)
+                log.warning(f"[sheets] {method} {type(e).__name__}, retry {attempt + 1} in {delay:.1f}s")
+            except (requests.exceptions.RequestException, google.auth.exceptions.TransportError) as e:
+                # ChunkedEncodingError、token 換發連線失敗等：同樣視為 Sheets 端失敗，但不重試
+                SHEETS_BREAKER.record_failure(type(e).__name__)
+                settled = True
+                raise
+            else:
+                status = resp.status_code
+                if status >= 500:
+                    SHEETS_BREAKER.record_failure(f"HTTP {status}")
+                else:
+                    SHEETS_BREAKER.record_success()
+                settled = True
+                if status not in SHEETS_RETRY_STATUSES or (status != 429 and not retry_transient):
+                    return resp
+                with SHEETS_METRICS_LOCK:
+                    SHEETS_METRICS["status_429" if status == 429 else "status_5xx"] += 1
+                if attempt >= SHEETS_MAX_RETRIES:
+                    with SHEETS_METRICS_LOCK:
+                        SHEETS_METRICS["exhausted"] += 1
+                    log.error(f"[sheets] {method} gave up after {attempt + 1} attempts, status={status}")
+                    return resp
+                delay = _sheets_backoff_seconds(attempt, resp.headers.get("Retry-After"))
+                log.warning(f"[sheets] {method} status={status} priority={priority_name}, retry {attempt + 1} in {delay:.1f}s")
+            finally:
+                # 其他例外（RefreshError、程式錯誤）不計入斷路器，但半開探測名額必須釋放，否則斷路器永遠停在半開
+                if not settled:
+                    SHEETS_BREAKER.release_probe()
+            with SHEETS_METRICS_LOCK:
+                SHEETS_METRICS["retries"] += 1
+            time.sleep(delay)
+            attempt += 1
+
+# ---- 共用連線 ----
+# 全程序共用一個 SheetsTransport：同一組憑證、同一個 keep-alive 連線池（gspread 與 values API 共用），
+# 背景執行緒在 token 到期前主動更新，請求路徑不會遇到 discovery、TLS 交握或換發 token
+SHEETS_API_BASE = "https://sheets.googleapis.com/v4/spreadsheets"
+SHEETS_POOL_SIZE = 16  # gunicorn 8 執行緒 + IO_EXECUTOR 8 個工作執行緒
+SHEETS_HTTP_TIMEOUT_SECONDS = 15
+TOKEN_REFRESH_MARGIN_SECONDS = 300
+TOKEN_CHECK_INTERVAL_SECONDS = 60
+
+class SheetsTransport:
+    def __init__(self):
+        self.creds, _ = google.auth.default(scopes=SCOPES)
+        self.session = ThrottledAuthorizedSession(self.creds)
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=SHEETS_POOL_SIZE)
+        self.session.mount("https://", adapter)
+        self.gspread_client = gspread.Client(auth=self.creds, session=self.session)
+        self._refresh_lock = Lock()
+        # token 換發走獨立連線，不佔 Sheets 配額也不受斷路器影響
+        self._auth_request = GoogleAuthRequest()
+        self._refresh_token()
+        threading.Thread(target=self._refresh_loop, name="sheets-token", daemon=True).start()
+
+    def _token_expiring(self) -> bool:
+        if not self.creds.valid:
+            return True
+        expiry = getattr(self.creds, "expiry", None)
+        if expiry is None:
+            return False
+        # google-auth 的 expiry 為 naive UTC
+        return (expiry - datetime.utcnow()).total_seconds() < TOKEN_REFRESH_MARGIN_SECONDS
+
+    def _refresh_token(self) -> None:
+        with self._refresh_lock:
+            if self._token_expiring():
+                self.creds.refresh(self._auth_request)
+                log.info(f"[sheets] token refreshed, expiry={getattr(self.creds, 'expiry', None)}")
+
+    def _refresh_loop(self) -> None:
+        while True:
+            time.sleep(TOKEN_CHECK_INTERVAL_SECONDS)
+            try:
+                self._refresh_token()
+            except Exception as e:
+                log.warning(f"[sheets] background token refresh failed: {e}")
+
+    def values_get(self, range_name: str) -> List[List[str]]:
+        resp = self.session.get(f"{SHEETS_API_BASE}/{SPREADSHEET_ID}/values/{urllib.parse.quote(range_name, safe='')}", timeout=SHEETS_HTTP_TIMEOUT_SECONDS)
+        resp.raise_for_status()
+        return resp.json().get("values", [])
+
+    def values_batch_get(self, ranges: List[str]) -> List[List[List[str]]]:
+        params = [("ranges", r) for r in ranges] + [("majorDimension", "ROWS")]
+        resp = self.session.get(f"{SHEETS_API_BASE}/{SPREADSHEET_ID}/values:batchGet", params=params, timeout=SHEETS_HTTP_TIMEOUT_SECONDS)
+        resp.raise_for_status()
+        return [vr.get("values", []) for vr in resp.json().get("valueRanges", [])]
+
+    def values_batch_update(self, data: List[Dict[str, Any]], value_input_option: str = "USER_ENTERED") -> None:
+        """一次寫入多個範圍（可跨工作表，range 需帶工作表名稱）"""
+        body = {"valueInputOption": value_input_option, "data": data}
+        with sheets_idempotent():
+            resp = self.session.post(f"{SHEETS_API_BASE}/{SPREADSHEET_ID}/values:batchUpdate", json=body, timeout=SHEETS_HTTP_TIMEOUT_SECONDS)
+        resp.raise_for_status()
+
+_sheets_transport: Optional[SheetsTransport] = None
+_sheets_transport_lock = Lock()
+
+def _get_sheets_transport() -> SheetsTransport:
+    global _sheets_transport
+    if _sheets_transport is None:
+        with _sheets_transport_lock:
+            if _sheets_transport is None:
+                _sheets_transport = SheetsTransport()
+    return _sheets_transport
+
 def _get_gspread_client() -> gspread.Client:
-    global _gc_cache
-    if _gc_cache is None:
-        with _gc_lock:
-            if _gc_cache is None:
-                creds, _ = google.auth.default(scopes=SCOPES)
-                _gc_cache = gspread.authorize(creds)
-    return _gc_cache
+    return _get_sheets_transport().gspread_client
 
 def _invalidate_ws_cache(sheet_name: Optional[str] = None) -> None:
     with _ws_lock:
@@ -325,6 +1062,9 @@ def open_ws(name: str) -> gspread.Worksheet:
         _ws_cache[name] = ws
     return ws
 
+def _sheet_range(sheet_name: str, a1: str) -> str:
+    return f"'{sheet_name}'!{a1}"
+
 def _sheet_headers(ws: gspread.Worksheet, header_row: int, values: Optional[List[List[str]]] = None) -> List[str]:
     if values is not None and len(values) >= header_row:
         headers = values[header_row - 1]
@@ -390,49 +1130,6 @@ def _find_qrcode_row(values: List[List[str]], hmap: Dict[str, int], qrcode_value
             return i
     return None
 
-def _find_qrcode_row_json(values: List[List[str]], hmap: Dict[str, int], booking_id: str, sub_index: int) -> Optional[int]:
-    """在 Sheet 的 QRCode編碼（JSON）中查找子票對應的預約行"""
-    col = hmap.get("QRCode編碼")
-    if not col:
-        return None
-    
-    ci = col - 1
-    import json
-    
-    for i, row in enumerate(values[HEADER_ROW_MAIN:], start=HEADER_ROW_MAIN + 1):
-        if ci < len(row):
-            qr_cell = (row[ci] or "").strip()
-            if not qr_cell:
-                continue
-            
-            # 嘗試解析 JSON
-            try:
-                qr_dict = json.loads(qr_cell)
-                if isinstance(qr_dict, dict):
-                    # 檢查是否包含該子票的 QR Code
-                    sub_key = str(sub_index)
-                    if sub_key in qr_dict:
-                        # 驗證 booking_id 是否匹配
-                        qr_content = qr_dict[sub_key]
-                        if isinstance(qr_content, dict):
-                            # 新格式：{"qr": "FT:...", "status": "...", "pax": 2}
-                            qr_str = qr_content.get("qr", "")
-                        else:
-                            # 舊格式：直接是 QR Code 字符串
-                            qr_str = str(qr_content)
-                        
-                        if qr_str.startswith(f"FT:{booking_id}:{sub_index}:"):
-                            # 驗證預約編號
-                            idx_booking = _col_index(hmap, "預約編號")
-                            if idx_booking >= 0 and idx_booking < len(row):
-                                if (row[idx_booking] or "").strip() == booking_id:
-                                    return i
-            except (json.JSONDecodeError, ValueError, AttributeError):
-                # 如果不是 JSON，跳過（可能是舊格式）
-                continue
-    
-    return None
-
 def _find_booking_row(values: List[List[str]], hmap: Dict[str, int], booking_id: str) -> Optional[int]:
     idx_booking = _col_index(hmap, "預約編號")
     if idx_booking < 0:
@@ -448,12 +1145,11 @@ def _col_letter(col_idx: int) -> str:
 # ========== 快取管理 ==========
 def _get_cached_sheet_data(sheet_name: str, range_name: str):
     now = datetime.now()
-    global SHEET_CACHE
     with CACHE_LOCK:
-        cached_values = SHEET_CACHE.get("values")
-        cached_sheet = SHEET_CACHE.get("sheet_name")
-        cached_range = SHEET_CACHE.get("range_name")
-        fetched_at = SHEET_CACHE.get("fetched_at")
+        cached_values = RANGE_CACHE.get("values")
+        cached_sheet = RANGE_CACHE.get("sheet_name")
+        cached_range = RANGE_CACHE.get("range_name")
+        fetched_at = RANGE_CACHE.get("fetched_at")
         if (
             cached_values is not None
             and cached_sheet == sheet_name
@@ -464,37 +1160,140 @@ def _get_cached_sheet_data(sheet_name: str, range_name: str):
             return cached_values
     return None
 
+def _get_cached_sheet_body(sheet_name: str, range_name: str) -> Optional[Tuple[bytes, str]]:
+    """快取中的值序列化一次後連同 ETag 保存，之後的請求直接重用"""
+    values = _get_cached_sheet_data(sheet_name, range_name)
+    if values is None:
+        return None
+    with CACHE_LOCK:
+        if RANGE_CACHE.get("values") is values and RANGE_CACHE.get("body") is not None:
+            return RANGE_CACHE["body"], RANGE_CACHE["etag"]
+    body = _dumps(values)
+    etag = _body_etag(body)
+    with CACHE_LOCK:
+        if RANGE_CACHE.get("values") is values:
+            RANGE_CACHE["body"] = body
+            RANGE_CACHE["etag"] = etag
+    return body, etag
+
 def _set_cached_sheet_data(sheet_name: str, range_name: str, values: list):
-    global SHEET_CACHE
+    global RANGE_CACHE
     with CACHE_LOCK:
-        SHEET_CACHE = {
+        RANGE_CACHE = {
             "values": values,
             "fetched_at": datetime.now(),
             "sheet_name": sheet_name,
             "range_name": range_name
         }
 
+def _get_cached_system_config() -> Optional[List[List[str]]]:
+    with CACHE_LOCK:
+        if _fresh_cache(SYSTEM_CONFIG_CACHE, _tz_now()):
+            return SYSTEM_CONFIG_CACHE["values"]
+    return None
+
+def _set_cached_system_config(values: List[List[str]]) -> None:
+    global SYSTEM_CONFIG_CACHE
+    with CACHE_LOCK:
+        SYSTEM_CONFIG_CACHE = {"values": values, "fetched_at": _tz_now()}
+
+# ========== 主表欄位投影讀取 ==========
+# 主表只讀取 HEADER_KEYS 所在的欄位（相鄰欄位合併為同一段），以 values.batchGet 一次取得，
+# 再組回原本的欄位位置，呼叫端仍以 hmap 的欄號索引與寫回；未讀取的欄位為空字串
+MAIN_PROJECTION: Dict[str, Any] = {"hmap": None, "runs": None, "resolved_at": None}
+MAIN_PROJECTION_LOCK = Lock()
+
+def _projection_runs(hmap: Dict[str, int]) -> List[Tuple[int, int]]:
+    """需要的欄號合併為連續區段 [(start, end)]（1-based, inclusive），間隔不超過 MAIN_PROJECTION_MAX_GAP 時併段"""
+    runs: List[Tuple[int, int]] = []
+    for col in sorted(set(hmap.values())):
+        if runs and col - runs[-1][1] <= MAIN_PROJECTION_MAX_GAP + 1:
+            runs[-1] = (runs[-1][0], col)
+        else:
+            runs.append((col, col))
+    return runs
+
+def _resolve_main_projection(ws: gspread.Worksheet) -> Dict[str, Any]:
+    headers = _sheet_headers(ws, HEADER_ROW_MAIN)
+    hmap = header_map_main(values=[[] for _ in range(HEADER_ROW_MAIN - 1)] + [headers])
+    projection = {"hmap": hmap, "runs": _projection_runs(hmap), "resolved_at": time.time()}
+    with MAIN_PROJECTION_LOCK:
+        MAIN_PROJECTION.update(projection)
+    log.info(f"[main_projection] resolved {len(hmap)} headers into {len(projection['runs'])} ranges")
+    return projection
+
+def _fetch_projected_rows(runs: List[Tuple[int, int]]) -> List[List[str]]:
+    ranges = [f"'{SHEET_NAME_MAIN}'!{_col_letter(start)}1:{_col_letter(end)}" for start, end in runs]
+    return _assemble_projected_rows(runs, _get_sheets_transport().values_batch_get(ranges))
+
+def _assemble_projected_rows(runs: List[Tuple[int, int]], blocks: List[List[List[str]]]) -> List[List[str]]:
+    width = max(end for _, end in runs)
+    nrows = max((len(b) for b in blocks), default=0)
+    values: List[List[str]] = []
+    for i in range(nrows):
+        row = [""] * width
+        for (start, _), block in zip(runs, blocks):
+            if i < len(block):
+                cells = block[i]
+                row[start - 1:start - 1 + len(cells)] = cells
+        values.append(row)
+    return values
+
+def _projected_headers_match(values: List[List[str]], hmap: Dict[str, int]) -> bool:
+    if len(values) < HEADER_ROW_MAIN:
+        return False
+    header_row = values[HEADER_ROW_MAIN - 1]
+    return all(col - 1 < len(header_row) and (header_row[col - 1] or "").strip() == name for name, col in hmap.items())
+
+def _read_main_projected(ws: gspread.Worksheet, force_resolve: bool = False) -> Tuple[List[List[str]], Dict[str, int]]:
+    """表頭對應沿用上次解析結果；讀回的表頭與預期不符（欄位被移動）或超過重新檢查間隔時才重新解析"""
+    with MAIN_PROJECTION_LOCK:
+        projection = dict(MAIN_PROJECTION)
+    if force_resolve or projection["hmap"] is None or time.time() - projection["resolved_at"] > MAIN_PROJECTION_RECHECK_SECONDS:
+        projection = _resolve_main_projection(ws)
+    if not projection["runs"]:
+        return _read_all_rows(ws), projection["hmap"]
+    values = _fetch_projected_rows(projection["runs"])
+    if not _projected_headers_match(values, projection["hmap"]):
+        projection = _resolve_main_projection(ws)
+        values = _fetch_projected_rows(projection["runs"])
+    return values, projection["hmap"]
+
+def _cached_main() -> Optional[Tuple[List[List[str]], Dict[str, int]]]:
+    with CACHE_LOCK:
+        if _fresh_cache(SHEET_CACHE, _tz_now()):
+            return SHEET_CACHE["values"], SHEET_CACHE["header_map"]
+    return None
+
 def _get_sheet_data_main() -> Tuple[List[List[str]], Dict[str, int]]:
+    cached = _cached_main()
+    if cached is not None:
+        return cached
+    try:
+        return _fetch_main_snapshot()
+    except Exception as e:
+        stale = _stale_main() if _is_sheets_outage(e) else None
+        if stale is None:
+            raise
+        return stale
+
+def _fetch_main_snapshot() -> Tuple[List[List[str]], Dict[str, int]]:
+    try:
+        _refresh_sheets()
+        cached = _cached_main()
+        if cached is not None:
+            return cached
+    except Exception as e:
+        log.warning(f"[sheet_refresh] batch refresh failed, reading main sheet alone: {e}")
     now = _tz_now()
-    global SHEET_CACHE
-    with CACHE_LOCK:
-        cached_values = SHEET_CACHE.get("values")
-        fetched_at: Optional[datetime] = SHEET_CACHE.get("fetched_at")
-        if (
-            cached_values is not None
-            and fetched_at is not None
-            and (now - fetched_at).total_seconds() < CACHE_TTL_SECONDS
-        ):
-            return cached_values, SHEET_CACHE["header_map"]
     ws = open_ws(SHEET_NAME_MAIN)
-    values = _read_all_rows(ws)
-    hmap = header_map_main(ws, values)
-    SHEET_CACHE = {
-        "values": values,
-        "header_map": hmap,
-        "fetched_at": now,
-    }
-    return values, hmap
+    try:
+        values, hmap = _read_main_projected(ws)
+    except Exception as e:
+        log.warning(f"[main_projection] projected read failed, reading full sheet: {e}")
+        values = _read_all_rows(ws)
+        hmap = header_map_main(ws, values)
+    return _store_main_snapshot(values, hmap, now)
 
 def _invalidate_sheet_cache() -> None:
     global SHEET_CACHE
@@ -548,6 +1347,13 @@ def _get_cap_sheet_data() -> Tuple[List[List[str]], Dict[str, int], int]:
             and (now - fetched_at).total_seconds() < CACHE_TTL_SECONDS
         ):
             return cached_values, cached_hmap, cached_hdr_row
+    try:
+        _refresh_sheets()
+        with CACHE_LOCK:
+            if _fresh_cache(CAP_SHEET_CACHE, _tz_now()):
+                return CAP_SHEET_CACHE["values"], CAP_SHEET_CACHE["header_map"], CAP_SHEET_CACHE["hdr_row"]
+    except Exception as e:
+        log.warning(f"[sheet_refresh] batch refresh failed, reading cap sheet alone: {e}")
     ws_cap = open_ws(SHEET_NAME_CAP)
     try:
         head_chunk = ws_cap.get("A1:AZ10")
@@ -579,6 +1385,439 @@ def _get_cap_sheet_data() -> Tuple[List[List[str]], Dict[str, int], int]:
     }
     return values, m, hdr_row_local
 
+# ========== 多工作表批次刷新 ==========
+# 主表、可預約班次與系統設定格以一次 values.batchGet 取得並分送到各自的快取；
+# 任一快取過期時整批刷新，冷啟動或全部過期都只需要一次 API 呼叫
+SHEET_REFRESH_LOCK = Lock()
+SYSTEM_CONFIG_RANGE = f"{SHEET_NAME_SYSTEM}!E19"
+# 可預約班次的欄位範圍（表頭列與 CAP_REQ_HEADERS 所在欄），第一次整表讀取後記住
+CAP_PROJECTION: Dict[str, Any] = {"hdr_row": None, "start_col": None, "end_col": None}
+
+def _fresh_cache(cache: Dict[str, Any], now: datetime) -> bool:
+    fetched_at: Optional[datetime] = cache.get("fetched_at")
+    return cache.get("values") is not None and fetched_at is not None and (now - fetched_at).total_seconds() < CACHE_TTL_SECONDS
+
+def _pad_rows(values: List[List[str]]) -> List[List[str]]:
+    """與 get_all_values 相同：每列補齊到相同寬度"""
+    width = max((len(r) for r in values), default=0)
+    return [r + [""] * (width - len(r)) if len(r) < width else r for r in values]
+
+def _store_main_snapshot(values: List[List[str]], hmap: Dict[str, int], now: datetime) -> Tuple[List[List[str]], Dict[str, int]]:
+    global SHEET_CACHE
+    with MAIN_TYPED_LOCK:
+        previous = MAIN_TYPED_CACHE["values"]
+    if previous is not None and previous == values:
+        # 內容未變：沿用同一個物件，型別欄位與司機視圖都不需重建
+        values = previous
+    _main_typed_columns(values, hmap)
+    with CACHE_LOCK:
+        SHEET_CACHE = {
+            "values": values,
+            "header_map": hmap,
+            "fetched_at": now,
+        }
+    _remember_good_main(values, hmap, now)
+    return values, hmap
+
+def _store_cap_snapshot(block: List[List[str]], projected: bool, now: datetime) -> None:
+    global CAP_SHEET_CACHE
+    if projected:
+        values = block
+        m_local, _ = _cap_header_map(values)
+        hdr_row = 1
+        if any(key not in m_local for key in CAP_REQ_HEADERS):
+            raise ValueError("cap projection headers moved")
+        m = m_local
+    else:
+        values = _pad_rows(block)
+        m, hdr_row = _cap_header_map(values)
+        if all(key in m for key in CAP_REQ_HEADERS):
+            CAP_PROJECTION.update({"hdr_row": hdr_row, "start_col": min(m.values()), "end_col": max(m.values())})
+    with CACHE_LOCK:
+        CAP_SHEET_CACHE = {
+            "values": values,
+            "header_map": m,
+            "hdr_row": hdr_row,
+            "fetched_at": now,
+        }
+
+def _refresh_sheets() -> None:
+    """
+    以單次 batchGet 刷新主表、可預約班次與系統設定格
+    主表 / 可預約班次已知欄位範圍時只讀投影欄位，否則讀整張表並從中解析欄位範圍供下次使用
+    """
+    with SHEET_REFRESH_LOCK:
+        now = _tz_now()
+        with CACHE_LOCK:
+            if _fresh_cache(SHEET_CACHE, now) and _fresh_cache(CAP_SHEET_CACHE, now) and _fresh_cache(SYSTEM_CONFIG_CACHE, now):
+                return
+        with MAIN_PROJECTION_LOCK:
+            main_projection = dict(MAIN_PROJECTION)
+        main_projected = main_projection["hmap"] is not None and main_projection["runs"] and time.time() - main_projection["resolved_at"] <= MAIN_PROJECTION_RECHECK_SECONDS
+        cap_projected = CAP_PROJECTION["hdr_row"] is not None
+        ranges: List[str] = []
+        if main_projected:
+            ranges.extend(f"'{SHEET_NAME_MAIN}'!{_col_letter(start)}1:{_col_letter(end)}" for start, end in main_projection["runs"])
+        else:
+            ranges.append(f"'{SHEET_NAME_MAIN}'")
+        main_count = len(ranges)
+        if cap_projected:
+            ranges.append(f"'{SHEET_NAME_CAP}'!{_col_letter(CAP_PROJECTION['start_col'])}{CAP_PROJECTION['hdr_row']}:{_col_letter(CAP_PROJECTION['end_col'])}")
+        else:
+            ranges.append(f"'{SHEET_NAME_CAP}'")
+        ranges.append(f"'{SHEET_NAME_SYSTEM}'!E19")
+        blocks = _get_sheets_transport().values_batch_get(ranges)
+        if len(blocks) != len(ranges):
+            raise ValueError(f"batchGet returned {len(blocks)} ranges, expected {len(ranges)}")
+        now = _tz_now()
+        main_blocks, cap_block, system_block = blocks[:main_count], blocks[main_count], blocks[main_count + 1]
+        if main_projected:
+            values = _assemble_projected_rows(main_projection["runs"], main_blocks)
+            hmap = main_projection["hmap"]
+            if not _projected_headers_match(values, hmap):
+                # 欄位被移動：重新解析表頭後單獨讀取（少見）
+                values, hmap = _read_main_projected(open_ws(SHEET_NAME_MAIN), force_resolve=True)
+        else:
+            values = _pad_rows(main_blocks[0])
+            hmap = header_map_main(values=values)
+            with MAIN_PROJECTION_LOCK:
+                MAIN_PROJECTION.update({"hmap": hmap, "runs": _projection_runs(hmap), "resolved_at": time.time()})
+        _store_main_snapshot(values, hmap, now)
+        try:
+            _store_cap_snapshot(cap_block, cap_projected, now)
+        except ValueError as e:
+            log.warning(f"[sheet_refresh] {e}; cap sheet will be re-resolved")
+            CAP_PROJECTION.update({"hdr_row": None, "start_col": None, "end_col": None})
+            _invalidate_cap_sheet_cache()
+        _set_cached_system_config(system_block)
+        log.info(f"[sheet_refresh] {len(ranges)} ranges in one batchGet (main={'projected' if main_projected else 'full'}, cap={'projected' if cap_projected else 'full'})")
+
+# ========== 降級唯讀模式 ==========
+# Sheets 斷路器開啟時：讀取改用最後一次成功的主表快照（記憶體，冷啟動時從磁碟載入）並標記為過期；
+# 司機端寫入（舊格式核銷、No-show、人工驗票）記入待寫入佇列並落地，恢復後依預約編號重新定位列一次寫回
+MAIN_SNAPSHOT_PATH = os.path.join(STATE_DIR, "main_snapshot.json")
+PENDING_WRITES_PATH = os.path.join(STATE_DIR, "pending_writes.json")
+LAST_GOOD_MAIN: Dict[str, Any] = {"values": None, "header_map": None, "fetched_at": None}
+# 核銷寫回每次都會修補快照；落地整份主表 JSON 最多每 30 秒一次（冷啟動備援，晚幾秒無妨）
+MAIN_SNAPSHOT_PERSIST_INTERVAL_SECONDS = 30
+MAIN_SNAPSHOT_PERSIST: Dict[str, Any] = {"last_at": float("-inf"), "scheduled": False}
+DEGRADED_STATE: Dict[str, Any] = {"stale_since": None}
+DEGRADED_LOCK = Lock()
+PENDING_SHEET_WRITES: List[Dict[str, Any]] = []
+PENDING_WRITES_LOCK = Lock()
+PENDING_REPLAY_LOCK = Lock()
+
+def _write_state_file(path: str, payload: bytes) -> None:
+    """先寫暫存檔並 fsync，再以 os.replace 原子替換，避免程序中斷留下半個檔案"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(payload)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def _read_state_file(path: str) -> Optional[Any]:
+    try:
+        with open(path, "rb") as f:
+            return json.loads(f.read())
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        log.warning(f"[degraded] failed to read {path}: {e}")
+        return None
+
+def _persist_main_snapshot() -> None:
+    """落地目前最新的主表快照；排程期間的多次變更只寫最後一份"""
+    with DEGRADED_LOCK:
+        MAIN_SNAPSHOT_PERSIST["scheduled"] = False
+        MAIN_SNAPSHOT_PERSIST["last_at"] = time.monotonic()
+        values, hmap, fetched_at = LAST_GOOD_MAIN["values"], LAST_GOOD_MAIN["header_map"], LAST_GOOD_MAIN["fetched_at"]
+    if values is None:
+        return
+    try:
+        _write_state_file(MAIN_SNAPSHOT_PATH, _dumps({"values": values, "header_map": hmap, "fetched_at": fetched_at.isoformat()}))
+    except Exception as e:
+        log.warning(f"[degraded] failed to persist main snapshot: {e}")
+
+def _remember_good_main(values: List[List[str]], hmap: Dict[str, int], fetched_at: datetime) -> None:
+    """每次成功讀取主表後呼叫；內容有變才落地，且每 MAIN_SNAPSHOT_PERSIST_INTERVAL_SECONDS 最多一次"""
+    delay = None
+    with DEGRADED_LOCK:
+        changed = LAST_GOOD_MAIN["values"] is not values
+        LAST_GOOD_MAIN.update({"values": values, "header_map": hmap, "fetched_at": fetched_at})
+        recovered = DEGRADED_STATE["stale_since"] is not None
+        DEGRADED_STATE["stale_since"] = None
+        if changed and not MAIN_SNAPSHOT_PERSIST["scheduled"]:
+            MAIN_SNAPSHOT_PERSIST["scheduled"] = True
+            delay = max(0.0, MAIN_SNAPSHOT_PERSIST["last_at"] + MAIN_SNAPSHOT_PERSIST_INTERVAL_SECONDS - time.monotonic())
+    if recovered:
+        log.info("[degraded] fresh main snapshot loaded, leaving read-only mode")
+    if delay is None:
+        return
+    if delay > 0:
+        timer = threading.Timer(delay, IO_EXECUTOR.submit, (_persist_main_snapshot,))
+        timer.daemon = True
+        timer.start()
+    else:
+        IO_EXECUTOR.submit(_persist_main_snapshot)
+
+def _load_persisted_main() -> None:
+    data = _read_state_file(MAIN_SNAPSHOT_PATH)
+    if not data or not data.get("values") or not data.get("header_map"):
+        return
+    with DEGRADED_LOCK:
+        if LAST_GOOD_MAIN["values"] is None:
+            LAST_GOOD_MAIN.update({
+                "values": data["values"],
+                "header_map": data["header_map"],
+                "fetched_at": datetime.fromisoformat(data["fetched_at"]),
+            })
+            log.info(f"[degraded] loaded persisted main snapshot from {data['fetched_at']}")
+
+def _stale_main() -> Optional[Tuple[List[List[str]], Dict[str, int]]]:
+    with DEGRADED_LOCK:
+        missing = LAST_GOOD_MAIN["values"] is None
+    if missing:
+        _load_persisted_main()
+    with DEGRADED_LOCK:
+        values, hmap = LAST_GOOD_MAIN["values"], LAST_GOOD_MAIN["header_map"]
+        if values is None:
+            return None
+        if DEGRADED_STATE["stale_since"] is None:
+            DEGRADED_STATE["stale_since"] = _tz_now()
+            log.warning(f"[degraded] serving main snapshot from {LAST_GOOD_MAIN['fetched_at']} (read-only mode)")
+    return values, hmap
+
+def _is_sheets_outage(e: Exception) -> bool:
+    if isinstance(e, (SheetsUnavailable, requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+        return True
+    status = getattr(getattr(e, "response", None), "status_code", None)
+    return status is not None and status >= 500
+
+def _persist_pending_writes() -> None:
+    with PENDING_WRITES_LOCK:
+        payload = _dumps(PENDING_SHEET_WRITES)
+    try:
+        _write_state_file(PENDING_WRITES_PATH, payload)
+    except Exception as e:
+        log.error(f"[degraded] failed to persist pending writes: {e}")
+
+def _load_pending_writes() -> None:
+    data = _read_state_file(PENDING_WRITES_PATH)
+    if not data:
+        return
+    with PENDING_WRITES_LOCK:
+        PENDING_SHEET_WRITES[:0] = data
+    log.info(f"[degraded] loaded {len(data)} pending writes from disk")
+
+def _pending_updates_for(booking_id: str) -> Dict[str, str]:
+    merged: Dict[str, str] = {}
+    with PENDING_WRITES_LOCK:
+        for item in PENDING_SHEET_WRITES:
+            if item["booking_id"] == booking_id:
+                merged.update(item["updates"])
+    return merged
+
+def _write_booking_rows(rows: Dict[int, Tuple[str, Dict[str, str]]], hmap: Dict[str, int]) -> bool:
+    """
+    寫回主表多列（列號 → (預約編號, 欄位值)），合併為一次 batch_update；Sheets 無法使用時改記入待寫入佇列
+    返回 True 表示已直接寫入，False 表示已排入佇列待恢復後寫回
+    """
+    data = [
+        {"range": gspread.utils.rowcol_to_a1(rowno, hmap[k]), "values": [[v]]}
+        for rowno, (_, updates) in rows.items()
+        for k, v in updates.items()
+        if k in hmap
+    ]
+    if not data:
+        return True
+    if SHEETS_BREAKER.is_closed():
+        try:
+            with sheets_idempotent():
+                open_ws(SHEET_NAME_MAIN).batch_update(data, value_input_option="USER_ENTERED")
+            return True
+        except Exception as e:
+            if not _is_sheets_outage(e):
+                raise
+            log.warning(f"[degraded] write for {len(rows)} bookings failed ({type(e).__name__}), queued")
+    queued_at = _tz_now_str()
+    with PENDING_WRITES_LOCK:
+        for booking_id, updates in rows.values():
+            PENDING_SHEET_WRITES.append({"booking_id": booking_id, "updates": updates, "queued_at": queued_at})
+    _persist_pending_writes()
+    return False
+
+def _write_booking_updates(rowno: int, booking_id: str, updates: Dict[str, str], hmap: Dict[str, int]) -> bool:
+    """寫回主表單列；見 _write_booking_rows"""
+    return _write_booking_rows({rowno: (booking_id, updates)}, hmap)
+
+def _replay_pending_writes() -> None:
+    """Sheets 恢復後重送待寫入資料：以最新主表依預約編號重新定位列，合併為一次 batch_update"""
+    if not SHEETS_BREAKER.is_closed() or not PENDING_REPLAY_LOCK.acquire(blocking=False):
+        return
+    try:
+        with PENDING_WRITES_LOCK:
+            pending = list(PENDING_SHEET_WRITES)
+        if not pending:
+            return
+        values, hmap = _get_sheet_data_main()
+        if DEGRADED_STATE["stale_since"] is not None:
+            return
+        data = []
+        for item in pending:
+            rowno = _find_booking_row(values, hmap, item["booking_id"])
+            if not rowno:
+                log.warning(f"[degraded] pending write for {item['booking_id']} dropped: booking not found")
+                continue
+            data.extend({"range": gspread.utils.rowcol_to_a1(rowno, hmap[k]), "values": [[v]]} for k, v in item["updates"].items() if k in hmap)
+        if data:
+            with sheets_idempotent():
+                open_ws(SHEET_NAME_MAIN).batch_update(data, value_input_option="USER_ENTERED")
+        with PENDING_WRITES_LOCK:
+            del PENDING_SHEET_WRITES[:len(pending)]
+        _persist_pending_writes()
+        _invalidate_sheet_cache()
+        log.info(f"[degraded] replayed {len(pending)} pending writes ({len(data)} cells)")
+    except Exception as e:
+        log.warning(f"[degraded] replay failed, will retry: {e}")
+    finally:
+        PENDING_REPLAY_LOCK.release()
+
+def _probe_sheets() -> None:
+    """斷路器開啟時由背景執行緒呼叫；半開時送出一個輕量讀取作為探測"""
+    try:
+        _get_sheets_transport().values_get(SYSTEM_CONFIG_RANGE)
+    except Exception:
+        pass
+
+def _degraded_status() -> Dict[str, Any]:
+    with DEGRADED_LOCK:
+        stale_since = DEGRADED_STATE["stale_since"]
+        snapshot_at = LAST_GOOD_MAIN["fetched_at"]
+    with PENDING_WRITES_LOCK:
+        pending_writes = len(PENDING_SHEET_WRITES)
+    with CHECKIN_CACHE_LOCK:
+        pending_checkins = sum(len(v) for v in CHECKIN_CACHE.values()) + sum(len(v) for v in CHECKIN_INFLIGHT.values())
+    return {
+        "breaker": SHEETS_BREAKER.status(),
+        "read_only": stale_since is not None,
+        "stale_since": stale_since.strftime("%Y-%m-%d %H:%M:%S") if stale_since else None,
+        "snapshot_fetched_at": snapshot_at.strftime("%Y-%m-%d %H:%M:%S") if snapshot_at else None,
+        "pending_writes": pending_writes,
+        "pending_checkins": pending_checkins,
+    }
+
+# ========== 車次管理表快取 ==========
+def _trip_mgmt_key(date_raw: str, time_raw: str) -> Optional[Tuple[str, str]]:
+    """將各種日期 / 時間寫法（2025/1/8、2025-01-08、8:05、08:05:00）正規化為 (YYYY-MM-DD, HH:MM)"""
+    try:
+        d = (date_raw or "").strip().replace("-", "/").split("/")
+        t = (time_raw or "").strip().replace("：", ":").split(":")
+        if len(d) != 3 or len(t) < 2:
+            return None
+        return (f"{int(d[0]):04d}-{int(d[1]):02d}-{int(d[2]):02d}", f"{int(t[0]):02d}:{int(t[1][:2]):02d}")
+    except (ValueError, IndexError):
+        return None
+
+def _trip_mgmt_key_from_dt(dt: datetime) -> Tuple[str, str]:
+    return (dt.strftime("%Y-%m-%d"), dt.strftime("%H:%M"))
+
+def _load_trip_mgmt_snapshot() -> Dict[str, Any]:
+    """讀取車次管理(櫃台)（失敗時改用備品）整張表一次，建立欄位與班次索引"""
+    sheet_name = SHEET_NAMES_TRIP_MGMT[0]
+    try:
+        ws = open_ws(sheet_name)
+    except Exception:
+        sheet_name = SHEET_NAMES_TRIP_MGMT[1]
+        ws = open_ws(sheet_name)
+    values = _read_all_rows(ws)
+    headers = _sheet_headers(ws, HEADER_ROW_TRIP_MGMT, values) if len(values) >= HEADER_ROW_TRIP_MGMT else []
+    def hidx(name: str) -> int:
+        try:
+            return headers.index(name)
+        except ValueError:
+            return -1
+    cols = {
+        "date": hidx("日期"),
+        "time": hidx("時間") if hidx("時間") >= 0 else hidx("班次"),
+        "status": hidx("出車狀態"),
+        "last": hidx("最後更新"),
+    }
+    index: Dict[Tuple[str, str], int] = {}
+    if cols["date"] >= 0 and cols["time"] >= 0:
+        for i in range(HEADER_ROW_TRIP_MGMT, len(values)):
+            row = values[i]
+            key = _trip_mgmt_key(_get_cell(row, cols["date"]), _get_cell(row, cols["time"]))
+            if key and key not in index:
+                index[key] = i + 1
+    snapshot = {"sheet_name": sheet_name, "values": values, "cols": cols, "index": index, "fetched_at": _tz_now()}
+    global TRIP_MGMT_CACHE
+    with TRIP_MGMT_LOCK:
+        TRIP_MGMT_CACHE = snapshot
+    return snapshot
+
+def _get_trip_mgmt_snapshot() -> Dict[str, Any]:
+    with TRIP_MGMT_LOCK:
+        snapshot = TRIP_MGMT_CACHE
+        fetched_at: Optional[datetime] = snapshot.get("fetched_at")
+        if (
+            snapshot.get("index") is not None
+            and fetched_at is not None
+            and (_tz_now() - fetched_at).total_seconds() < TRIP_MGMT_CACHE_TTL_SECONDS
+        ):
+            return snapshot
+    return _load_trip_mgmt_snapshot()
+
+def _find_trip_mgmt_row(key: Tuple[str, str]) -> Tuple[Dict[str, Any], Optional[int]]:
+    """從快照索引查找班次列；找不到且快照已超過 TRIP_MGMT_MISS_RELOAD_SECONDS 時重新載入一次（班次可能是快照後才新增）"""
+    snapshot = _get_trip_mgmt_snapshot()
+    rowno = snapshot["index"].get(key)
+    if rowno is None and (_tz_now() - snapshot["fetched_at"]).total_seconds() >= TRIP_MGMT_MISS_RELOAD_SECONDS:
+        snapshot = _load_trip_mgmt_snapshot()
+        rowno = snapshot["index"].get(key)
+    return snapshot, rowno
+
+def _trip_mgmt_row_matches(snapshot: Dict[str, Any], rowno: int, key: Tuple[str, str]) -> bool:
+    """讀取該列的日期 / 時間欄確認仍是同一班次（表格由人工編輯，插入或刪除列會讓快照列號失準）"""
+    cols = snapshot["cols"]
+    first, last = min(cols["date"], cols["time"]) + 1, max(cols["date"], cols["time"]) + 1
+    a1 = f"{gspread.utils.rowcol_to_a1(rowno, first)}:{gspread.utils.rowcol_to_a1(rowno, last)}"
+    cells = (_get_sheets_transport().values_get(_sheet_range(snapshot["sheet_name"], a1)) or [[]])[0]
+    return _trip_mgmt_key(_get_cell(cells, cols["date"] + 1 - first), _get_cell(cells, cols["time"] + 1 - first)) == key
+
+def _write_trip_mgmt_status(snapshot: Dict[str, Any], rowno: int, status_text: str, key: Tuple[str, str]) -> bool:
+    """
+    寫入出車狀態與最後更新時間（單次 batch_update），並就地更新快照。
+    寫入路徑原本目標為零讀取，但表格由人工編輯、快照最長沿用 10 分鐘：快照未滿 TRIP_MGMT_VERIFY_AFTER_SECONDS
+    時直接寫入，較舊時先讀回該列一次確認；列號已失準時重新載入快照再定位，仍找不到時不寫入，返回 False
+    """
+    age = (_tz_now() - snapshot["fetched_at"]).total_seconds()
+    if age >= TRIP_MGMT_VERIFY_AFTER_SECONDS and not _trip_mgmt_row_matches(snapshot, rowno, key):
+        log.warning(f"[trip_mgmt] row {rowno} no longer holds {key}, reloading index")
+        snapshot = _load_trip_mgmt_snapshot()
+        rowno = snapshot["index"].get(key)
+        if rowno is None:
+            return False
+    cols = snapshot["cols"]
+    now_text = _tz_now().strftime("%Y/%m/%d %H:%M")
+    ws = open_ws(snapshot["sheet_name"])
+    data = [
+        {"range": gspread.utils.rowcol_to_a1(rowno, cols["status"] + 1), "values": [[status_text]]},
+        {"range": gspread.utils.rowcol_to_a1(rowno, cols["last"] + 1), "values": [[now_text]]},
+    ]
+    with sheets_idempotent():
+        ws.batch_update(data, value_input_option="USER_ENTERED")
+    with TRIP_MGMT_LOCK:
+        if TRIP_MGMT_CACHE is snapshot and rowno - 1 < len(snapshot["values"]):
+            row = snapshot["values"][rowno - 1]
+            width = max(cols["status"], cols["last"]) + 1
+            if len(row) < width:
+                row.extend([""] * (width - len(row)))
+            row[cols["status"]] = status_text
+            row[cols["last"]] = now_text
+    return True
+
 def lookup_capacity(direction: str, date_iso: str, time_hm: str, station: str) -> int:
     values, m, hdr_row = _get_cap_sheet_data()
     for key in CAP_REQ_HEADERS:
@@ -787,61 +2026,398 @@ def _generate_booking_id_rtdb(today_iso: str) -> str:
         seq_int = 0
     return f"{yymmdd}{seq_int:02d}"
 
-# ========== 母子車票管理（僅使用 Google Sheets）==========
-def _get_sub_tickets_from_sheet(booking_id: str, values: List[List[str]], hmap: Dict[str, int]) -> List[Dict[str, Any]]:
-    """
-    從 Sheet 的 QRCode編碼（JSON）中讀取所有子票
-    返回：子票列表，每個包含 sub_ticket_index, sub_ticket_pax, qr_content, status, checked_at
-    """
-    import json
-    col = hmap.get("QRCode編碼")
-    if not col:
-        return []
-    
-    ci = col - 1
-    sub_tickets = []
-    
-    # 查找對應的預約行
-    for i, row in enumerate(values[HEADER_ROW_MAIN:], start=HEADER_ROW_MAIN + 1):
-        if ci < len(row):
-            booking_id_col = hmap.get("預約編號", 0) - 1
-            if booking_id_col >= 0 and booking_id_col < len(row):
-                if row[booking_id_col].strip() == booking_id:
-                    qr_cell = (row[ci] or "").strip()
-                    if qr_cell:
-                        try:
-                            qr_dict = json.loads(qr_cell)
-                            if isinstance(qr_dict, dict):
-                                for sub_key, sub_data in qr_dict.items():
-                                    if sub_key.isdigit():
-                                        sub_index = int(sub_key)
-                                        if sub_index > 0:  # 排除母票（索引0）
-                                            if isinstance(sub_data, dict):
-                                                sub_tickets.append({
-                                                    "sub_ticket_index": sub_index,
-                                                    "sub_ticket_pax": sub_data.get("pax", 0),
-                                                    "qr_content": sub_data.get("qr", ""),
-                                                    "status": sub_data.get("status", "not_checked_in"),
-                                                    "checked_at": sub_data.get("checked_at")
-                                                })
-                                            else:
-                                                # 舊格式：直接是 QR Code 字符串
-                                                sub_tickets.append({
-                                                    "sub_ticket_index": sub_index,
-                                                    "sub_ticket_pax": 0,  # 舊格式沒有 pax 信息
-                                                    "qr_content": str(sub_data),
-                                                    "status": "not_checked_in",
-                                                    "checked_at": None
-                                                })
-                        except (json.JSONDecodeError, ValueError) as e:
-                            log.warning(f"[sub_ticket] Failed to parse QRCode JSON for {booking_id}: {e}")
-                    break
-    
-    # 排序：已上車的在前，未上車的在後，然後按索引排序
-    return sorted(sub_tickets, key=lambda x: (x.get("status") != "checked_in", x.get("sub_ticket_index", 0)))
+# ========== 核銷日誌（本機落地）==========
+# 每筆子票核銷先進 CHECKIN_CACHE，再以 JSON Lines 追加到日誌段並 fsync 後才回應掃碼；
+# 寫入執行緒一次取出所有排隊中的紀錄共用一次 fsync（group commit），掃碼量大時 fsync 次數不隨之增加。
+# 每次 flush 封存目前的日誌段並開新段，寫回成功後刪除已封存的段；啟動時重放所有殘留段重建快取
+CHECKIN_JOURNAL_DIR = os.path.join(STATE_DIR, "checkin_journal")
+VOLATILE_FS_TYPES = ("tmpfs", "ramfs")
 
-def _create_sub_tickets(booking_id: str, ticket_split: List[int], email: str, start_index: int = 1) -> List[Dict[str, Any]]:
-    """
+def _mount_fs_type(path: str) -> Optional[str]:
+    """path 所在掛載點的檔案系統類型（取 /proc/mounts 中最長的前綴）"""
+    best, fs_type = "", None
+    try:
+        with open("/proc/mounts", "r") as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) < 3:
+                    continue
+                mount_point = parts[1].replace("\\040", " ")
+                if (path == mount_point or path.startswith(mount_point.rstrip("/") + "/")) and len(mount_point) > len(best):
+                    best, fs_type = mount_point, parts[2]
+    except OSError:
+        return None
+    return fs_type
+
+def _ensure_persistent_state_dir() -> None:
+    """Cloud Run（有 K_SERVICE）上 STATE_DIR 不是持久 volume 時拒絕啟動，避免已回應掃碼的核銷在重啟後消失"""
+    if not os.environ.get("K_SERVICE"):
+        return
+    path = os.path.realpath(STATE_DIR)
+    fs_type = _mount_fs_type(path)
+    if "SHUTTLE_STATE_DIR" not in os.environ or path == "/tmp" or path.startswith("/tmp/") or fs_type in VOLATILE_FS_TYPES:
+        raise RuntimeError(f"SHUTTLE_STATE_DIR={STATE_DIR} ({fs_type}) 不是持久 volume；請掛載 volume 並設定 SHUTTLE_STATE_DIR")
+    log.info(f"[state] STATE_DIR={path} fs={fs_type}")
+
+CHECKIN_JOURNAL_FSYNC_TIMEOUT_SECONDS = 2.0
+
+class CheckinJournal:
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.seq = 0
+        self._file = None
+        self._file_lock = Lock()
+        self._queue: "queue.Queue[Tuple[bytes, Dict[str, Any]]]" = queue.Queue()
+        self._writer: Optional[threading.Thread] = None
+
+    def _segment_path(self, seq: int) -> str:
+        return os.path.join(self.directory, f"{seq:08d}.jsonl")
+
+    def segments(self) -> List[int]:
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        return sorted(int(n[:-6]) for n in names if n.endswith(".jsonl") and n[:-6].isdigit())
+
+    def start(self, seq: int) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        with self._file_lock:
+            self.seq = seq
+            self._file = open(self._segment_path(seq), "ab")
+        if self._writer is None:
+            self._writer = threading.Thread(target=self._write_loop, name="checkin-journal", daemon=True)
+            self._writer.start()
+
+    def append(self, record: Dict[str, Any]) -> bool:
+        """排入寫入佇列並等待 fsync 完成；返回 False 表示未能落地（仍保留在記憶體快取）"""
+        if self._writer is None:
+            return False
+        pending = {"done": threading.Event(), "ok": False}
+        self._queue.put((_dumps(record) + b"\n", pending))
+        return pending["done"].wait(CHECKIN_JOURNAL_FSYNC_TIMEOUT_SECONDS) and pending["ok"]
+
+    def _write_loop(self) -> None:
+        while True:
+            items = [self._queue.get()]
+            while True:
+                try:
+                    items.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            ok = False
+            try:
+                with self._file_lock:
+                    for line, _ in items:
+                        self._file.write(line)
+                    self._file.flush()
+                    os.fsync(self._file.fileno())
+                ok = True
+            except Exception as e:
+                log.error(f"[checkin_journal] write failed for {len(items)} records: {e}")
+            for _, pending in items:
+                pending["ok"] = ok
+                pending["done"].set()
+
+    def rotate(self) -> int:
+        """封存目前的日誌段並開始新段，返回封存段的序號"""
+        with self._file_lock:
+            sealed = self.seq
+            if self._file is not None:
+                self._file.close()
+            self.seq = sealed + 1
+            self._file = open(self._segment_path(self.seq), "ab")
+        return sealed
+
+    def discard_through(self, seq: int) -> None:
+        """刪除序號 <= seq 的已封存段（其中的核銷都已寫回 Sheet）"""
+        for s in self.segments():
+            if s <= seq:
+                try:
+                    os.remove(self._segment_path(s))
+                except FileNotFoundError:
+                    pass
+
+    def read_segment(self, seq: int) -> List[Dict[str, Any]]:
+        records = []
+        with open(self._segment_path(seq), "rb") as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    # 程序中斷時最後一行可能只寫了一半
+                    log.warning(f"[checkin_journal] skipped truncated record in segment {seq}")
+        return records
+
+CHECKIN_JOURNAL = CheckinJournal(CHECKIN_JOURNAL_DIR)
+
+def _replay_checkin_journal() -> None:
+    """啟動時重放殘留的日誌段，重建尚未寫回的核銷；新的日誌段接在最大序號之後"""
+    segments = CHECKIN_JOURNAL.segments()
+    restored = 0
+    with CHECKIN_CACHE_LOCK:
+        for seq in segments:
+            try:
+                records = CHECKIN_JOURNAL.read_segment(seq)
+            except OSError as e:
+                log.error(f"[checkin_journal] failed to read segment {seq}: {e}")
+                continue
+            for rec in records:
+                subs = CHECKIN_CACHE.setdefault(rec["booking_id"], {})
+                if rec["sub_index"] not in subs:
+                    subs[rec["sub_index"]] = {"status": "checked_in", "checked_at": rec["checked_at"], "checked_by": rec["checked_by"]}
+                    restored += 1
+    CHECKIN_JOURNAL.start((segments[-1] + 1) if segments else 1)
+    if restored:
+        log.info(f"[checkin_journal] restored {restored} check-ins from {len(segments)} segments")
+
+def _pending_checkins_for(booking_id: str) -> Dict[int, Dict[str, Any]]:
+    """尚未反映在主表快照中的核銷：待寫回（CHECKIN_CACHE）與寫回中（CHECKIN_INFLIGHT）"""
+    with CHECKIN_CACHE_LOCK:
+        merged = dict(CHECKIN_INFLIGHT.get(booking_id, {}))
+        merged.update(CHECKIN_CACHE.get(booking_id, {}))
+    return merged
+
+# ========== 子票資料表 ==========
+# 子票存放在「子票」工作表，一張子票一列，以 (預約編號, 子票索引) 定位；核銷只覆寫該子票一列（寫入前讀回 A:B 確認列號未移動），
+# 不再讀出、改寫主表 QRCode編碼 整格 JSON。主表 QRCode編碼 只在分票時寫入子票結構（使整張票的 QR 失效）。
+# 載入時把主表 JSON 中尚未搬進子票表的子票補寫進去；子票不刪列，重新分票後不再使用的列標記為 void
+SUB_TICKET_HEADERS = ["預約編號", "子票索引", "人數", "QRCode編碼", "狀態", "核銷時間"]
+SUB_TICKET_VOID = "void"
+SUB_TICKET_SNAPSHOT_PATH = os.path.join(STATE_DIR, "sub_tickets.json")
+SUB_TICKET_LOAD_LOCK = Lock()
+
+def _sub_ticket_row(booking_id: str, t: Dict[str, Any]) -> List[str]:
+    return [booking_id, str(t["sub_ticket_index"]), str(t.get("sub_ticket_pax", 0)), t.get("qr_content", ""), t.get("status") or "not_checked_in", t.get("checked_at") or ""]
+
+def _build_sub_ticket_snapshot(values: List[List[str]], fetched_at: datetime) -> Dict[str, Any]:
+    """建立 (預約編號, 子票索引) → 列號索引、各預約的有效子票與預先彙總的 (已上車人數, 總人數)"""
+    index: Dict[Tuple[str, int], int] = {}
+    by_booking: Dict[str, List[Dict[str, Any]]] = {}
+    for rowno, row in enumerate(values[1:], start=2):
+        booking_id = _get_cell(row, 0)
+        sub_index = _safe_int(_get_cell(row, 1), 0)
+        if not booking_id or sub_index <= 0 or (booking_id, sub_index) in index:
+            # 多個實例同時搬移時可能重複追加，以先出現的列為準
+            continue
+        index[(booking_id, sub_index)] = rowno
+        status = _get_cell(row, 4) or "not_checked_in"
+        if status == SUB_TICKET_VOID:
+            continue
+        by_booking.setdefault(booking_id, []).append({
+            "sub_ticket_index": sub_index,
+            "sub_ticket_pax": _safe_int(_get_cell(row, 2), 0),
+            "qr_content": _get_cell(row, 3),
+            "status": status,
+            "checked_at": _get_cell(row, 5) or None,
+        })
+    summary: Dict[str, Tuple[int, int]] = {}
+    for booking_id, tickets in by_booking.items():
+        # 已上車的在前，未上車的在後，然後按索引排序
+        tickets.sort(key=lambda t: (t["status"] != "checked_in", t["sub_ticket_index"]))
+        summary[booking_id] = (
+            sum(t["sub_ticket_pax"] for t in tickets if t["status"] == "checked_in"),
+            sum(t["sub_ticket_pax"] for t in tickets),
+        )
+    version = hashlib.blake2b(_dumps(values), digest_size=8).hexdigest()
+    return {"values": values, "index": index, "by_booking": by_booking, "summary": summary, "version": version, "fetched_at": fetched_at}
+
+def _json_sub_ticket_rows(values: List[List[str]], hmap: Dict[str, int], skip: Set[str]) -> List[List[str]]:
+    """主表 QRCode編碼 JSON 中、子票表還沒有的預約的子票，轉成子票表的列"""
+    qr_col = _col_index(hmap, "QRCode編碼")
+    id_col = _col_index(hmap, "預約編號")
+    if qr_col < 0 or id_col < 0:
+        return []
+    rows: List[List[str]] = []
+    seen = set(skip)
+    for row in values[HEADER_ROW_MAIN:]:
+        cell = _get_cell(row, qr_col)
+        booking_id = _get_cell(row, id_col)
+        if not cell.startswith("{") or not booking_id or booking_id in seen:
+            continue
+        seen.add(booking_id)
+        try:
+            qr_dict = json.loads(cell)
+        except ValueError as e:
+            log.warning(f"[sub_ticket] Failed to parse QRCode JSON for {booking_id}: {e}")
+            continue
+        if not isinstance(qr_dict, dict):
+            continue
+        for sub_key, sub_data in qr_dict.items():
+            if not sub_key.isdigit() or int(sub_key) <= 0:
+                continue  # 排除母票（索引0）
+            if isinstance(sub_data, dict):
+                ticket = {"sub_ticket_index": int(sub_key), "sub_ticket_pax": sub_data.get("pax", 0), "qr_content": sub_data.get("qr", ""), "status": sub_data.get("status"), "checked_at": sub_data.get("checked_at")}
+            else:
+                # 舊格式：直接是 QR Code 字符串，沒有 pax 信息
+                ticket = {"sub_ticket_index": int(sub_key), "sub_ticket_pax": 0, "qr_content": str(sub_data)}
+            rows.append(_sub_ticket_row(booking_id, ticket))
+    return rows
+
+def _open_sub_ticket_ws() -> gspread.Worksheet:
+    try:
+        return open_ws(SHEET_NAME_SUB_TICKETS)
+    except gspread.WorksheetNotFound:
+        sh = _get_gspread_client().open_by_key(SPREADSHEET_ID)
+        ws = sh.add_worksheet(title=SHEET_NAME_SUB_TICKETS, rows=1000, cols=len(SUB_TICKET_HEADERS))
+        ws.append_row(SUB_TICKET_HEADERS, value_input_option="RAW")
+        log.info(f"[sub_ticket] created worksheet {SHEET_NAME_SUB_TICKETS}")
+        with _ws_lock:
+            _ws_cache[SHEET_NAME_SUB_TICKETS] = ws
+        return ws
+
+def _persist_sub_ticket_snapshot(snapshot: Dict[str, Any]) -> None:
+    with SUB_TICKET_LOCK:
+        if SUB_TICKET_CACHE is not snapshot:
+            return  # 已有更新的快照
+    try:
+        _write_state_file(SUB_TICKET_SNAPSHOT_PATH, _dumps({"values": snapshot["values"], "fetched_at": snapshot["fetched_at"].isoformat()}))
+    except Exception as e:
+        log.warning(f"[sub_ticket] failed to persist snapshot: {e}")
+
+def _store_sub_ticket_snapshot(snapshot: Dict[str, Any]) -> None:
+    global SUB_TICKET_CACHE
+    with SUB_TICKET_LOCK:
+        changed = SUB_TICKET_CACHE.get("values") != snapshot["values"]
+        SUB_TICKET_CACHE = snapshot
+    if changed:
+        IO_EXECUTOR.submit(_persist_sub_ticket_snapshot, snapshot)
+
+def _load_persisted_sub_tickets() -> Optional[Dict[str, Any]]:
+    data = _read_state_file(SUB_TICKET_SNAPSHOT_PATH)
+    if not data or not data.get("values"):
+        return None
+    log.info(f"[sub_ticket] loaded persisted snapshot from {data['fetched_at']}")
+    return _build_sub_ticket_snapshot(data["values"], datetime.fromisoformat(data["fetched_at"]))
+
+def _load_sub_ticket_snapshot() -> Dict[str, Any]:
+    """讀取子票表整張一次並建立索引；主表 JSON 中尚未搬移的子票先補寫進子票表"""
+    with SUB_TICKET_LOAD_LOCK:
+        ws = _open_sub_ticket_ws()
+        snapshot = _build_sub_ticket_snapshot(_read_all_rows(ws) or [SUB_TICKET_HEADERS], _tz_now())
+        main_values, hmap = _get_sheet_data_main()
+        migrated = _json_sub_ticket_rows(main_values, hmap, {booking_id for booking_id, _ in snapshot["index"]})
+        if migrated:
+            ws.append_rows(migrated, value_input_option="RAW")
+            log.info(f"[sub_ticket] migrated {len(migrated)} sub-tickets from QRCode編碼 JSON")
+            snapshot = _build_sub_ticket_snapshot(_read_all_rows(ws), _tz_now())
+        _store_sub_ticket_snapshot(snapshot)
+        return snapshot
+
+def _get_sub_ticket_snapshot() -> Dict[str, Any]:
+    global SUB_TICKET_CACHE
+    with SUB_TICKET_LOCK:
+        snapshot = SUB_TICKET_CACHE
+    fetched_at: Optional[datetime] = snapshot.get("fetched_at")
+    if (
+        snapshot.get("index") is not None
+        and fetched_at is not None
+        and (_tz_now() - fetched_at).total_seconds() < SUB_TICKET_CACHE_TTL_SECONDS
+    ):
+        return snapshot
+    try:
+        return _load_sub_ticket_snapshot()
+    except Exception as e:
+        if snapshot.get("index") is None and _is_sheets_outage(e):
+            # 降級模式冷啟動：改用落地的快照
+            snapshot = _load_persisted_sub_tickets() or {}
+            if snapshot:
+                with SUB_TICKET_LOCK:
+                    SUB_TICKET_CACHE = snapshot
+        if snapshot.get("index") is None:
+            raise
+        log.warning(f"[sub_ticket] reload failed, serving snapshot from {snapshot['fetched_at']}: {e}")
+        return snapshot
+
+def _invalidate_sub_ticket_cache() -> None:
+    """下次讀取時重新載入；載入失敗時仍可沿用目前的快照"""
+    global SUB_TICKET_CACHE
+    with SUB_TICKET_LOCK:
+        SUB_TICKET_CACHE = dict(SUB_TICKET_CACHE, fetched_at=None)
+
+def _patch_sub_ticket_snapshot(snapshot: Dict[str, Any], checkins: List[Tuple[int, str]]) -> None:
+    """核銷寫回後修補子票快照（列號, 核銷時間），重建索引與統計，不必重新讀取整張表"""
+    values = list(snapshot["values"])
+    width = len(SUB_TICKET_HEADERS)
+    for rowno, checked_at in checkins:
+        row = list(values[rowno - 1])
+        if len(row) < width:
+            row.extend([""] * (width - len(row)))
+        row[4] = "checked_in"
+        row[5] = checked_at
+        values[rowno - 1] = row
+    with SUB_TICKET_LOCK:
+        current = SUB_TICKET_CACHE
+    if current is not snapshot:
+        # 快照已在寫回期間被替換，無法確定是否包含這次寫入
+        _invalidate_sub_ticket_cache()
+        return
+    _store_sub_ticket_snapshot(_build_sub_ticket_snapshot(values, snapshot["fetched_at"]))
+
+def _verify_sub_ticket_rows(snapshot: Dict[str, Any], keys: List[Tuple[str, int]]) -> Dict[str, Any]:
+    """
+    依列號寫入前讀回子票表 A:B，確認各 (預約編號, 子票索引) 仍在快照記錄的列；
+    有人手動插入、刪除或排序過列時重新載入整張表，返回的快照索引即為重新定位後的列號
+    """
+    rows = {key: snapshot["index"][key] for key in keys if key in snapshot["index"]}
+    if not rows:
+        return snapshot
+    current = _get_sheets_transport().values_get(_sheet_range(SHEET_NAME_SUB_TICKETS, "A:B"))
+    for (booking_id, sub_index), rowno in rows.items():
+        row = current[rowno - 1] if rowno - 1 < len(current) else []
+        if _get_cell(row, 0) != booking_id or _safe_int(_get_cell(row, 1), 0) != sub_index:
+            log.warning(f"[sub_ticket] row {rowno} no longer holds {booking_id}#{sub_index}, reloading index")
+            return _load_sub_ticket_snapshot()
+    return snapshot
+
+def _save_sub_tickets(booking_id: str, tickets: List[Dict[str, Any]]) -> None:
+    """
+    以 tickets 取代預約的全部子票：同索引的列就地覆寫、新索引追加在表尾，
+    不再使用的列標記為 void（不刪列，其他子票的列號不變）；整列連同 (預約編號, 子票索引) 一起寫入
+    """
+    snapshot = _load_sub_ticket_snapshot()
+    snapshot = _verify_sub_ticket_rows(snapshot, [key for key in snapshot["index"] if key[0] == booking_id])
+    existing = {sub_index: rowno for (b, sub_index), rowno in snapshot["index"].items() if b == booking_id}
+    wanted = {t["sub_ticket_index"]: t for t in tickets}
+    data: List[Dict[str, Any]] = []
+    for sub_index, rowno in existing.items():
+        if sub_index in wanted:
+            data.append({"range": _sheet_range(SHEET_NAME_SUB_TICKETS, f"A{rowno}:F{rowno}"), "values": [_sub_ticket_row(booking_id, wanted[sub_index])]})
+        elif _get_cell(snapshot["values"][rowno - 1], 4) != SUB_TICKET_VOID:
+            row = snapshot["values"][rowno - 1]
+            voided = [booking_id, str(sub_index), _get_cell(row, 2), _get_cell(row, 3), SUB_TICKET_VOID, ""]
+            data.append({"range": _sheet_range(SHEET_NAME_SUB_TICKETS, f"A{rowno}:F{rowno}"), "values": [voided]})
+    appended = [_sub_ticket_row(booking_id, t) for sub_index, t in sorted(wanted.items()) if sub_index not in existing]
+    try:
+        if data:
+            _get_sheets_transport().values_batch_update(data, value_input_option="RAW")
+        if appended:
+            _open_sub_ticket_ws().append_rows(appended, value_input_option="RAW")
+    finally:
+        _invalidate_sub_ticket_cache()
+    log.info(f"[sub_ticket] saved {len(tickets)} sub-tickets for {booking_id} ({len(data)} rows rewritten, {len(appended)} appended)")
+
+def _find_sub_ticket_row(values: List[List[str]], hmap: Dict[str, int], booking_id: str, sub_index: int) -> Optional[int]:
+    """子票表中有此子票（未作廢）時，返回預約在主表的列號"""
+    tickets = _get_sub_ticket_snapshot()["by_booking"].get(booking_id, [])
+    if not any(t["sub_ticket_index"] == sub_index for t in tickets):
+        return None
+    return _main_typed_columns(values, hmap)["booking_row"].get(booking_id)
+
+def _ride_status_text(checked_pax: int, total_pax: int) -> str:
+    # 統一格式：上車 (已上車人數/總人數)
+    return "未上車" if checked_pax == 0 else f"上車 ({checked_pax}/{total_pax})"
+
+# ========== 母子車票管理（僅使用 Google Sheets）==========
+def _get_sub_tickets(booking_id: str) -> List[Dict[str, Any]]:
+    """
+    從子票表讀取預約的所有子票（已上車的在前，未上車的在後，然後按索引排序）
+    返回：子票列表，每個包含 sub_ticket_index, sub_ticket_pax, qr_content, status, checked_at
+    """
+    return [dict(t) for t in _get_sub_ticket_snapshot()["by_booking"].get(booking_id, [])]
+
+def _create_sub_tickets(booking_id: str, ticket_split: List[int], email: str, start_index: int = 1) -> List[Dict[str, Any]]:
+    """
     創建子票（僅存儲到 Sheet，不寫入 Firebase）
     參數：
         booking_id: 預約編號
@@ -867,12 +2443,12 @@ def _create_sub_tickets(booking_id: str, ticket_split: List[int], email: str, st
     
     return sub_tickets
 
-def _re_split_tickets(booking_id: str, ticket_split: List[int], email: str, values: List[List[str]], hmap: Dict[str, int]) -> Tuple[List[Dict[str, Any]], int, int]:
+def _re_split_tickets(booking_id: str, ticket_split: List[int], email: str) -> Tuple[List[Dict[str, Any]], int, int]:
     """
-    重新分票：保留已上車的子票，為剩餘人數創建新子票（僅使用 Sheet）
+    重新分票：保留已上車的子票，為剩餘人數創建新子票
     返回：(新子票列表, 已上車人數, 剩餘人數)
     """
-    existing_tickets = _get_sub_tickets_from_sheet(booking_id, values, hmap)
+    existing_tickets = _get_sub_tickets(booking_id)
     if not existing_tickets:
         raise ValueError("找不到現有子票，請使用首次分票功能")
     
@@ -907,136 +2483,186 @@ def _create_mother_ticket(booking_id: str, email: str) -> str:
     ticket_hash = _generate_ticket_hash(booking_id, 0, email)
     return f"FT:{booking_id}:0:{ticket_hash}"
 
-def _update_sub_ticket_status_in_cache(booking_id: str, sub_index: int, checked_in_by: str = "driver") -> bool:
+def _update_sub_ticket_status_in_cache(booking_id: str, sub_index: int, checked_in_by: str = "driver", checked_at: Optional[str] = None) -> bool:
     """
     更新子票狀態到內存快取（用於批量寫回 Sheet）
     返回：True 如果成功加入快取，False 如果已存在
     """
     global CHECKIN_CACHE, CHECKIN_CACHE_LOCK
     with CHECKIN_CACHE_LOCK:
-        if booking_id not in CHECKIN_CACHE:
-            CHECKIN_CACHE[booking_id] = {}
-        
-        # 檢查是否已核銷
-        if sub_index in CHECKIN_CACHE[booking_id]:
+        # 檢查是否已核銷（含寫回中的批次）
+        if sub_index in CHECKIN_CACHE.get(booking_id, {}) or sub_index in CHECKIN_INFLIGHT.get(booking_id, {}):
             return False  # 已經在快取中（已核銷）
         
         # 加入快取
-        CHECKIN_CACHE[booking_id][sub_index] = {
+        checked_at = checked_at or _tz_now_str()
+        CHECKIN_CACHE.setdefault(booking_id, {})[sub_index] = {
             "status": "checked_in",
-            "checked_at": _tz_now_str(),
+            "checked_at": checked_at,
             "checked_by": checked_in_by
         }
-        log.info(f"[sub_ticket] Added to cache: {booking_id}:{sub_index}")
-        return True
+    # 先進快取再寫日誌：flush 交換前後的紀錄最多在兩個日誌段各出現一次，重放時去重
+    if not CHECKIN_JOURNAL.append({"booking_id": booking_id, "sub_index": sub_index, "checked_at": checked_at, "checked_by": checked_in_by}):
+        log.warning(f"[sub_ticket] Journal write failed for {booking_id}:{sub_index}, kept in memory only")
+    log.info(f"[sub_ticket] Added to cache: {booking_id}:{sub_index}")
+    return True
+
+CHECKIN_FLUSH_METRICS_LOCK = Lock()
+CHECKIN_FLUSH_METRICS: Dict[str, Any] = {
+    "flushes": 0,
+    "failures": 0,
+    "bookings_total": 0,
+    "cells_total": 0,
+    "last_batch_bookings": 0,
+    "max_batch_bookings": 0,
+    "last_latency_ms": 0.0,
+    "max_latency_ms": 0.0,
+    "total_latency_ms": 0.0,
+}
 
+def _record_checkin_flush(bookings: int, cells: int, latency_s: float, ok: bool) -> None:
+    latency_ms = latency_s * 1000.0
+    with CHECKIN_FLUSH_METRICS_LOCK:
+        m = CHECKIN_FLUSH_METRICS
+        if not ok:
+            m["failures"] += 1
+            return
+        m["flushes"] += 1
+        m["bookings_total"] += bookings
+        m["cells_total"] += cells
+        m["last_batch_bookings"] = bookings
+        m["max_batch_bookings"] = max(m["max_batch_bookings"], bookings)
+        m["last_latency_ms"] = round(latency_ms, 1)
+        m["max_latency_ms"] = round(max(m["max_latency_ms"], latency_ms), 1)
+        m["total_latency_ms"] = round(m["total_latency_ms"] + latency_ms, 1)
+
+def _checkin_flush_metrics_snapshot() -> Dict[str, Any]:
+    with CHECKIN_FLUSH_METRICS_LOCK:
+        snap = dict(CHECKIN_FLUSH_METRICS)
+    snap["avg_latency_ms"] = round(snap["total_latency_ms"] / snap["flushes"], 1) if snap["flushes"] else 0.0
+    return snap
+
+def _patch_main_snapshot(values: List[List[str]], hmap: Dict[str, int], row_updates: Dict[int, Dict[str, str]]) -> None:
+    """寫回後直接修補快取中的主表快照（複製受影響的列成為新快照），不必重新讀取整張表"""
+    with CACHE_LOCK:
+        current = SHEET_CACHE["values"]
+        fetched_at = SHEET_CACHE["fetched_at"]
+    if current is not values:
+        # 快照已在寫回期間被替換，無法確定是否包含這次寫入
+        _invalidate_sheet_cache()
+        return
+    patched = list(values)
+    for rowno, updates in row_updates.items():
+        row = list(patched[rowno - 1])
+        for col_name, val in updates.items():
+            if col_name not in hmap:
+                continue
+            ci = hmap[col_name] - 1
+            if ci >= len(row):
+                row.extend([""] * (ci + 1 - len(row)))
+            row[ci] = val
+        patched[rowno - 1] = row
+    _patch_main_typed_columns(values, patched, hmap, list(row_updates))
+    _store_main_snapshot(patched, hmap, fetched_at)
+
+def _write_checkin_batch(batch: Dict[str, Dict[int, Dict[str, Any]]]) -> None:
+    """
+    將一批核銷寫回：子票表各子票列的狀態與核銷時間，以及主表的乘車狀態（由子票表預先彙總的人數計算）
+    子票列由 (預約編號, 子票索引) 索引定位並先讀回 A:B 確認、主表列由預約編號索引定位，兩張表合併成一次 values:batchUpdate，寫回後修補兩份快照
+    """
+    started = time.perf_counter()
+    values, hmap = _get_sheet_data_main()
+    sub_snapshot = _get_sub_ticket_snapshot()
+    sub_snapshot = _verify_sub_ticket_rows(sub_snapshot, [(booking_id, sub_index) for booking_id, sub_tickets in batch.items() for sub_index in sub_tickets])
+    booking_rows = _main_typed_columns(values, hmap)["booking_row"]
+    now_str = _tz_now_str()
+    data: List[Dict[str, Any]] = []
+    row_updates: Dict[int, Dict[str, str]] = {}
+    sub_checkins: List[Tuple[int, str]] = []
+    
+    for booking_id, sub_tickets in batch.items():
+        tickets = {t["sub_ticket_index"]: t for t in sub_snapshot["by_booking"].get(booking_id, [])}
+        # 只寫仍有效且尚未上車的子票
+        changed = [(sub_index, checkin_data) for sub_index, checkin_data in sub_tickets.items() if sub_index in tickets and tickets[sub_index]["status"] != "checked_in"]
+        if not changed:
+            continue
+        for sub_index, checkin_data in changed:
+            sub_rowno = sub_snapshot["index"][(booking_id, sub_index)]
+            checked = dict(tickets[sub_index], status="checked_in", checked_at=checkin_data["checked_at"])
+            data.append({"range": _sheet_range(SHEET_NAME_SUB_TICKETS, f"A{sub_rowno}:F{sub_rowno}"), "values": [_sub_ticket_row(booking_id, checked)]})
+            sub_checkins.append((sub_rowno, checkin_data["checked_at"]))
+        
+        rowno = booking_rows.get(booking_id)
+        if not rowno:
+            log.warning(f"[flush_checkin] Booking {booking_id} not found in sheet")
+            continue
+        checked_pax, total_pax = sub_snapshot["summary"][booking_id]
+        checked_pax += sum(tickets[sub_index]["sub_ticket_pax"] for sub_index, _ in changed)
+        updates = {"乘車狀態": _ride_status_text(checked_pax, total_pax), "最後操作時間": now_str + " 已上車(司機)"}
+        updates = {k: v for k, v in updates.items() if k in hmap}
+        row_updates[rowno] = updates
+        data.extend({"range": _sheet_range(SHEET_NAME_MAIN, gspread.utils.rowcol_to_a1(rowno, hmap[k])), "values": [[v]]} for k, v in updates.items())
+    
+    if data:
+        _get_sheets_transport().values_batch_update(data, value_input_option="RAW")
+        _patch_sub_ticket_snapshot(sub_snapshot, sub_checkins)
+        _patch_main_snapshot(values, hmap, row_updates)
+    latency = time.perf_counter() - started
+    _record_checkin_flush(len(row_updates), len(data), latency, ok=True)
+    log.info(f"[flush_checkin] {len(sub_checkins)} sub-tickets / {len(row_updates)} bookings in one batchUpdate ({latency * 1000:.0f} ms)")
+
+@sheets_priority(SHEETS_PRIORITY_CHECKIN)
 def _flush_checkin_cache() -> None:
-    """批量寫回核銷快取到 Sheet"""
-    global CHECKIN_CACHE, CHECKIN_CACHE_LOCK, _last_flush_time
-    import json
+    """
+    批量寫回核銷快取到 Sheet
+    先在鎖內把 CHECKIN_CACHE 換成空字典並封存目前的日誌段，網路寫回在鎖外進行，掃碼不必等待 Sheets；
+    寫回失敗時批次併回快取，日誌段保留到之後某次寫回成功才刪除
+    端點以新執行緒觸發時不會帶上 contextvars，優先序在這裡指定（刷新主表、讀回子票列與寫回都以核銷優先序送出）
+    """
+    global CHECKIN_CACHE, CHECKIN_INFLIGHT, _last_flush_time
     
     now = time.time()
     if now - _last_flush_time < CHECKIN_FLUSH_INTERVAL:
         return
-    
-    with CHECKIN_CACHE_LOCK:
-        if not CHECKIN_CACHE:
-            _last_flush_time = now
-            return
+    if not SHEETS_BREAKER.is_closed():
+        # 降級模式：核銷留在快取中，等斷路器關閉後再寫回
+        _probe_sheets()
+        return
+    if not CHECKIN_FLUSH_LOCK.acquire(blocking=False):
+        return
+    try:
+        with CHECKIN_CACHE_LOCK:
+            if not CHECKIN_CACHE:
+                _last_flush_time = now
+                return
+            batch = CHECKIN_CACHE
+            CHECKIN_CACHE = {}
+            CHECKIN_INFLIGHT = batch
+            sealed_segment = CHECKIN_JOURNAL.rotate()
         
         try:
-            values, hmap = _get_sheet_data_main()
-            ws = open_ws(SHEET_NAME_MAIN)
-            
-            # 按 booking_id 分組處理
-            for booking_id, sub_tickets in CHECKIN_CACHE.items():
-                # 查找對應的行
-                rowno = None
-                for i, row in enumerate(values[HEADER_ROW_MAIN:], start=HEADER_ROW_MAIN + 1):
-                    booking_id_col = hmap.get("預約編號", 0) - 1
-                    if booking_id_col >= 0 and booking_id_col < len(row):
-                        if row[booking_id_col].strip() == booking_id:
-                            rowno = i
-                            break
-                
-                if not rowno:
-                    log.warning(f"[flush_checkin] Booking {booking_id} not found in sheet")
-                    continue
-                
-                # 讀取當前的 QRCode編碼 JSON
-                qr_col = hmap.get("QRCode編碼", 0) - 1
-                if qr_col < 0:
-                    continue
-                
-                row_idx = rowno - 1
-                row = values[row_idx] if 0 <= row_idx < len(values) else []
-                qr_cell = (row[qr_col] or "").strip() if qr_col < len(row) else ""
-                
-                qr_dict = {}
-                if qr_cell:
-                    try:
-                        qr_dict = json.loads(qr_cell)
-                    except (json.JSONDecodeError, ValueError):
-                        qr_dict = {}
-                
-                # 更新子票狀態
-                updated = False
-                for sub_index, checkin_data in sub_tickets.items():
-                    sub_key = str(sub_index)
-                    if sub_key in qr_dict:
-                        if isinstance(qr_dict[sub_key], dict):
-                            qr_dict[sub_key]["status"] = "checked_in"
-                            qr_dict[sub_key]["checked_at"] = checkin_data["checked_at"]
-                            updated = True
-                
-                # 計算總狀態
-                if updated:
-                    total_pax = 0
-                    checked_pax = 0
-                    for sub_key, sub_data in qr_dict.items():
-                        if sub_key.isdigit() and isinstance(sub_data, dict):
-                            pax = sub_data.get("pax", 0)
-                            total_pax += pax
-                            if sub_data.get("status") == "checked_in":
-                                checked_pax += pax
-                    
-                    # 更新 Sheet
-                    updates = {}
-                    if total_pax > 0:
-                        if checked_pax == 0:
-                            ride_status = "未上車"
-                        else:
-                            ride_status = f"上車 ({checked_pax}/{total_pax})"
-                        updates["乘車狀態"] = ride_status
-                    
-                    qr_json_str = json.dumps(qr_dict, ensure_ascii=False)
-                    updates["QRCode編碼"] = qr_json_str
-                    
-                    if "最後操作時間" in hmap:
-                        updates["最後操作時間"] = _tz_now_str() + " 已上車(司機)"
-                    
-                    # 批量更新
-                    if updates:
-                        data = []
-                        for col_name, val in updates.items():
-                            if col_name in hmap:
-                                ci = hmap[col_name]
-                                data.append({"range": gspread.utils.rowcol_to_a1(rowno, ci), "values": [[val]]})
-                        if data:
-                            ws.batch_update(data, value_input_option="USER_ENTERED")
-                            log.info(f"[flush_checkin] Updated {booking_id} with {len(sub_tickets)} checkins")
-            
-            # 清空快取
-            CHECKIN_CACHE = {}
-            _last_flush_time = now
-            _invalidate_sheet_cache()
-            
+            _write_checkin_batch(batch)
         except Exception as e:
             log.error(f"[flush_checkin] Failed to flush cache: {e}")
+            _record_checkin_flush(0, 0, 0.0, ok=False)
+            with CHECKIN_CACHE_LOCK:
+                for booking_id, sub_tickets in batch.items():
+                    merged = CHECKIN_CACHE.setdefault(booking_id, {})
+                    for sub_index, checkin_data in sub_tickets.items():
+                        merged.setdefault(sub_index, checkin_data)
+                CHECKIN_INFLIGHT = {}
+            return
+        
+        CHECKIN_JOURNAL.discard_through(sealed_segment)
+        with CHECKIN_CACHE_LOCK:
+            CHECKIN_INFLIGHT = {}
+        _last_flush_time = now
+    finally:
+        CHECKIN_FLUSH_LOCK.release()
 
-def _checkin_all_sub_tickets(booking_id: str, values: List[List[str]], hmap: Dict[str, int], checked_in_by: str = "driver") -> int:
+def _checkin_all_sub_tickets(booking_id: str, checked_in_by: str = "driver") -> int:
     """一次性核銷所有未上車的子票，返回核銷的子票數量"""
-    sub_tickets = _get_sub_tickets_from_sheet(booking_id, values, hmap)
+    sub_tickets = _get_sub_tickets(booking_id)
     if not sub_tickets:
         return 0
     checked_count = 0
@@ -1047,43 +2673,28 @@ def _checkin_all_sub_tickets(booking_id: str, values: List[List[str]], hmap: Dic
                 checked_count += 1
     return checked_count
 
-def _calculate_mother_ticket_status(booking_id: str, values: List[List[str]], hmap: Dict[str, int]) -> Tuple[str, int, int]:
+def _calculate_mother_ticket_status(booking_id: str) -> Tuple[str, int, int]:
     """
-    計算母票總狀態（從 Sheet JSON 讀取）
+    計算母票總狀態：子票表預先彙總的人數，加上尚未寫回的核銷
     返回：(狀態文字, 已上車人數, 總人數)
     狀態：未上車 / 上車 (X/Y)
     """
-    sub_tickets = _get_sub_tickets_from_sheet(booking_id, values, hmap)
-    if not sub_tickets:
+    snapshot = _get_sub_ticket_snapshot()
+    tickets = snapshot["by_booking"].get(booking_id)
+    if not tickets:
         return "未上車", 0, 0
+    checked_pax, total_pax = snapshot["summary"][booking_id]
     
     # 檢查快取中的核銷狀態
-    global CHECKIN_CACHE, CHECKIN_CACHE_LOCK
-    with CHECKIN_CACHE_LOCK:
-        cache_data = CHECKIN_CACHE.get(booking_id, {})
-    
-    total_pax = 0
-    checked_pax = 0
-    
-    for t in sub_tickets:
-        pax = t.get("sub_ticket_pax", 0)
-        total_pax += pax
-        
-        sub_index = t.get("sub_ticket_index")
-        # 檢查快取或 Sheet 中的狀態
-        if sub_index in cache_data or t.get("status") == "checked_in":
-            checked_pax += pax
-    
-    if checked_pax == 0:
-        return "未上車", 0, total_pax
-    else:
-        # 統一格式：上車 (已上車人數/總人數)
-        return f"上車 ({checked_pax}/{total_pax})", checked_pax, total_pax
+    cache_data = _pending_checkins_for(booking_id)
+    if cache_data:
+        checked_pax += sum(t["sub_ticket_pax"] for t in tickets if t["sub_ticket_index"] in cache_data and t["status"] != "checked_in")
+    return _ride_status_text(checked_pax, total_pax), checked_pax, total_pax
 
-def _sync_mother_ticket_status_to_sheet(booking_id: str, ws_main: gspread.Worksheet, hmap: Dict[str, int], rowno: int, values: List[List[str]]):
+def _sync_mother_ticket_status_to_sheet(booking_id: str, ws_main: gspread.Worksheet, hmap: Dict[str, int], rowno: int):
     """同步母票狀態到 Sheet"""
     try:
-        status_text, checked_pax, total_pax = _calculate_mother_ticket_status(booking_id, values, hmap)
+        status_text, checked_pax, total_pax = _calculate_mother_ticket_status(booking_id)
         if "乘車狀態" in hmap:
             ws_main.update_cell(rowno, hmap["乘車狀態"], status_text)
         log.info(f"[sub_ticket] Synced status for {booking_id}: {status_text}")
@@ -1440,6 +3051,8 @@ class MailPayload(BaseModel):
 class OpsRequest(BaseModel):
     action: str
     data: Dict[str, Any]
+    # 也可用 Idempotency-Key 標頭；兩者都有時以標頭為準
+    idempotency_key: Optional[str] = None
 
 class DriverTrip(BaseModel):
     trip_id: str
@@ -1480,6 +3093,53 @@ class DriverAllData(BaseModel):
     trips: List[DriverTrip]
     trip_passengers: List[DriverPassenger]
     passenger_list: List[DriverAllPassenger]
+    version: Optional[str] = None
+
+# 司機端資料在組裝時使用的 slotted 紀錄，欄位與上方對應的 Pydantic 模型完全相同（順序也相同），
+# 直接以 _dumps 序列化，不需逐列建立 / 驗證 Pydantic 實例；Pydantic 模型只用於 API 文件
+@dataclass(slots=True)
+class DriverTripRecord:
+    trip_id: str
+    date: str
+    time: str
+    total_pax: int
+
+@dataclass(slots=True)
+class DriverPassengerRecord:
+    trip_id: str
+    station: str
+    updown: str
+    booking_id: str
+    name: str
+    phone: str
+    room: str
+    pax: int
+    status: str
+    direction: Optional[str]
+    qrcode: str
+
+@dataclass(slots=True)
+class DriverAllPassengerRecord:
+    booking_id: str
+    main_datetime: str
+    depart_time: str
+    name: str
+    phone: str
+    room: str
+    pax: int
+    ride_status: str
+    direction: str
+    hotel_go: str
+    mrt: str
+    train: str
+    mall: str
+    hotel_back: str
+
+def _dumps(obj: Any) -> bytes:
+    """與 Pydantic model_dump_json 相同的緊湊 UTF-8 JSON；有 orjson 時直接序列化 dataclass"""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"), default=asdict).encode("utf-8")
 
 class DriverCheckinRequest(BaseModel):
     qrcode: str
@@ -1497,6 +3157,22 @@ class DriverCheckinResponse(BaseModel):
     total_pax: Optional[int] = None  # 新增：總人數
     ride_status: Optional[str] = None  # 新增：完整狀態（例如 "上車 (3/5)"）
 
+class DriverCheckinScan(BaseModel):
+    qrcode: str
+    idempotency_key: str = Field(..., min_length=1, max_length=128)
+    client_ts: Optional[float] = None  # 掃碼當下的用戶端時間（epoch 毫秒）
+
+class DriverCheckinBatchRequest(BaseModel):
+    scans: List[DriverCheckinScan]
+
+class DriverCheckinScanResult(BaseModel):
+    idempotency_key: str
+    replayed: bool = False  # True：重送的掃碼，結果來自冪等快取
+    result: DriverCheckinResponse
+
+class DriverCheckinBatchResponse(BaseModel):
+    results: List[DriverCheckinScanResult]
+
 class DriverLocation(BaseModel):
     lat: float
     lng: float
@@ -1529,7 +3205,7 @@ class GoogleTripStartRequest(BaseModel):
 class GoogleTripStartResponse(BaseModel):
     trip_id: Optional[str] = None
     share_url: Optional[str] = None
-    stops: Optional[List[Dict[str, float]]] = None
+    stops: Optional[List[Dict[str, Any]]] = None
 
 class GoogleTripCompleteRequest(BaseModel):
     trip_id: str
@@ -1557,72 +3233,188 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag", "X-Data-Stale", "X-Data-As-Of", "X-Manifest-Signature"],
 )
 
+@app.middleware("http")
+async def mark_stale_responses(request: Request, call_next):
+    """降級模式期間所有回應都帶上過期標記與快照時間，前端可提示資料非即時"""
+    response = await call_next(request)
+    if DEGRADED_STATE["stale_since"] is not None:
+        snapshot_at = LAST_GOOD_MAIN["fetched_at"]
+        response.headers["X-Data-Stale"] = "true"
+        if snapshot_at is not None:
+            response.headers["X-Data-As-Of"] = snapshot_at.strftime("%Y-%m-%d %H:%M:%S")
+    return response
+
+@app.exception_handler(SheetsUnavailable)
+async def sheets_unavailable_handler(request: Request, exc: SheetsUnavailable):
+    return JSONResponse(status_code=503, content={"detail": "Google Sheets 暫時無法使用，請稍後再試"})
+
+# ========== 壓縮與條件式 GET ==========
+# 大型 JSON 回應：ETag 由快照版本（或內容雜湊）產生，If-None-Match 相符時直接 304 不序列化；
+# 超過門檻的 body 依 Accept-Encoding 以 br / gzip 壓縮，同一 ETag 的壓縮結果會被快取
+COMPRESS_MIN_BYTES = 1024
+COMPRESSED_CACHE_SIZE = 64
+COMPRESSED_CACHE: Dict[Tuple[str, str], bytes] = {}
+COMPRESSED_CACHE_LOCK = Lock()
+
+def _strong_etag(token: str) -> str:
+    return f'"{token}"'
+
+def _body_etag(body: bytes) -> str:
+    return _strong_etag(hashlib.blake2b(body, digest_size=12).hexdigest())
+
+def _etag_matches(request: Request, etag: str) -> bool:
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    base = etag.strip('"')
+    for candidate in header.split(","):
+        tag = candidate.strip()
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        tag = tag.strip('"')
+        # 壓縮後的表示法以 -br / -gzip 後綴區分，比對時視為同一版本
+        if tag == base or tag in (f"{base}-br", f"{base}-gzip"):
+            return True
+    return False
+
+def _negotiate_encoding(accept_encoding: str) -> Optional[str]:
+    accepted: Dict[str, float] = {}
+    for part in (accept_encoding or "").split(","):
+        pieces = part.strip().split(";")
+        name = pieces[0].strip().lower()
+        if not name:
+            continue
+        q = 1.0
+        for param in pieces[1:]:
+            param = param.strip()
+            if param.startswith("q="):
+                try:
+                    q = float(param[2:])
+                except ValueError:
+                    q = 0.0
+        accepted[name] = q
+    if brotli is not None and accepted.get("br", 0) > 0:
+        return "br"
+    if accepted.get("gzip", 0) > 0:
+        return "gzip"
+    return None
+
+def _compress_body(etag: str, encoding: str, body: bytes) -> bytes:
+    key = (etag, encoding)
+    with COMPRESSED_CACHE_LOCK:
+        cached = COMPRESSED_CACHE.get(key)
+    if cached is not None:
+        return cached
+    if encoding == "br":
+        compressed = brotli.compress(body, quality=5)
+    else:
+        compressed = gzip.compress(body, compresslevel=6)
+    with COMPRESSED_CACHE_LOCK:
+        COMPRESSED_CACHE[key] = compressed
+        while len(COMPRESSED_CACHE) > COMPRESSED_CACHE_SIZE:
+            COMPRESSED_CACHE.pop(next(iter(COMPRESSED_CACHE)))
+    return compressed
+
+def _json_responses(model: Any) -> Dict[Any, Dict[str, Any]]:
+    """OpenAPI 說明：端點直接返回 Response（可能壓縮或 304），schema 只作文件用途"""
+    return {
+        200: {"model": model, "description": "JSON（依 Accept-Encoding 可能以 br / gzip 壓縮）"},
+        304: {"description": "If-None-Match 相符，未變更"},
+    }
+
+def _conditional_response(request: Request, etag: str, body, media_type: str = "application/json") -> Response:
+    """body 可為 bytes 或返回 bytes 的函數；ETag 相符時不會呼叫"""
+    headers = {"ETag": etag, "Cache-Control": "no-cache", "Vary": "Accept-Encoding"}
+    if _etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+    content = body() if callable(body) else body
+    if len(content) >= COMPRESS_MIN_BYTES:
+        encoding = _negotiate_encoding(request.headers.get("accept-encoding", ""))
+        if encoding:
+            content = _compress_body(etag, encoding, content)
+            headers["Content-Encoding"] = encoding
+            headers["ETag"] = etag[:-1] + f'-{encoding}"'
+    return Response(content=content, media_type=media_type, headers=headers)
+
 @app.on_event("startup")
 async def startup_event():
     log.info("Application startup: Ensuring Firebase paths exist")
-    _init_firebase()
+    # 確認狀態目錄可跨重啟保存、重放核銷日誌後再啟動後台線程；
+    # 放在啟動事件而非 import 時，CLI（precompute_routes、bench_*）不會重放或刷新核銷
+    _ensure_persistent_state_dir()
+    _replay_checkin_journal()
+    _start_checkin_cache_flusher()
+    _load_persisted_main()
+    _load_pending_writes()
+    if _init_firebase():
+        _restore_trip_schedule()
+    # 冷啟動預熱：一次 batchGet 取得主表、可預約班次與系統設定
+    IO_EXECUTOR.submit(_refresh_sheets)
 
 # 啟動定時刷新核銷快取的後台線程
 def _start_checkin_cache_flusher():
     """啟動定時刷新核銷快取的後台線程"""
     def flush_loop():
+        _SHEETS_PRIORITY.set(SHEETS_PRIORITY_CHECKIN)
         while True:
             try:
                 time.sleep(CHECKIN_FLUSH_INTERVAL)
                 _flush_checkin_cache()
+                if PENDING_SHEET_WRITES:
+                    _replay_pending_writes()
             except Exception as e:
                 log.error(f"[flush_loop] Error: {e}")
     
     threading.Thread(target=flush_loop, daemon=True).start()
     log.info("[checkin_cache] Started background flusher thread")
 
-# 啟動後台線程
-_start_checkin_cache_flusher()
-
 @app.get("/health")
 @app.get("/api/health")
 def health():
-    return {"status": "ok", "time": _tz_now_str()}
+    sheets = _degraded_status()
+    status = "ok" if sheets["breaker"]["state"] == "closed" and not sheets["read_only"] else "degraded"
+    return {"status": status, "time": _tz_now_str(), "sheets": sheets}
 
 # ========== Booking API 端點 ==========
 @app.get("/api/sheet")
-def get_sheet_data(sheet: str = DEFAULT_SHEET, range: Optional[str] = None):
+def get_sheet_data(request: Request, sheet: str = DEFAULT_SHEET, range: Optional[str] = None):
     if range:
         range_name = f"{sheet}!{range}"
     else:
         range_name = f"{sheet}!{DEFAULT_RANGE}"
-    cached_values = _get_cached_sheet_data(sheet, range_name)
-    if cached_values is not None:
-        return cached_values
-    try:
-        creds, _ = default(scopes=["https://www.googleapis.com/auth/spreadsheets.readonly"])
-        service = build("sheets", "v4", credentials=creds)
-        result = service.spreadsheets().values().get(spreadsheetId=SPREADSHEET_ID, range=range_name).execute()
-        values = result.get("values", [])
-        _set_cached_sheet_data(sheet, range_name, values)
-        return values
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    cached = _get_cached_sheet_body(sheet, range_name)
+    if cached is None:
+        try:
+            values = _get_sheets_transport().values_get(range_name)
+            _set_cached_sheet_data(sheet, range_name, values)
+        except Exception as e:
+            raise HTTPException(status_code=503 if _is_sheets_outage(e) else 500, detail=str(e))
+        cached = _get_cached_sheet_body(sheet, range_name)
+        if cached is None:
+            body = _dumps(values)
+            cached = (body, _body_etag(body))
+    body, etag = cached
+    return _conditional_response(request, etag, body)
 
 @app.get("/api/realtime/location")
-def api_realtime_location():
+def api_realtime_location(request: Request, since: Optional[int] = Query(None, description="上次回應的 path cursor（毫秒），只返回之後的軌跡點"), path_format: str = Query("raw", pattern="^(encoded|raw)$", description="raw：原始軌跡點（current_trip_path_history）；encoded：改回傳精簡軌跡（current_trip_path）")):
     try:
         if not _init_firebase():
             raise HTTPException(status_code=500, detail="Firebase initialization failed")
         gps_system_enabled = None
         try:
-            cached_gps_enabled = _get_cached_sheet_data("系統", "系統!E19")
+            cached_gps_enabled = _get_cached_system_config()
             if cached_gps_enabled is None:
-                creds, _ = default(scopes=["https://www.googleapis.com/auth/spreadsheets.readonly"])
-                service = build("sheets", "v4", credentials=creds)
-                result = service.spreadsheets().values().get(spreadsheetId=SPREADSHEET_ID, range="系統!E19").execute()
-                values = result.get("values", [])
+                values = _get_sheets_transport().values_get(SYSTEM_CONFIG_RANGE)
                 if values and len(values) > 0 and len(values[0]) > 0:
                     e19_value = (values[0][0] or "").strip().lower()
                     gps_system_enabled = e19_value in ("true", "t", "yes", "1")
-                    _set_cached_sheet_data("系統", "系統!E19", values)
+                    _set_cached_system_config(values)
             else:
                 if cached_gps_enabled and len(cached_gps_enabled) > 0 and len(cached_gps_enabled[0]) > 0:
                     e19_value = (cached_gps_enabled[0][0] or "").strip().lower()
@@ -1634,89 +3426,75 @@ def api_realtime_location():
         if gps_system_enabled is None:
             gps_system_enabled = False
         driver_location = db.reference("/driver_location").get() or {}
-        current_trip_id = db.reference("/current_trip_id").get() or ""
-        current_trip_status = db.reference("/current_trip_status").get() or ""
-        current_trip_datetime = db.reference("/current_trip_datetime").get() or ""
-        current_trip_route = db.reference("/current_trip_route").get() or {}
-        current_trip_stations = db.reference("/current_trip_stations").get() or {}
-        current_trip_station = db.reference("/current_trip_station").get() or ""
-        current_trip_start_time = db.reference("/current_trip_start_time").get() or 0
-        current_trip_completed_stops = db.reference("/current_trip_completed_stops").get() or []
-        last_trip_datetime = db.reference("/last_trip_datetime").get() or ""
-        try:
-            if current_trip_status == "active" and current_trip_start_time:
-                now_ms = int(time.time() * 1000)
-                elapsed_ms = now_ms - int(current_trip_start_time)
-                if elapsed_ms >= AUTO_SHUTDOWN_MS:
-                    try:
-                        if current_trip_id:
-                            db.reference(f"/trip/{current_trip_id}/route").delete()
-                    except Exception:
-                        pass
-                    db.reference("/current_trip_status").set("ended")
-                    if current_trip_datetime:
-                        db.reference("/last_trip_datetime").set(current_trip_datetime)
-                    db.reference("/current_trip_id").set("")
-                    db.reference("/current_trip_route").set({})
-                    db.reference("/current_trip_datetime").set("")
-                    db.reference("/current_trip_stations").set({})
-                    current_trip_status = "ended"
-                    if current_trip_datetime:
-                        last_trip_datetime = current_trip_datetime
-            if current_trip_status == "active":
-                driver_location_updated_at = driver_location.get("updated_at") if driver_location else None
-                if driver_location_updated_at and current_trip_start_time:
-                    try:
-                        updated_dt = datetime.strptime(driver_location_updated_at, "%Y-%m-%d %H:%M:%S")
-                        now_dt = datetime.now()
-                        elapsed_seconds = (now_dt - updated_dt).total_seconds()
-                        if elapsed_seconds >= GPS_TIMEOUT_SECONDS:
-                            now_ms = int(time.time() * 1000)
-                            elapsed_ms = now_ms - int(current_trip_start_time)
-                            if elapsed_ms >= AUTO_SHUTDOWN_MS:
-                                try:
-                                    db.reference("/current_trip_path_history").set([])
-                                except Exception:
-                                    pass
-                                db.reference("/current_trip_status").set("ended")
-                                if current_trip_datetime:
-                                    db.reference("/last_trip_datetime").set(current_trip_datetime)
-                                db.reference("/current_trip_id").set("")
-                                db.reference("/current_trip_route").set({})
-                                db.reference("/current_trip_datetime").set("")
-                                db.reference("/current_trip_stations").set({})
-                                db.reference("/current_trip_path_history").set([])
-                                current_trip_status = "ended"
-                                if current_trip_datetime:
-                                    last_trip_datetime = current_trip_datetime
-                    except Exception:
-                        pass
-        except Exception:
-            pass
-        current_trip_path_history = []
-        try:
-            if current_trip_id:
-                path_history_ref = db.reference("/current_trip_path_history")
-                current_trip_path_history = path_history_ref.get() or []
-        except Exception:
-            pass
-        return {
-            "gps_system_enabled": bool(gps_system_enabled),
-            "driver_location": driver_location,
-            "current_trip_id": current_trip_id,
-            "current_trip_status": current_trip_status,
-            "current_trip_datetime": current_trip_datetime,
-            "current_trip_route": current_trip_route,
-            "current_trip_stations": current_trip_stations,
-            "current_trip_station": current_trip_station,
-            "current_trip_start_time": int(current_trip_start_time) if current_trip_start_time else 0,
-            "current_trip_completed_stops": current_trip_completed_stops,
-            "current_trip_path_history": current_trip_path_history,
-            "last_trip_datetime": last_trip_datetime
-        }
+        trip_snapshot = _read_trip_snapshot()
+        current_trip_version = trip_snapshot.get("current_trip_version") or 0
+        _check_trip_deadline(trip_snapshot)
+        # ETag 在讀取軌跡 / ETA 與序列化之前決定：行程版本涵蓋 current_trip_* 欄位，
+        # 軌跡與 ETA 只隨司機定位回報更新，以最後定位的時間戳代表
+        validator = ".".join(str(v) for v in (
+            current_trip_version, driver_location.get("timestamp", ""), driver_location.get("updated_at", ""),
+            int(bool(gps_system_enabled)), path_format, since if since is not None else "",
+        ))
+        etag = _strong_etag("rl." + hashlib.blake2b(validator.encode("utf-8"), digest_size=12).hexdigest())
+        return _conditional_response(request, etag, lambda: _dumps(_realtime_location_payload(
+            trip_snapshot, driver_location, gps_system_enabled, path_format, since,
+        )))
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+def _realtime_location_payload(trip_snapshot: Dict[str, Any], driver_location: Dict[str, Any], gps_system_enabled: Any, path_format: str, since: Optional[int]) -> Dict[str, Any]:
+    current_trip_version = trip_snapshot.get("current_trip_version") or 0
+    current_trip_id = trip_snapshot.get("current_trip_id") or ""
+    current_trip_status = trip_snapshot.get("current_trip_status") or ""
+    current_trip_datetime = trip_snapshot.get("current_trip_datetime") or ""
+    current_trip_route = trip_snapshot.get("current_trip_route") or {}
+    current_trip_stations = trip_snapshot.get("current_trip_stations") or {}
+    current_trip_station = trip_snapshot.get("current_trip_station") or ""
+    current_trip_start_time = trip_snapshot.get("current_trip_start_time") or 0
+    current_trip_completed_stops = trip_snapshot.get("current_trip_completed_stops") or []
+    last_trip_datetime = trip_snapshot.get("last_trip_datetime") or ""
+    current_trip_path_history = []
+    try:
+        if current_trip_id:
+            path_history_ref = db.reference("/current_trip_path_history")
+            current_trip_path_history = path_history_ref.get() or []
+    except Exception:
+        pass
+    current_trip_eta = {}
+    try:
+        if current_trip_status == "active" and current_trip_id:
+            current_trip_eta = _get_active_trip_eta(current_trip_id)
+            if current_trip_eta is None:
+                current_trip_eta = db.reference("/current_trip_eta").get() or {}
+    except Exception:
+        current_trip_eta = {}
+    # 預設維持原始軌跡點；path_format=encoded 時改回傳精簡軌跡（polyline + 差分時間戳），不附原始點
+    current_trip_path = None
+    if path_format == "encoded":
+        current_trip_path = _encode_path_history(current_trip_path_history, since=since)
+        current_trip_path_history = []
+    payload = {
+        "gps_system_enabled": bool(gps_system_enabled),
+        "driver_location": driver_location,
+        "current_trip_id": current_trip_id,
+        "current_trip_status": current_trip_status,
+        "current_trip_datetime": current_trip_datetime,
+        "current_trip_route": current_trip_route,
+        "current_trip_stations": current_trip_stations,
+        "current_trip_station": current_trip_station,
+        "current_trip_start_time": int(current_trip_start_time) if current_trip_start_time else 0,
+        "current_trip_completed_stops": current_trip_completed_stops,
+        "current_trip_path_history": current_trip_path_history,
+        "current_trip_eta": current_trip_eta,
+        "current_trip_version": current_trip_version,
+        "last_trip_datetime": last_trip_datetime
+    }
+    if current_trip_path is not None:
+        payload["current_trip_path"] = current_trip_path
+    return payload
+
 # ========== Booking Processor ==========
 class BookingProcessor:
     def __init__(self):
@@ -1770,11 +3548,54 @@ booking_processor = BookingProcessor()
 def ops_options():
     return Response(status_code=204)
 
+# book / modify / delete（取消）的冪等快取：(action, Idempotency-Key) → (內容指紋, 第一次成功的回應)
+# 只快取成功的結果；失敗（容量不足、系統忙碌等）的請求重送時照常重新處理
+OPS_IDEMPOTENT_ACTIONS = ("book", "modify", "delete")
+OPS_IDEMPOTENCY_TTL_SECONDS = 24 * 3600
+OPS_IDEMPOTENCY = TTLResultCache(OPS_IDEMPOTENCY_TTL_SECONDS, max_entries=5000)
+OPS_IDEMPOTENCY_INFLIGHT: Dict[str, threading.Event] = {}
+OPS_IDEMPOTENCY_LOCK = Lock()
+
+def _ops_idempotent(key: str, data: Dict[str, Any], run) -> Any:
+    """
+    同一個 key 重送時直接回覆第一次成功的結果，不再取容量鎖、寫 Sheet 或 RTDB；
+    第一次仍在處理中（例如等候容量鎖）時，重送等它完成後再回覆同一結果
+    """
+    fingerprint = hashlib.sha256(json.dumps(data, sort_keys=True, ensure_ascii=False, default=str).encode("utf-8")).hexdigest()
+    while True:
+        with OPS_IDEMPOTENCY_LOCK:
+            cached = OPS_IDEMPOTENCY.get(key)
+            inflight = OPS_IDEMPOTENCY_INFLIGHT.get(key) if cached is None else None
+            if cached is None and inflight is None:
+                OPS_IDEMPOTENCY_INFLIGHT[key] = threading.Event()
+                break
+        if cached is not None:
+            if cached[0] != fingerprint:
+                raise HTTPException(422, "idempotency_key_reused")
+            log.info(f"[ops] idempotent replay {key}")
+            return cached[1]
+        if not inflight.wait(LOCK_WAIT_SECONDS + TRIP_IO_TIMEOUT_SECONDS):
+            raise HTTPException(409, "request_in_progress")
+        # 第一次已結束：成功則下一輪取得快取結果，失敗則由這次重新處理
+    try:
+        result = run()
+        OPS_IDEMPOTENCY.put(key, (fingerprint, result))
+        return result
+    finally:
+        with OPS_IDEMPOTENCY_LOCK:
+            OPS_IDEMPOTENCY_INFLIGHT.pop(key).set()
+
 @app.post("/api/ops")
 @app.post("/api/ops/")
-def ops(req: OpsRequest):
+def ops(req: OpsRequest, idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")):
     action = (req.action or "").strip().lower()
     data = req.data or {}
+    key = (idempotency_key or req.idempotency_key or "").strip()
+    if key and action in OPS_IDEMPOTENT_ACTIONS:
+        return _ops_idempotent(f"{action}:{key}", data, lambda: _ops(action, data))
+    return _ops(action, data)
+
+def _ops(action: str, data: Dict[str, Any]):
     log.info(f"OPS action={action} payload={data}")
     try:
         if action == "query":
@@ -1788,31 +3609,12 @@ def ops(req: OpsRequest):
                 return row[hmap[key] - 1] if key in hmap and len(row) >= hmap[key] else ""
             now = _tz_now()
             one_month_ago = now - timedelta(days=31)
+            car_date_col = _main_typed_columns(all_values, hmap)["car_date"]
             results: List[Dict[str, Any]] = []
-            for row in all_values[HEADER_ROW_MAIN:]:
-                car_dt_str = get(row, "車次-日期時間")
-                date_iso: str = ""
-                time_hm: str = ""
-                if car_dt_str:
-                    try:
-                        parts = car_dt_str.strip().split()
-                        if parts:
-                            date_iso = parts[0].replace("/", "-")
-                            if len(parts) > 1:
-                                time_hm = _time_hm_from_any(parts[1])
-                        else:
-                            date_iso = ""
-                    except Exception:
-                        date_iso = get(row, "日期")
-                        time_hm = _time_hm_from_any(get(row, "班次"))
-                else:
-                    date_iso = get(row, "日期")
-                    time_hm = _time_hm_from_any(get(row, "班次"))
-                try:
-                    d = datetime.strptime(date_iso, "%Y-%m-%d")
-                except Exception:
-                    d = now
-                if d < one_month_ago:
+            for i in range(HEADER_ROW_MAIN, len(all_values)):
+                row = all_values[i]
+                date_iso, time_hm, d = car_date_col[i]
+                if d is not None and d < one_month_ago:
                     continue
                 if p.booking_id and p.booking_id != get(row, "預約編號"):
                     continue
@@ -1836,7 +3638,7 @@ def ops(req: OpsRequest):
                 booking_id = rec.get("預約編號", "")
                 if booking_id:
                     try:
-                        sub_tickets = _get_sub_tickets_from_sheet(booking_id, all_values, hmap)
+                        sub_tickets = _get_sub_tickets(booking_id)
                         if sub_tickets:
                             # 生成子票編號後綴（A, B, C...）
                             def get_suffix(index: int) -> str:
@@ -1854,7 +3656,7 @@ def ops(req: OpsRequest):
                                 for t in sub_tickets
                             ]
                             # 更新乘車狀態（如果存在子票）
-                            status_text, _, _ = _calculate_mother_ticket_status(booking_id, all_values, hmap)
+                            status_text, _, _ = _calculate_mother_ticket_status(booking_id)
                             if status_text and status_text != "未上車":
                                 rec["乘車狀態"] = status_text
                     except Exception as e:
@@ -2188,14 +3990,14 @@ def ops(req: OpsRequest):
                     
                     # 母票上車（一次性核銷所有人）
                     elif ticket_type == "mother":
-                        checked_count = _checkin_all_sub_tickets(booking_id_from_qr, values, hmap, "check_in_api")
+                        checked_count = _checkin_all_sub_tickets(booking_id_from_qr, "check_in_api")
                         log.info(f"[sub_ticket] Checked in all sub-tickets for {booking_id_from_qr}, count={checked_count}")
                         # 觸發異步刷新快取
                         if checked_count > 0:
                             threading.Thread(target=_flush_checkin_cache, daemon=True).start()
                     
                     # 同步狀態到 Sheet
-                    _sync_mother_ticket_status_to_sheet(booking_id_from_qr, ws_main, hmap, rowno, values)
+                    _sync_mother_ticket_status_to_sheet(booking_id_from_qr, ws_main, hmap, rowno)
                     
                     # 更新最後操作時間
                     if "最後操作時間" in hmap:
@@ -2240,7 +4042,7 @@ def ops(req: OpsRequest):
                 raise HTTPException(400, "此訂單缺少信箱信息，無法分票")
             
             # 檢查是否已經分票
-            existing_sub_tickets = _get_sub_tickets_from_sheet(p.booking_id, values, hmap)
+            existing_sub_tickets = _get_sub_tickets(p.booking_id)
             is_re_split = len(existing_sub_tickets) > 0
             
             try:
@@ -2258,93 +4060,28 @@ def ops(req: OpsRequest):
                         raise HTTPException(400, f"新分票總和 ({sum(p.ticket_split)}) 必須等於剩餘人數 ({remaining_pax})")
                     
                     # 重新分票：保留已上車的子票，為剩餘人數創建新子票
-                    new_sub_tickets, _, _ = _re_split_tickets(p.booking_id, p.ticket_split, email, values, hmap)
+                    new_sub_tickets, _, _ = _re_split_tickets(p.booking_id, p.ticket_split, email)
                     log.info(f"[split_ticket] Re-split booking {p.booking_id}: {checked_in_pax} checked in, {remaining_pax} remaining")
-                    
-                    # 更新 QRCode編碼（JSON 格式，包含所有子票）
-                    # 保留已上車的子票，添加新子票
-                    import json
-                    qr_dict = {}
-                    
-                    # 先添加已上車的子票
-                    for t in checked_in_tickets:
-                        sub_index = t.get("sub_ticket_index")
-                        qr_content = t.get("qr_content", "")
-                        status = t.get("status", "not_checked_in")
-                        pax = t.get("sub_ticket_pax", 0)
-                        checked_at = t.get("checked_at")
-                        
-                        if sub_index and qr_content:
-                            qr_dict[str(sub_index)] = {
-                                "qr": qr_content,
-                                "status": status,
-                                "pax": pax,
-                                "checked_at": checked_at
-                            }
-                    
-                    # 再添加新子票
-                    for t in new_sub_tickets:
-                        sub_index = t.get("sub_index")
-                        qr_content = t.get("qr_content", "")
-                        if sub_index and qr_content:
-                            qr_dict[str(sub_index)] = {
-                                "qr": qr_content,
-                                "status": "not_checked_in",
-                                "pax": t.get("pax", 0),
-                                "checked_at": None
-                            }
-                    
-                    all_sub_tickets_after = checked_in_tickets + [{"sub_ticket_index": t.get("sub_index"), "sub_ticket_pax": t.get("pax", 0), "qr_content": t.get("qr_content", ""), "status": "not_checked_in"} for t in new_sub_tickets]
-                    if "QRCode編碼" in hmap and all_sub_tickets_after:
-                        import json
-                        qr_dict = {}
-                        for t in all_sub_tickets_after:
-                            sub_index = t.get("sub_ticket_index")
-                            qr_content = t.get("qr_content", "")
-                            status = t.get("status", "not_checked_in")
-                            pax = t.get("sub_ticket_pax", 0)
-                            checked_at = t.get("checked_in_at")
-                            
-                            if sub_index and qr_content:
-                                qr_dict[str(sub_index)] = {
-                                    "qr": qr_content,
-                                    "status": status,
-                                    "pax": pax,
-                                    "checked_at": checked_at
-                                }
-                        
-                        if qr_dict:
-                            qr_json_str = json.dumps(qr_dict, ensure_ascii=False)
-                            ws_main.update_cell(rowno, hmap["QRCode編碼"], qr_json_str)
                 else:
                     # 首次分票：只創建子票，不創建母票
                     if sum(p.ticket_split) != total_pax:
                         raise HTTPException(400, f"分票總和 ({sum(p.ticket_split)}) 必須等於總人數 ({total_pax})")
                     
-                    sub_tickets = _create_sub_tickets(p.booking_id, p.ticket_split, email)
-                    
-                    # 更新 Sheet 的 QRCode編碼（JSON 格式）
-                    if "QRCode編碼" in hmap and sub_tickets:
-                        import json
-                        qr_dict = {}
-                        
-                        for t in sub_tickets:
-                            sub_index = t.get("sub_index")
-                            qr_content = t.get("qr_content", "")
-                            if sub_index and qr_content:
-                                qr_dict[str(sub_index)] = {
-                                    "qr": qr_content,
-                                    "status": "not_checked_in",
-                                    "pax": t.get("pax", 0),
-                                    "checked_at": None
-                                }
-                        
-                        if qr_dict:
-                            qr_json_str = json.dumps(qr_dict, ensure_ascii=False)
-                            ws_main.update_cell(rowno, hmap["QRCode編碼"], qr_json_str)
-                    
-                    log.info(f"[split_ticket] First split booking {p.booking_id} into {len(sub_tickets)} sub-tickets (no mother ticket)")
-                    new_sub_tickets = sub_tickets
+                    checked_in_tickets = []
+                    new_sub_tickets = _create_sub_tickets(p.booking_id, p.ticket_split, email)
+                    log.info(f"[split_ticket] First split booking {p.booking_id} into {len(new_sub_tickets)} sub-tickets (no mother ticket)")
+                
+                # 子票寫入子票表（已上車的子票保留原列）
+                all_sub_tickets_after = checked_in_tickets + [
+                    {"sub_ticket_index": t["sub_index"], "sub_ticket_pax": t["pax"], "qr_content": t["qr_content"], "status": "not_checked_in", "checked_at": None}
+                    for t in new_sub_tickets
+                ]
+                _save_sub_tickets(p.booking_id, all_sub_tickets_after)
+                
+                # 主表 QRCode編碼 只記錄子票結構（狀態以子票表為準），同時使原本整張票的 QR 失效
+                if "QRCode編碼" in hmap:
+                    qr_dict = {str(t["sub_ticket_index"]): {"qr": t["qr_content"], "pax": t["sub_ticket_pax"]} for t in all_sub_tickets_after}
+                    ws_main.update_cell(rowno, hmap["QRCode編碼"], json.dumps(qr_dict, ensure_ascii=False))
                 
                 _invalidate_sheet_cache()
                 
@@ -2356,7 +4093,7 @@ def ops(req: OpsRequest):
                 # 重新分票後，已核銷的票保持不變，新票從下一個索引開始
                 
                 # 返回所有子票信息（包括已上車的舊子票和新子票）
-                all_sub_tickets = _get_sub_tickets_from_sheet(p.booking_id, values, hmap)
+                all_sub_tickets = _get_sub_tickets(p.booking_id)
                 
                 # 分票後不返回母票，只返回子票
                 return {
@@ -2415,6 +4152,12 @@ def ops(req: OpsRequest):
     except HTTPException:
         raise
     except Exception as e:
+        if _is_sheets_quota_error(e):
+            log.warning(f"[ops] sheets quota exhausted: {e}")
+            raise HTTPException(503, "系統忙碌中，請稍後再試")
+        if _is_sheets_outage(e):
+            log.warning(f"[ops] sheets unavailable: {e}")
+            raise HTTPException(503, "Google Sheets 暫時無法使用，請稍後再試")
         log.exception("server error")
         raise HTTPException(500, f"伺服器錯誤: {str(e)}")
 
@@ -2437,8 +4180,14 @@ def cors_debug():
 def debug_endpoint():
     return {"status": "服務正常", "base_url": BASE_URL, "time": _tz_now_str()}
 
+@app.get("/api/metrics/sheets")
+def sheets_metrics():
+    snap = _sheets_metrics_snapshot()
+    snap["checkin_flush"] = _checkin_flush_metrics_snapshot()
+    return snap
+
 # ========== 司機數據處理函數 ==========
-def build_all_driver_data_optimized(values: List[List[str]], hmap: Dict[str, int]) -> Tuple[List[DriverTrip], List[DriverPassenger], List[DriverAllPassenger]]:
+def build_all_driver_data_optimized(values: List[List[str]], hmap: Dict[str, int]) -> Tuple[List[DriverTripRecord], List[DriverPassengerRecord], List[DriverAllPassengerRecord]]:
     idx_main_dt = _col_index(hmap, "主班次時間")
     if idx_main_dt < 0:
         return [], [], []
@@ -2468,12 +4217,13 @@ def build_all_driver_data_optimized(values: List[List[str]], hmap: Dict[str, int
     SORT_BACK_MAP = {mrt: 1, train: 2, mall: 3}
     DROPOFF_GO_MAP = {mrt: 1, train: 2, mall: 3}
     DROPOFF_BACK_MAP = {mall: 1, train: 2, mrt: 3}
-    now = _tz_now()
-    cutoff = now - timedelta(hours=1)
-    trips_by_dt: Dict[str, DriverTrip] = {}
-    trip_passengers_list: List[DriverPassenger] = []
+    main_dt_col = _main_typed_columns(values, hmap)["main_dt"]
+    cutoff_min = _cutoff_epoch_minutes(_tz_now() - timedelta(hours=1))
+    trips_by_dt: Dict[str, DriverTripRecord] = {}
+    trip_passengers_list: List[DriverPassengerRecord] = []
     all_passengers_base: List[Dict[str, Any]] = []
-    for row in values[HEADER_ROW_MAIN:]:
+    for i in range(HEADER_ROW_MAIN, len(values)):
+        row = values[i]
         if not any(row):
             continue
         if idx_main_dt >= len(row):
@@ -2485,16 +4235,15 @@ def build_all_driver_data_optimized(values: List[List[str]], hmap: Dict[str, int
             st = _get_cell(row, idx_status_check)
             if "❌" in st or st == CANCELLED_TEXT:
                 continue
-        dt = _parse_main_dt(main_raw)
-        if not dt:
+        parsed = main_dt_col[i]
+        if parsed is None or parsed.epoch_min < cutoff_min:
             continue
-        if dt < cutoff:
-            continue
-        normalized_trip_id = _normalize_main_dt_format(main_raw)
-        date_str = dt.strftime("%Y-%m-%d")
-        time_str = dt.strftime("%H:%M")
+        dt = parsed.dt
+        normalized_trip_id = parsed.trip_id
+        date_str = parsed.date_str
+        time_str = parsed.time_str
         if normalized_trip_id not in trips_by_dt:
-            trips_by_dt[normalized_trip_id] = DriverTrip(trip_id=normalized_trip_id, date=date_str, time=time_str, total_pax=0)
+            trips_by_dt[normalized_trip_id] = DriverTripRecord(trip_id=normalized_trip_id, date=date_str, time=time_str, total_pax=0)
         if idx_pax >= 0 and idx_pax < len(row):
             trips_by_dt[normalized_trip_id].total_pax += _safe_int(row[idx_pax], 0)
         booking_id = _get_cell(row, idx_booking)
@@ -2510,9 +4259,9 @@ def build_all_driver_data_optimized(values: List[List[str]], hmap: Dict[str, int
         if idx_pax >= 0 and idx_pax < len(row):
             pax = _safe_int(row[idx_pax], 1)
         if pick:
-            trip_passengers_list.append(DriverPassenger(trip_id=normalized_trip_id, station=pick, updown="上車", booking_id=booking_id, name=name, phone=phone, room=room, pax=pax, status=ride_status, direction=direction, qrcode=qrcode))
+            trip_passengers_list.append(DriverPassengerRecord(trip_id=normalized_trip_id, station=pick, updown="上車", booking_id=booking_id, name=name, phone=phone, room=room, pax=pax, status=ride_status, direction=direction, qrcode=qrcode))
         if drop:
-            trip_passengers_list.append(DriverPassenger(trip_id=normalized_trip_id, station=drop, updown="下車", booking_id=booking_id, name=name, phone=phone, room=room, pax=pax, status=ride_status, direction=direction, qrcode=qrcode))
+            trip_passengers_list.append(DriverPassengerRecord(trip_id=normalized_trip_id, station=drop, updown="下車", booking_id=booking_id, name=name, phone=phone, room=room, pax=pax, status=ride_status, direction=direction, qrcode=qrcode))
         rid = _get_cell(row, idx_rid)
         car_raw = _get_cell(row, idx_car_raw)
         phone_raw = _get_cell(row, idx_phone)
@@ -2552,9 +4301,9 @@ def build_all_driver_data_optimized(values: List[List[str]], hmap: Dict[str, int
             dropoff_order = DROPOFF_BACK_MAP.get(up, 4)
         else:
             dropoff_order = 99
-        all_passengers_base.append(dict(car_raw=car_raw, main_dt_raw=main_raw, main_dt=dt, booking_id=rid, ride_status=ride_status_all, direction=direction, station_sort=station_sort, dropoff_order=dropoff_order, name=name, phone=phone_text, room=room_text, qty=qty, hotel_go=hotel_go, mrt=mrt_col, train=train_col, mall=mall_col, hotel_back=hotel_back))
+        all_passengers_base.append(dict(car_raw=car_raw, main_dt_raw=main_raw, main_dt=dt, trip_id=normalized_trip_id, depart_time=time_str, booking_id=rid, ride_status=ride_status_all, direction=direction, station_sort=station_sort, dropoff_order=dropoff_order, name=name, phone=phone_text, room=room_text, qty=qty, hotel_go=hotel_go, mrt=mrt_col, train=train_col, mall=mall_col, hotel_back=hotel_back))
     trips = sorted(trips_by_dt.values(), key=lambda t: (t.date, t.time))
-    def sort_key_passenger(p: DriverPassenger):
+    def sort_key_passenger(p: DriverPassengerRecord):
         return (p.station, 0 if p.updown == "上車" else 1, p.booking_id)
     trip_passengers = sorted(trip_passengers_list, key=sort_key_passenger)
     def sort_key_all(row: Dict[str, Any]):
@@ -2562,26 +4311,34 @@ def build_all_driver_data_optimized(values: List[List[str]], hmap: Dict[str, int
         dir_rank = 0 if dir_val == "去程" else 1
         return (row["main_dt"], dir_rank, row["station_sort"], row["dropoff_order"])
     all_passengers_base.sort(key=sort_key_all)
-    result_all: List[DriverAllPassenger] = []
+    result_all: List[DriverAllPassengerRecord] = []
     for row in all_passengers_base:
-        dt = row["main_dt"]
-        depart_time = dt.strftime("%H:%M") if dt else ""
-        normalized_main_dt = _normalize_main_dt_format(row["main_dt_raw"])
-        result_all.append(DriverAllPassenger(booking_id=row["booking_id"], main_datetime=normalized_main_dt, depart_time=depart_time, name=row["name"], phone=row["phone"], room=row["room"], pax=row["qty"], ride_status=row["ride_status"], direction=row["direction"], hotel_go=row["hotel_go"], mrt=row["mrt"], train=row["train"], mall=row["mall"], hotel_back=row["hotel_back"]))
+        result_all.append(DriverAllPassengerRecord(booking_id=row["booking_id"], main_datetime=row["trip_id"], depart_time=row["depart_time"], name=row["name"], phone=row["phone"], room=row["room"], pax=row["qty"], ride_status=row["ride_status"], direction=row["direction"], hotel_go=row["hotel_go"], mrt=row["mrt"], train=row["train"], mall=row["mall"], hotel_back=row["hotel_back"]))
     return trips, trip_passengers, result_all
 
-def build_driver_trips(values: List[List[str]], hmap: Dict[str, int]) -> List[DriverTrip]:
+def _group_driver_trip_passengers(values: List[List[str]], hmap: Dict[str, int]) -> Dict[str, List[DriverPassengerRecord]]:
+    """依主班次時間原始字串分組的上下車名單，各組已排序。
+    與舊版單班次查詢相同：不套用一小時截止線、不排除無法解析的主班次時間，
+    司機仍可查詢剛發車或格式特殊的班次名單"""
     idx_main_dt = _col_index(hmap, "主班次時間")
     if idx_main_dt < 0:
-        return []
+        return {}
+    idx_booking = _col_index(hmap, "預約編號")
+    idx_name = _col_index(hmap, "姓名")
+    idx_phone = _col_index(hmap, "手機")
+    idx_room = _col_index(hmap, "房號")
     pax_col = hmap.get("確認人數", hmap.get("預約人數", 0))
     idx_pax = pax_col - 1 if pax_col else -1
-    status_col = hmap.get("確認狀態")
-    idx_status = status_col - 1 if status_col else -1
-    now = _tz_now()
-    cutoff = now - timedelta(hours=1)
-    trips_by_dt: Dict[str, DriverTrip] = {}
-    for row in values[HEADER_ROW_MAIN:]:
+    idx_pick = _col_index(hmap, "上車地點")
+    idx_drop = _col_index(hmap, "下車地點")
+    idx_status = _col_index(hmap, "乘車狀態")
+    idx_dir = _col_index(hmap, "往返")
+    idx_qr = _col_index(hmap, "QRCode編碼")
+    idx_confirm_status = _col_index(hmap, "確認狀態")
+    main_dt_col = _main_typed_columns(values, hmap)["main_dt"]
+    groups: Dict[str, List[DriverPassengerRecord]] = {}
+    for i in range(HEADER_ROW_MAIN, len(values)):
+        row = values[i]
         if not any(row):
             continue
         if idx_main_dt >= len(row):
@@ -2589,56 +4346,10 @@ def build_driver_trips(values: List[List[str]], hmap: Dict[str, int]) -> List[Dr
         main_raw = _get_cell(row, idx_main_dt)
         if not main_raw:
             continue
-        if idx_status >= 0 and idx_status < len(row):
-            st = _get_cell(row, idx_status)
-            if "❌" in st or st == CANCELLED_TEXT:
+        if idx_confirm_status >= 0 and idx_confirm_status < len(row):
+            confirm_status = _get_cell(row, idx_confirm_status)
+            if "❌" in confirm_status or confirm_status == CANCELLED_TEXT:
                 continue
-        dt = _parse_main_dt(main_raw)
-        if not dt:
-            continue
-        if dt < cutoff:
-            continue
-        date_str = dt.strftime("%Y-%m-%d")
-        time_str = dt.strftime("%H:%M")
-        normalized_trip_id = _normalize_main_dt_format(main_raw)
-        if normalized_trip_id not in trips_by_dt:
-            trips_by_dt[normalized_trip_id] = DriverTrip(trip_id=normalized_trip_id, date=date_str, time=time_str, total_pax=0)
-        if idx_pax >= 0 and idx_pax < len(row):
-            normalized_trip_id = _normalize_main_dt_format(main_raw)
-            trips_by_dt[normalized_trip_id].total_pax += _safe_int(row[idx_pax], 0)
-    return sorted(trips_by_dt.values(), key=lambda t: (t.date, t.time))
-
-def build_driver_trip_passengers(values: List[List[str]], hmap: Dict[str, int], trip_id: Optional[str] = None) -> List[DriverPassenger]:
-    idx_main_dt = _col_index(hmap, "主班次時間")
-    if idx_main_dt < 0:
-        return []
-    idx_booking = _col_index(hmap, "預約編號")
-    idx_name = _col_index(hmap, "姓名")
-    idx_phone = _col_index(hmap, "手機")
-    idx_room = _col_index(hmap, "房號")
-    pax_col = hmap.get("確認人數", hmap.get("預約人數", 0))
-    idx_pax = pax_col - 1 if pax_col else -1
-    idx_pick = _col_index(hmap, "上車地點")
-    idx_drop = _col_index(hmap, "下車地點")
-    idx_status = _col_index(hmap, "乘車狀態")
-    idx_dir = _col_index(hmap, "往返")
-    idx_qr = _col_index(hmap, "QRCode編碼")
-    idx_confirm_status = _col_index(hmap, "確認狀態")
-    result: List[DriverPassenger] = []
-    for row in values[HEADER_ROW_MAIN:]:
-        if not any(row):
-            continue
-        if idx_main_dt >= len(row):
-            continue
-        main_raw = _get_cell(row, idx_main_dt)
-        if not main_raw:
-            continue
-        if idx_confirm_status >= 0 and idx_confirm_status < len(row):
-            confirm_status = _get_cell(row, idx_confirm_status)
-            if "❌" in confirm_status or confirm_status == CANCELLED_TEXT:
-                continue
-        if trip_id is not None and main_raw != trip_id:
-            continue
         booking_id = _get_cell(row, idx_booking)
         name = _get_cell(row, idx_name)
         phone = _get_cell(row, idx_phone)
@@ -2651,16 +4362,21 @@ def build_driver_trip_passengers(values: List[List[str]], hmap: Dict[str, int],
             pax = _safe_int(row[idx_pax], 1)
         pick = _get_cell(row, idx_pick)
         drop = _get_cell(row, idx_drop)
-        normalized_trip_id = _normalize_main_dt_format(main_raw)
+        parsed = main_dt_col[i]
+        normalized_trip_id = parsed.trip_id if parsed is not None else _normalize_main_dt_format(main_raw)
+        result = groups.setdefault(main_raw, [])
         if pick:
-            result.append(DriverPassenger(trip_id=normalized_trip_id, station=pick, updown="上車", booking_id=booking_id, name=name, phone=phone, room=room, pax=pax, status=ride_status, direction=direction, qrcode=qrcode))
+            result.append(DriverPassengerRecord(trip_id=normalized_trip_id, station=pick, updown="上車", booking_id=booking_id, name=name, phone=phone, room=room, pax=pax, status=ride_status, direction=direction, qrcode=qrcode))
         if drop:
-            result.append(DriverPassenger(trip_id=normalized_trip_id, station=drop, updown="下車", booking_id=booking_id, name=name, phone=phone, room=room, pax=pax, status=ride_status, direction=direction, qrcode=qrcode))
-    def sort_key(p: DriverPassenger):
-        return (p.station, 0 if p.updown == "上車" else 1, p.booking_id)
-    return sorted(result, key=sort_key)
+            result.append(DriverPassengerRecord(trip_id=normalized_trip_id, station=drop, updown="下車", booking_id=booking_id, name=name, phone=phone, room=room, pax=pax, status=ride_status, direction=direction, qrcode=qrcode))
+    for result in groups.values():
+        result.sort(key=_driver_passenger_sort_key)
+    return groups
 
-def build_driver_all_passengers(values: List[List[str]], hmap: Dict[str, int]) -> List[DriverAllPassenger]:
+def _driver_passenger_sort_key(p: DriverPassengerRecord):
+    return (p.station, 0 if p.updown == "上車" else 1, p.booking_id)
+
+def build_driver_all_passengers(values: List[List[str]], hmap: Dict[str, int]) -> List[DriverAllPassengerRecord]:
     def col_idx(name: str) -> int:
         return _col_index(hmap, name)
     idx_rid = col_idx("預約編號")
@@ -2682,14 +4398,15 @@ def build_driver_all_passengers(values: List[List[str]], hmap: Dict[str, int]) -
     mrt = STATION_NAMES["mrt"]
     train = STATION_NAMES["train"]
     mall = STATION_NAMES["mall"]
-    now = _tz_now()
-    cutoff = now - timedelta(hours=1)
+    main_dt_col = _main_typed_columns(values, hmap)["main_dt"]
+    cutoff_min = _cutoff_epoch_minutes(_tz_now() - timedelta(hours=1))
     SORT_GO_MAP = {hotel: 1, mrt: 2, train: 3, mall: 4}
     SORT_BACK_MAP = {mrt: 1, train: 2, mall: 3}
     DROPOFF_GO_MAP = {mrt: 1, train: 2, mall: 3}
     DROPOFF_BACK_MAP = {mall: 1, train: 2, mrt: 3}
     base_rows: List[Dict[str, Any]] = []
-    for row in values[HEADER_ROW_MAIN:]:
+    for i in range(HEADER_ROW_MAIN, len(values)):
+        row = values[i]
         if not any(row):
             continue
         if idx_main_dt >= len(row):
@@ -2697,10 +4414,8 @@ def build_driver_all_passengers(values: List[List[str]], hmap: Dict[str, int]) -
         main_raw = _get_cell(row, idx_main_dt)
         if not main_raw:
             continue
-        dt = _parse_main_dt(main_raw)
-        if not dt:
-            continue
-        if dt < cutoff:
+        parsed = main_dt_col[i]
+        if parsed is None or parsed.epoch_min < cutoff_min:
             continue
         status_val = _get_cell(row, idx_status)
         if "❌" in status_val:
@@ -2746,174 +4461,1146 @@ def build_driver_all_passengers(values: List[List[str]], hmap: Dict[str, int]) -
             dropoff_order = DROPOFF_BACK_MAP.get(up, 4)
         else:
             dropoff_order = 99
-        base_rows.append(dict(car_raw=car_raw, main_dt_raw=main_raw, main_dt=dt, booking_id=rid, ride_status=ride_status, direction=direction, station_sort=station_sort, dropoff_order=dropoff_order, name=name, phone=phone_text, room=room_text, qty=qty, hotel_go=hotel_go, mrt=mrt_col, train=train_col, mall=mall_col, hotel_back=hotel_back))
+        base_rows.append(dict(car_raw=car_raw, main_dt_raw=main_raw, main_dt=parsed.dt, trip_id=parsed.trip_id, depart_time=parsed.time_str, booking_id=rid, ride_status=ride_status, direction=direction, station_sort=station_sort, dropoff_order=dropoff_order, name=name, phone=phone_text, room=room_text, qty=qty, hotel_go=hotel_go, mrt=mrt_col, train=train_col, mall=mall_col, hotel_back=hotel_back))
     def sort_key(row: Dict[str, Any]):
         dir_val = row["direction"] or ""
         dir_rank = 0 if dir_val == "去程" else 1
         return (row["main_dt"], dir_rank, row["station_sort"], row["dropoff_order"])
     base_rows.sort(key=sort_key)
-    result: List[DriverAllPassenger] = []
+    result: List[DriverAllPassengerRecord] = []
     for row in base_rows:
-        dt = row["main_dt"]
-        depart_time = dt.strftime("%H:%M") if dt else ""
-        normalized_main_dt = _normalize_main_dt_format(row["main_dt_raw"])
-        result.append(DriverAllPassenger(booking_id=row["booking_id"], main_datetime=normalized_main_dt, depart_time=depart_time, name=row["name"], phone=row["phone"], room=row["room"], pax=row["qty"], ride_status=row["ride_status"], direction=row["direction"], hotel_go=row["hotel_go"], mrt=row["mrt"], train=row["train"], mall=row["mall"], hotel_back=row["hotel_back"]))
+        result.append(DriverAllPassengerRecord(booking_id=row["booking_id"], main_datetime=row["trip_id"], depart_time=row["depart_time"], name=row["name"], phone=row["phone"], room=row["room"], pax=row["qty"], ride_status=row["ride_status"], direction=row["direction"], hotel_go=row["hotel_go"], mrt=row["mrt"], train=row["train"], mall=row["mall"], hotel_back=row["hotel_back"]))
     return result
 
-# ========== 站點到達檢測 ==========
-def check_station_arrival(lat: float, lng: float, trip_id: str):
-    if not firebase_admin._apps:
-        return
+# ========== 司機視圖快取 ==========
+# 每份主表快照只建立一次所有司機端輸出（含預先序列化的 JSON），直到快照內容改變
+# 或有班次跨過「一小時前」的截止線時才重建
+# version 為內容雜湊：各實例對相同內容給出相同版本，客戶端換到其他實例時 since_version 仍然有效
+DRIVER_VIEWS_HISTORY_SIZE = 16
+def _keyed_fragments(items: list, key_fn) -> Dict[str, bytes]:
+    """逐筆序列化並以穩定的 key 索引；key 重複時加上 #n"""
+    out: Dict[str, bytes] = {}
+    for item in items:
+        base = key_fn(item)
+        key = base
+        n = 1
+        while key in out:
+            key = f"{base}#{n}"
+            n += 1
+        out[key] = _dumps(item)
+    return out
+
+def _json_array(fragments: Dict[str, bytes]) -> bytes:
+    return b"[" + b",".join(fragments.values()) + b"]"
+
+def _json_object(fragments: Dict[str, bytes]) -> bytes:
+    return b"{" + b",".join(json.dumps(k, ensure_ascii=False).encode("utf-8") + b":" + v for k, v in fragments.items()) + b"}"
+
+def _manifest_tickets(p: DriverPassengerRecord, sub_tickets: Dict[str, List[Dict[str, Any]]]):
+    """可核銷的票：子票表中的子票，或未分票的整張票（QRCode編碼 為 FT: 開頭，索引 0）；產出 (QR 內容, 子票索引, 人數, 是否已上車)"""
+    tickets = sub_tickets.get(p.booking_id)
+    if tickets:
+        for t in tickets:
+            if t["qr_content"]:
+                yield t["qr_content"], t["sub_ticket_index"], t["sub_ticket_pax"], t["status"] == "checked_in"
+    elif p.qrcode.startswith("FT:"):
+        yield p.qrcode, 0, p.pax, p.status.startswith(("已上車", "上車"))
+
+def _manifest_ticket_key(qr_content: str) -> str:
+    return hashlib.sha256(qr_content.encode("utf-8")).hexdigest()
+
+def _build_trip_manifest(trip_id: str, version: str, passengers: List[DriverPassengerRecord], sub_tickets: Dict[str, List[Dict[str, Any]]]) -> bytes:
+    """
+    單一班次的離線核銷名單：tickets 以 QR 內容 UTF-8 的 SHA-256（hex）為 key，名單外流也拿不到可用的 QR 內容；
+    用戶端掃碼後先雜湊再 O(1) 查驗，值為 [預約編號, 子票索引, 人數, 已上車 0/1]；
+    bookings 為各預約的顯示資訊與子票結構；window 為可核銷的時間窗（主班次前 / 後分鐘數）
+    """
+    tickets: Dict[str, list] = {}
+    bookings: Dict[str, Dict[str, Any]] = {}
+    for p in passengers:
+        booking = bookings.get(p.booking_id)
+        if booking is None:
+            booking = bookings[p.booking_id] = {"name": p.name, "room": p.room, "pax": p.pax, "pickup": "", "dropoff": "", "subs": []}
+            for qr, sub_index, pax, checked in _manifest_tickets(p, sub_tickets):
+                tickets[_manifest_ticket_key(qr)] = [p.booking_id, sub_index, pax, 1 if checked else 0]
+                if sub_index:
+                    booking["subs"].append(sub_index)
+        booking["pickup" if p.updown == "上車" else "dropoff"] = p.station
+    return _dumps({
+        "trip_id": trip_id,
+        "version": version,
+        "window": {"before_min": CHECKIN_WINDOW_BEFORE_SECONDS // 60, "after_min": CHECKIN_WINDOW_AFTER_SECONDS // 60},
+        "ticket_key": "sha256",
+        "tickets": tickets,
+        "bookings": bookings,
+    })
+
+def _sign_manifest(body: bytes) -> Optional[str]:
+    if MANIFEST_SIGNING_KEY is None:
+        return None
+    return "v1=" + hmac.new(MANIFEST_SIGNING_KEY, body, hashlib.sha256).hexdigest()
+
+class DriverViews:
+    # 差量回應的三個集合與其 key：trips=trip_id；trip_passengers=trip_id|booking_id|上下車|站點；passenger_list=main_datetime|booking_id
+    SECTIONS = ("trips", "trip_passengers", "passenger_list")
+
+    def __init__(self, values: List[List[str]], hmap: Dict[str, int], build_seq: int):
+        self.values = values
+        self.build_seq = build_seq
+        cutoff_min = _cutoff_epoch_minutes(_tz_now() - timedelta(hours=1))
+        upcoming = [m.epoch_min for m in _main_typed_columns(values, hmap)["main_dt"] if m is not None and m.epoch_min >= cutoff_min]
+        # 截止線超過最早一個仍顯示的班次時，視圖即過期
+        self.valid_until_min = min(upcoming) if upcoming else None
+        self.trips, self.trip_passengers, self.passenger_list_all = build_all_driver_data_optimized(values, hmap)
+        self.passenger_list = build_driver_all_passengers(values, hmap)
+        self.passengers_by_raw = _group_driver_trip_passengers(values, hmap)
+        self.raw_by_trip_id: Dict[str, List[str]] = {}
+        for raw in self.passengers_by_raw:
+            self.raw_by_trip_id.setdefault(_normalize_main_dt_format(raw), []).append(raw)
+        self.fragments: Dict[str, Dict[str, bytes]] = {
+            "trips": _keyed_fragments(self.trips, lambda t: t.trip_id),
+            "trip_passengers": _keyed_fragments(self.trip_passengers, lambda p: f"{p.trip_id}|{p.booking_id}|{p.updown}|{p.station}"),
+            "passenger_list": _keyed_fragments(self.passenger_list_all, lambda p: f"{p.main_datetime}|{p.booking_id}"),
+        }
+        self.passenger_list_json = _dumps(self.passenger_list)
+        digest = hashlib.blake2b(digest_size=8)
+        for section in self.SECTIONS:
+            for key, frag in self.fragments[section].items():
+                digest.update(key.encode("utf-8"))
+                digest.update(frag)
+        # /api/driver/passenger_list 的篩選條件不同，也納入版本
+        digest.update(self.passenger_list_json)
+        # 單班次名單來自 passengers_by_raw（不套用截止線），同樣納入版本，避免其 ETag 過期
+        for raw in sorted(self.passengers_by_raw):
+            digest.update(raw.encode("utf-8"))
+            digest.update(_dumps(self.passengers_by_raw[raw]))
+        self.version = digest.hexdigest()
+        self.data_json = (
+            b'{"trips":' + _json_array(self.fragments["trips"])
+            + b',"trip_passengers":' + _json_array(self.fragments["trip_passengers"])
+            + b',"passenger_list":' + _json_array(self.fragments["passenger_list"])
+            + b',"version":' + json.dumps(self.version).encode("utf-8") + b"}"
+        )
+        self.trips_json = _json_array(self.fragments["trips"])
+        self._trip_json: Dict[str, bytes] = {}
+        self._manifests: Dict[Tuple[str, str], Tuple[bytes, Optional[str]]] = {}
+        self._delta_json: Dict[str, bytes] = {}
+        self._lock = Lock()
+
+    def is_current(self, values: List[List[str]]) -> bool:
+        if values is not self.values:
+            return False
+        if self.valid_until_min is None:
+            return True
+        return _cutoff_epoch_minutes(_tz_now() - timedelta(hours=1)) <= self.valid_until_min
+
+    def passengers_for_trip(self, trip_id: str) -> List[DriverPassengerRecord]:
+        """先以原始字串比對；找不到時以正規化後的主班次時間比對（合併各種寫法）"""
+        if trip_id in self.passengers_by_raw:
+            return self.passengers_by_raw[trip_id]
+        raws = self.raw_by_trip_id.get(_normalize_main_dt_format(trip_id.strip()), [])
+        if len(raws) == 1:
+            return self.passengers_by_raw[raws[0]]
+        return sorted((p for raw in raws for p in self.passengers_by_raw[raw]), key=_driver_passenger_sort_key)
+
+    def trip_passengers_json(self, trip_id: str) -> bytes:
+        with self._lock:
+            body = self._trip_json.get(trip_id)
+        if body is None:
+            body = _dumps(self.passengers_for_trip(trip_id))
+            with self._lock:
+                if len(self._trip_json) < 1024:
+                    self._trip_json[trip_id] = body
+        return body
+
+    def trip_manifest(self, trip_id: str, sub_snapshot: Dict[str, Any]) -> Optional[Tuple[bytes, Optional[str]]]:
+        """
+        (名單 JSON, 簽章)；班次沒有乘客時返回 None，未設定簽章金鑰時簽章為 None。
+        子票狀態來自子票表快照（核銷寫回後即修補，不改變主表），故快取以 (trip_id, 子票快照版本) 為 key
+        """
+        key = (trip_id, sub_snapshot["version"])
+        with self._lock:
+            cached = self._manifests.get(key)
+        if cached is not None:
+            return cached
+        passengers = self.passengers_for_trip(trip_id)
+        if not passengers:
+            return None
+        body = _build_trip_manifest(trip_id, f"{self.version}.{sub_snapshot['version']}", passengers, sub_snapshot["by_booking"])
+        cached = (body, _sign_manifest(body))
+        with self._lock:
+            if len(self._manifests) >= 1024:
+                # 舊子票版本的名單不會再被取用
+                self._manifests = {k: v for k, v in self._manifests.items() if k[1] == key[1]}
+            if len(self._manifests) < 1024:
+                self._manifests[key] = cached
+        return cached
+
+    def delta_json(self, since_version: str, base: Dict[str, Dict[str, bytes]]) -> bytes:
+        """與舊版本相比的新增 / 變更（upserted）與移除（removed），只序列化有變動的項目"""
+        with self._lock:
+            body = self._delta_json.get(since_version)
+        if body is not None:
+            return body
+        parts = [b'"version":' + json.dumps(self.version).encode("utf-8"), b'"since_version":' + json.dumps(since_version).encode("utf-8"), b'"delta":true']
+        for section in self.SECTIONS:
+            current = self.fragments[section]
+            previous = base.get(section, {})
+            upserted = {k: v for k, v in current.items() if previous.get(k) != v}
+            removed = [k for k in previous if k not in current]
+            parts.append(json.dumps(section).encode("utf-8") + b':{"upserted":' + _json_object(upserted) + b',"removed":' + json.dumps(removed, ensure_ascii=False).encode("utf-8") + b"}")
+        body = b"{" + b",".join(parts) + b"}"
+        with self._lock:
+            if len(self._delta_json) < DRIVER_VIEWS_HISTORY_SIZE:
+                self._delta_json[since_version] = body
+        return body
+
+DRIVER_VIEWS: Optional[DriverViews] = None
+DRIVER_VIEWS_BUILD_SEQ = 0
+DRIVER_VIEWS_LOCK = Lock()
+# 最近幾個版本的逐筆片段，供 since_version 差量比對
+DRIVER_VIEWS_HISTORY: Dict[str, Dict[str, Dict[str, bytes]]] = {}
+
+def _get_driver_views() -> DriverViews:
+    global DRIVER_VIEWS, DRIVER_VIEWS_BUILD_SEQ
+    values, hmap = _get_sheet_data_main()
+    views = DRIVER_VIEWS
+    if views is not None and views.is_current(values):
+        return views
+    with DRIVER_VIEWS_LOCK:
+        views = DRIVER_VIEWS
+        if views is not None and views.is_current(values):
+            return views
+        DRIVER_VIEWS_BUILD_SEQ += 1
+        t0 = time.perf_counter()
+        views = DriverViews(values, hmap, DRIVER_VIEWS_BUILD_SEQ)
+        DRIVER_VIEWS = views
+        DRIVER_VIEWS_HISTORY.pop(views.version, None)
+        DRIVER_VIEWS_HISTORY[views.version] = views.fragments
+        while len(DRIVER_VIEWS_HISTORY) > DRIVER_VIEWS_HISTORY_SIZE:
+            DRIVER_VIEWS_HISTORY.pop(next(iter(DRIVER_VIEWS_HISTORY)))
+        log.info(f"[driver_views] built version={views.version} seq={views.build_seq} trips={len(views.trips)} in {time.perf_counter() - t0:.3f}s")
+    return views
+
+def _driver_views_base(version: str) -> Optional[Dict[str, Dict[str, bytes]]]:
+    with DRIVER_VIEWS_LOCK:
+        return DRIVER_VIEWS_HISTORY.get(version)
+
+def benchmark_driver_serialization(sizes: Tuple[int, ...] = (1000, 10000, 100000)) -> List[Dict[str, Any]]:
+    """
+    乘客名單序列化微基準：
+    legacy = 逐列建立 Pydantic 實例 + response_model 再驗證 + jsonable_encoder + json.dumps（原本 FastAPI 的路徑）
+    fast = slotted 紀錄直接 _dumps
+    """
+    from pydantic import TypeAdapter
+    from fastapi.encoders import jsonable_encoder
+    adapter = TypeAdapter(List[DriverPassenger])
+    results: List[Dict[str, Any]] = []
+    for size in sizes:
+        records = [
+            DriverPassengerRecord(trip_id=f"2025/01/{1 + i % 28:02d} {7 + i % 12:02d}:30", station=TRIP_STATIONS[i % 4], updown="上車" if i % 2 == 0 else "下車", booking_id=f"2501{i:06d}", name=f"旅客{i}", phone="0912345678", room=str(300 + i % 50), pax=1 + i % 3, status="", direction="去程", qrcode=f"FT:2501{i:06d}:abcdef")
+            for i in range(size)
+        ]
+        t0 = time.perf_counter()
+        models = [DriverPassenger(**asdict(r)) for r in records]
+        validated = adapter.validate_python(models)
+        legacy_body = json.dumps(jsonable_encoder(validated), ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        legacy_s = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        fast_body = _dumps(records)
+        fast_s = time.perf_counter() - t0
+        if json.loads(fast_body) != json.loads(legacy_body):
+            raise AssertionError("fast serialization output differs from legacy path")
+        results.append({"passengers": size, "legacy_s": round(legacy_s, 4), "fast_s": round(fast_s, 4), "speedup": round(legacy_s / fast_s, 1) if fast_s else None, "bytes": len(fast_body)})
+    log.info(f"[bench] driver serialization: {results}")
+    return results
+
+# ========== 路線快取（Google Directions）==========
+# 以停靠站順序為 key，快取 overview polyline 與解碼後的 path
+# 記憶體一層、RTDB /route_cache 一層（跨實例、重啟後仍在）；過期後仍可作為 Maps API 失敗時的備援
+ROUTE_CACHE: Dict[str, Dict[str, Any]] = {}
+ROUTE_CACHE_LOCK = Lock()
+_route_refreshing: set = set()
+
+def _route_stops(stops_names: List[str]) -> List[Dict[str, Any]]:
+    stops: List[Dict[str, Any]] = []
+    for name in stops_names:
+        coord = STATION_COORDS.get(name)
+        if coord:
+            stops.append({"lat": coord["lat"], "lng": coord["lng"], "name": name})
+    return stops
+
+def _route_cache_key(stops: List[Dict[str, Any]]) -> str:
+    raw = "|".join(f"{s['name']}@{s['lat']:.6f},{s['lng']:.6f}" for s in stops)
+    return "route_" + hashlib.sha256(raw.encode("utf-8")).hexdigest()[:24]
+
+def _fetch_directions_polyline(stops: List[Dict[str, Any]], timeout_s: float = DIRECTIONS_TIMEOUT_SECONDS) -> Dict[str, Any]:
+    """呼叫 Google Directions API，返回 {"points", "path"}；失敗或未設定金鑰時返回 {}"""
+    api_key = os.environ.get("GOOGLE_MAPS_API_KEY")
+    if not api_key or len(stops) < 2:
+        return {}
+    origin = f"{stops[0]['lat']},{stops[0]['lng']}"
+    destination = f"{stops[-1]['lat']},{stops[-1]['lng']}"
+    if len(stops) > 2:
+        wp = "|".join([f"{s['lat']},{s['lng']}" for s in stops[1:-1]])
+    else:
+        wp = ""
+    params = {"origin": origin, "destination": destination, "mode": "driving", "key": api_key}
+    if wp:
+        params["waypoints"] = wp
+    url = "https://maps.googleapis.com/maps/api/directions/json?" + urllib.parse.urlencode(params)
+    with urllib.request.urlopen(url, timeout=timeout_s) as resp:
+        data = json.loads(resp.read().decode("utf-8"))
+    if data.get("status") != "OK":
+        log.warning(f"[route_cache] directions status={data.get('status')}")
+        return {}
+    routes = data.get("routes", [])
+    if not routes:
+        return {}
+    points = routes[0].get("overview_polyline", {}).get("points", "")
+    path = _decode_polyline(points) if points else []
+    return {"points": points, "path": path}
+
+def _route_cache_get(key: str) -> Optional[Dict[str, Any]]:
+    with ROUTE_CACHE_LOCK:
+        entry = ROUTE_CACHE.get(key)
+    if entry is not None:
+        return entry
+    if not _init_firebase():
+        return None
     try:
-        root_ref = db.reference("/")
-        firebase_data = root_ref.get()
-        if not firebase_data:
+        entry = db.reference(f"/route_cache/{key}").get()
+    except Exception as e:
+        log.warning(f"[route_cache] read failed key={key}: {e}")
+        return None
+    if not isinstance(entry, dict) or not entry.get("points"):
+        return None
+    if not entry.get("path"):
+        entry["path"] = _decode_polyline(entry["points"])
+    with ROUTE_CACHE_LOCK:
+        ROUTE_CACHE[key] = entry
+    return entry
+
+def _route_cache_put(key: str, stops: List[Dict[str, Any]], polyline_obj: Dict[str, Any]) -> Dict[str, Any]:
+    entry = {
+        "stops": [s["name"] for s in stops],
+        "points": polyline_obj["points"],
+        "path": polyline_obj["path"],
+        "fetched_at": int(time.time() * 1000),
+    }
+    with ROUTE_CACHE_LOCK:
+        ROUTE_CACHE[key] = entry
+    try:
+        if _init_firebase():
+            db.reference(f"/route_cache/{key}").set(entry)
+    except Exception as e:
+        log.warning(f"[route_cache] write failed key={key}: {e}")
+    return entry
+
+def _refresh_route_cache(key: str, stops: List[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    try:
+        polyline_obj = _fetch_directions_polyline(stops)
+    except Exception as e:
+        log.warning(f"[route_cache] directions failed key={key}: {type(e).__name__}: {e}")
+        return None
+    if not polyline_obj.get("points"):
+        return None
+    return _route_cache_put(key, stops, polyline_obj)
+
+def _refresh_route_cache_async(key: str, stops: List[Dict[str, Any]]) -> None:
+    with ROUTE_CACHE_LOCK:
+        if key in _route_refreshing:
             return
-        stations_info = firebase_data.get("current_trip_stations", {})
-        if not stations_info or "stops" not in stations_info:
+        _route_refreshing.add(key)
+    def _run():
+        try:
+            _refresh_route_cache(key, stops)
+        finally:
+            with ROUTE_CACHE_LOCK:
+                _route_refreshing.discard(key)
+    threading.Thread(target=_run, daemon=True).start()
+
+def _get_route_polyline(stops: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    取得停靠站順序對應的路線：命中快取立即返回（過期則背景更新），
+    完全沒有快取時才同步呼叫 Directions API
+    """
+    if len(stops) < 2:
+        return {}
+    key = _route_cache_key(stops)
+    entry = _route_cache_get(key)
+    if entry is not None:
+        age_s = time.time() - int(entry.get("fetched_at", 0)) / 1000
+        if age_s > ROUTE_CACHE_TTL_SECONDS:
+            _refresh_route_cache_async(key, stops)
+        return {"points": entry["points"], "path": entry["path"]}
+    entry = _refresh_route_cache(key, stops)
+    if entry is None:
+        return {}
+    return {"points": entry["points"], "path": entry["path"]}
+
+def _route_sequences_to_precompute() -> List[List[str]]:
+    """起點與回程飯店固定，中間各站可略過的所有組合"""
+    first, middle, last = TRIP_STATIONS[0], TRIP_STATIONS[1:-1], TRIP_STATIONS[-1]
+    sequences: List[List[str]] = []
+    for mask in range(1 << len(middle)):
+        chosen = [name for i, name in enumerate(middle) if mask & (1 << (len(middle) - 1 - i))]
+        sequences.append([first] + chosen + [last])
+    sequences.sort(key=len, reverse=True)
+    return sequences
+
+def precompute_route_cache() -> int:
+    """離線預先計算常用停靠順序的路線（python server.py precompute_routes）"""
+    ok = 0
+    for names in _route_sequences_to_precompute():
+        stops = _route_stops(names)
+        entry = _refresh_route_cache(_route_cache_key(stops), stops)
+        if entry is not None:
+            ok += 1
+            log.info(f"[route_cache] precomputed {len(stops)} stops, {len(entry['path'])} points: {' -> '.join(names)}")
+        else:
+            log.warning(f"[route_cache] precompute failed: {' -> '.join(names)}")
+    return ok
+
+# ========== 行程狀態機 ==========
+# 所有 current_trip_* 的變更都經由 _apply_trip_transition：
+# 1. 在 /current_trip_fsm 以 transaction 檢查轉換是否合法、取得遞增版本號，並把帶版本的欄位（state）一起寫入同一節點，
+#    版本與欄位在同一次原子寫入中提交，讀取端以此節點為準
+# 2. 之後把 state 與 current_trip_version 鏡像到根目錄的 current_trip_*（供直接讀 RTDB 的用戶端）；
+#    鏡像寫完若發現已有更新的版本，改以最新的 state 重寫，鏡像最終會收斂到最新版本
+TRIP_TRANSITIONS: Dict[str, Tuple[Tuple[str, ...], str]] = {
+    # 事件: (允許的來源狀態, 目標狀態)；"" 表示從未有過行程
+    "start": (("", "idle", "active", "ended"), "active"),
+    "station": (("active",), "active"),
+    "end": (("active",), "ended"),
+}
+
+# 由狀態機管理、帶版本號的 RTDB 欄位
+TRIP_VERSIONED_KEYS = (
+    "current_trip_id", "current_trip_status", "current_trip_datetime", "current_trip_route",
+    "current_trip_stations", "current_trip_station", "current_trip_start_time",
+    "current_trip_completed_stops", "last_trip_datetime",
+)
+TRIP_MIRROR_MAX_ROUNDS = 3
+
+class TripTransitionRejected(Exception):
+    pass
+
+def _mirror_trip_state(fsm: Dict[str, Any], extras: Dict[str, Any]) -> None:
+    """把狀態機節點的 state 鏡像到根目錄；期間有更新的轉換時改寫最新的 state"""
+    for _ in range(TRIP_MIRROR_MAX_ROUNDS):
+        payload = dict(extras)
+        payload.update(fsm.get("state") or {})
+        payload["current_trip_version"] = int(fsm["version"])
+        db.reference("/").update(payload)
+        latest = db.reference("/current_trip_fsm").get()
+        if not isinstance(latest, dict) or int(latest.get("version", 0)) <= int(fsm["version"]):
+            return
+        fsm, extras = latest, {}
+    log.warning(f"[trip_fsm] mirror did not settle after {TRIP_MIRROR_MAX_ROUNDS} rounds")
+
+def _apply_trip_transition(event: str, updates: Dict[str, Any], trip_id: Optional[str] = None) -> Optional[int]:
+    """
+    套用行程狀態轉換，返回新版本號；轉換不合法（例如行程已被其他實例結束）時返回 None
+    trip_id：start 時為新行程 ID；station / end 時若提供則必須與目前行程相同
+    updates 中不屬於 TRIP_VERSIONED_KEYS 的欄位（ETA、軌跡等）只寫入鏡像
+    """
+    allowed_from, target = TRIP_TRANSITIONS[event]
+    # 交易函數可能被 RTDB 重試多次，內部不做讀取：尚未啟用狀態機時先在交易外讀一次根目錄的 current_trip_*
+    legacy: Dict[str, Any] = {key: None for key in TRIP_VERSIONED_KEYS}
+    if db.reference("/current_trip_fsm/state/current_trip_status").get() is None:
+        legacy.update({key: db.reference(f"/{key}").get() for key in TRIP_VERSIONED_KEYS})
+    def txn(current):
+        if not isinstance(current, dict) or not isinstance(current.get("state"), dict):
+            # 尚未啟用狀態機（或舊版節點沒有 state）時，以根目錄的 current_trip_* 作為初始狀態
+            cur = dict(current) if isinstance(current, dict) else {"version": 0, "status": legacy["current_trip_status"] or "", "trip_id": legacy["current_trip_id"] or ""}
+            cur["state"] = {k: v for k, v in legacy.items() if v is not None}
+        else:
+            cur = current
+        cur_status = cur.get("status") or ""
+        if cur_status not in allowed_from:
+            raise TripTransitionRejected(f"{event}: status={cur_status}")
+        if event != "start" and trip_id and cur.get("trip_id") and cur.get("trip_id") != trip_id:
+            raise TripTransitionRejected(f"{event}: trip_id={cur.get('trip_id')} != {trip_id}")
+        state = dict(cur["state"])
+        state.update({k: v for k, v in updates.items() if k in TRIP_VERSIONED_KEYS})
+        state["current_trip_status"] = target
+        return {
+            "version": int(cur.get("version", 0)) + 1,
+            "status": target,
+            "trip_id": trip_id if event == "start" else ("" if event == "end" else cur.get("trip_id", "")),
+            "event": event,
+            "ts": int(time.time() * 1000),
+            "state": state,
+        }
+    try:
+        fsm = db.reference("/current_trip_fsm").transaction(txn)
+    except TripTransitionRejected as e:
+        log.info(f"[trip_fsm] rejected {e}")
+        return None
+    version = int(fsm["version"])
+    _mirror_trip_state(fsm, {k: v for k, v in updates.items() if k not in TRIP_VERSIONED_KEYS})
+    log.info(f"[trip_fsm] {event} -> {target} version={version}")
+    return version
+
+def _trip_end_updates(last_trip_datetime: Optional[str], route_trip_id: Optional[str] = None) -> Dict[str, Any]:
+    updates: Dict[str, Any] = {
+        "current_trip_id": "",
+        "current_trip_route": {},
+        "current_trip_path_history": [],
+        "current_trip_datetime": "",
+        "current_trip_stations": {},
+    }
+    if last_trip_datetime:
+        updates["last_trip_datetime"] = last_trip_datetime
+    if route_trip_id:
+        updates[f"trip/{route_trip_id}/route"] = None
+    return updates
+
+# 讀取端快取：版本號不變時不需重新讀取各 current_trip_* 欄位
+TRIP_SNAPSHOT_CACHE: Dict[str, Any] = {"version": None, "data": None}
+TRIP_SNAPSHOT_LOCK = Lock()
+
+def _read_trip_snapshot() -> Dict[str, Any]:
+    """以 /current_trip_fsm 為準：版本號不變時用快取，否則一次讀取整個節點（版本與欄位必定成對）"""
+    version = db.reference("/current_trip_fsm/version").get()
+    with TRIP_SNAPSHOT_LOCK:
+        if version is not None and TRIP_SNAPSHOT_CACHE["version"] == version and TRIP_SNAPSHOT_CACHE["data"] is not None:
+            return dict(TRIP_SNAPSHOT_CACHE["data"])
+    fsm = db.reference("/current_trip_fsm").get()
+    if isinstance(fsm, dict) and isinstance(fsm.get("state"), dict):
+        version = fsm.get("version")
+        data = {key: fsm["state"].get(key) for key in TRIP_VERSIONED_KEYS}
+    else:
+        # 狀態機尚未寫入過 state：沿用根目錄欄位，不快取
+        data = {key: db.reference(f"/{key}").get() for key in TRIP_VERSIONED_KEYS}
+        data["current_trip_version"] = db.reference("/current_trip_version").get()
+        return data
+    data["current_trip_version"] = version
+    with TRIP_SNAPSHOT_LOCK:
+        TRIP_SNAPSHOT_CACHE["version"] = version
+        TRIP_SNAPSHOT_CACHE["data"] = dict(data)
+    return data
+
+# ========== 行程排程（時間輪） ==========
+# 行程的自動結束由背景時間輪在期限到達時觸發一次；Cloud Run 在請求之外會節流 CPU、實例也可能被縮減，
+# 計時器不保證會觸發，因此定位上傳與即時位置讀取仍以行程快照做一次便宜的期限檢查作為後備
+TIMER_WHEEL_TICK_SECONDS = 1.0
+TIMER_WHEEL_SLOTS = 512
+TRIP_SHUTDOWN_TIMER_KEY = "trip_auto_shutdown"
+
+class TimerWheel:
+    """
+    Hashed timing wheel：每個 tick 只處理一個槽位，排程與取消皆為 O(1)
+    超過一圈的期限以 rounds 記錄剩餘圈數；回呼在 IO_EXECUTOR 執行，每個 key 只觸發一次
+    """
+    def __init__(self, tick_seconds: float = TIMER_WHEEL_TICK_SECONDS, slots: int = TIMER_WHEEL_SLOTS):
+        self.tick_seconds = tick_seconds
+        self.slots: List[Dict[str, List[Any]]] = [{} for _ in range(slots)]
+        self.index: Dict[str, int] = {}
+        self.cursor = 0
+        self.lock = Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    def schedule(self, key: str, deadline_ts: float, callback) -> None:
+        """在 deadline_ts（epoch 秒）觸發 callback；同一 key 重複排程會取代舊的"""
+        delay = max(0.0, deadline_ts - time.time())
+        ticks = max(1, int(math.ceil(delay / self.tick_seconds)))
+        with self.lock:
+            self._cancel_locked(key)
+            slot = (self.cursor + ticks) % len(self.slots)
+            self.slots[slot][key] = [(ticks - 1) // len(self.slots), callback]
+            self.index[key] = slot
+        self.start()
+
+    def cancel(self, key: str) -> bool:
+        with self.lock:
+            return self._cancel_locked(key)
+
+    def _cancel_locked(self, key: str) -> bool:
+        slot = self.index.pop(key, None)
+        if slot is None:
+            return False
+        self.slots[slot].pop(key, None)
+        return True
+
+    def pending(self) -> int:
+        with self.lock:
+            return len(self.index)
+
+    def _advance(self) -> List[Any]:
+        due = []
+        with self.lock:
+            self.cursor = (self.cursor + 1) % len(self.slots)
+            bucket = self.slots[self.cursor]
+            for key in list(bucket.keys()):
+                entry = bucket[key]
+                if entry[0] > 0:
+                    entry[0] -= 1
+                    continue
+                del bucket[key]
+                self.index.pop(key, None)
+                due.append((key, entry[1]))
+        return due
+
+    def _run(self) -> None:
+        next_tick = time.monotonic() + self.tick_seconds
+        while True:
+            time.sleep(max(0.0, next_tick - time.monotonic()))
+            # 若執行緒被延遲（例如 CPU 節流），補走落後的 tick
+            while next_tick <= time.monotonic():
+                for key, callback in self._advance():
+                    log.info(f"[timer_wheel] fire {key}")
+                    IO_EXECUTOR.submit(callback)
+                next_tick += self.tick_seconds
+
+    def start(self) -> None:
+        with self.lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name="timer-wheel", daemon=True)
+            self._thread.start()
+
+TRIP_SCHEDULER = TimerWheel()
+# 本實例時間輪上登記的行程，以及已送出自動結束、尚未完成的行程
+TRIP_SHUTDOWN_STATE: Dict[str, Any] = {"armed_trip_id": None, "completing": set()}
+TRIP_SHUTDOWN_LOCK = Lock()
+
+def _run_trip_auto_shutdown(trip_id: str, main_datetime: str) -> None:
+    try:
+        auto_complete_trip(trip_id=trip_id, main_datetime=main_datetime, only_if_current=True)
+    except Exception as e:
+        log.error(f"[trip_scheduler] auto complete failed: {e}")
+    finally:
+        with TRIP_SHUTDOWN_LOCK:
+            TRIP_SHUTDOWN_STATE["completing"].discard(trip_id)
+
+def _schedule_trip_shutdown(trip_id: str, main_datetime: str, start_ms: int) -> None:
+    """登記行程的自動結束期限（開始時間 + AUTO_SHUTDOWN_MS）"""
+    with TRIP_SHUTDOWN_LOCK:
+        TRIP_SHUTDOWN_STATE["armed_trip_id"] = trip_id
+    TRIP_SCHEDULER.schedule(TRIP_SHUTDOWN_TIMER_KEY, (int(start_ms) + AUTO_SHUTDOWN_MS) / 1000.0, lambda: _run_trip_auto_shutdown(trip_id, main_datetime))
+    log.info(f"[trip_scheduler] trip {trip_id} auto shutdown scheduled")
+
+def _cancel_trip_shutdown(trip_id: Optional[str]) -> None:
+    """只取消登記給 trip_id 的期限；結束其他行程時不影響目前行程的計時器"""
+    with TRIP_SHUTDOWN_LOCK:
+        if not trip_id or TRIP_SHUTDOWN_STATE["armed_trip_id"] != trip_id:
             return
-        actual_stops_names = stations_info.get("stops", [])
-        if not actual_stops_names:
+        TRIP_SHUTDOWN_STATE["armed_trip_id"] = None
+    TRIP_SCHEDULER.cancel(TRIP_SHUTDOWN_TIMER_KEY)
+
+def _check_trip_deadline(snapshot: Dict[str, Any]) -> None:
+    """
+    熱點路徑上的後備檢查（只比較時間，不做 I/O）：進行中的行程已過期時送出一次自動結束；
+    尚未過期但本實例沒有登記計時器時（行程在其他實例開始）補登記
+    """
+    trip_id = snapshot.get("current_trip_id") or ""
+    start_ms = snapshot.get("current_trip_start_time") or 0
+    if snapshot.get("current_trip_status") != "active" or not trip_id or not start_ms:
+        return
+    main_datetime = snapshot.get("current_trip_datetime") or ""
+    expired = time.time() * 1000 >= int(start_ms) + AUTO_SHUTDOWN_MS
+    with TRIP_SHUTDOWN_LOCK:
+        if expired:
+            if trip_id in TRIP_SHUTDOWN_STATE["completing"]:
+                return
+            TRIP_SHUTDOWN_STATE["completing"].add(trip_id)
+        elif TRIP_SHUTDOWN_STATE["armed_trip_id"] == trip_id:
             return
-        completed_stops = firebase_data.get("current_trip_completed_stops", [])
-        route_data = firebase_data.get("current_trip_route", {})
-        route_path = route_data.get("path", []) if route_data else []
-        completed_stops_ref = db.reference("/current_trip_completed_stops")
-        def get_station_threshold(stop_name: str) -> float:
-            if "飯店" in stop_name or "Hotel" in stop_name:
-                return 60
-            elif "捷運" in stop_name or "MRT" in stop_name:
-                return 40
-            elif "火車" in stop_name or "Train" in stop_name:
-                return 40
+    if expired:
+        log.info(f"[trip_scheduler] trip {trip_id} past deadline, completing on request path")
+        IO_EXECUTOR.submit(_run_trip_auto_shutdown, trip_id, main_datetime)
+    else:
+        _schedule_trip_shutdown(trip_id, main_datetime, start_ms)
+
+def _restore_trip_schedule() -> None:
+    """啟動時若 RTDB 仍有進行中的行程，重新登記期限（已過期者會在下一個 tick 結束）"""
+    try:
+        snapshot = _read_trip_snapshot()
+    except Exception as e:
+        log.warning(f"[trip_scheduler] restore failed: {e}")
+        return
+    if snapshot.get("current_trip_status") == "active" and snapshot.get("current_trip_start_time"):
+        _schedule_trip_shutdown(snapshot.get("current_trip_id") or "", snapshot.get("current_trip_datetime") or "", snapshot["current_trip_start_time"])
+
+# ========== 站點到達檢測 ==========
+class RouteGeometry:
+    """
+    行程路線幾何（trip_start 時建立一次）
+    - 路線點轉為以起點為原點的平面座標（公尺，NumPy 陣列）並預先計算累積距離
+    - 各站點依行駛順序預先對應到路線索引（後一站只在前一站之後搜尋，避免回程飯店對到起點）
+    - 以遊標做增量 map-matching，每次定位只搜尋遊標附近的視窗
+    - 進站門檻取自 get_station_threshold，離站需超過門檻 × STATION_EXIT_FACTOR，避免 GPS 抖動反覆進出
+    """
+    def __init__(self, path: List[Dict[str, float]], stops: List[str]):
+        self.stops = list(stops or [])
+        lat = np.array([float(p.get("lat", 0)) for p in (path or [])], dtype=np.float64)
+        lng = np.array([float(p.get("lng", 0)) for p in (path or [])], dtype=np.float64)
+        ref_lat = lat[0] if len(lat) else 25.05
+        ref_lng = lng[0] if len(lng) else 121.6
+        self._kx = 6371000.0 * math.cos(math.radians(ref_lat)) * math.pi / 180.0
+        self._ky = 6371000.0 * math.pi / 180.0
+        self._ref = (ref_lat, ref_lng)
+        self.x = (lng - ref_lng) * self._kx
+        self.y = (lat - ref_lat) * self._ky
+        seg = np.hypot(np.diff(self.x), np.diff(self.y)) if len(self.x) > 1 else np.zeros(0)
+        self.cum = np.concatenate(([0.0], np.cumsum(seg))) if len(self.x) else np.zeros(0)
+        self.cursor = 0
+        self.station_idx: Dict[str, int] = {}
+        self.in_zone: Dict[str, bool] = {}
+        start = 0
+        for name in self.stops:
+            coord = STATION_COORDS.get(name)
+            self.in_zone[name] = False
+            if not coord or not len(self.x):
+                continue
+            sx, sy = self._project(coord["lat"], coord["lng"])
+            d2 = (self.x[start:] - sx) ** 2 + (self.y[start:] - sy) ** 2
+            idx = start + int(np.argmin(d2))
+            self.station_idx[name] = idx
+            start = idx
+
+    def _project(self, lat: float, lng: float) -> Tuple[float, float]:
+        return (lng - self._ref[1]) * self._kx, (lat - self._ref[0]) * self._ky
+
+    def match(self, lat: float, lng: float) -> Tuple[int, float]:
+        """將定位對應到路線索引，返回 (索引, 與路線點距離公尺)；遊標只前進"""
+        n = len(self.x)
+        if n == 0:
+            return -1, float("inf")
+        px, py = self._project(lat, lng)
+        lo = max(0, self.cursor - ROUTE_MATCH_WINDOW_BACK)
+        hi = min(n, self.cursor + ROUTE_MATCH_WINDOW_FWD + 1)
+        d2 = (self.x[lo:hi] - px) ** 2 + (self.y[lo:hi] - py) ** 2
+        i = int(np.argmin(d2))
+        idx, dist = lo + i, math.sqrt(float(d2[i]))
+        if dist > ROUTE_REACQUIRE_M and hi < n:
+            # 視窗內找不到（例如長時間沒有定位），往前全段重新搜尋
+            d2 = (self.x[self.cursor:] - px) ** 2 + (self.y[self.cursor:] - py) ** 2
+            i = int(np.argmin(d2))
+            cand, cand_dist = self.cursor + i, math.sqrt(float(d2[i]))
+            if cand_dist < dist:
+                idx, dist = cand, cand_dist
+        if idx > self.cursor and dist <= ROUTE_REACQUIRE_M:
+            self.cursor = idx
+        return idx, dist
+
+    def remaining_distance(self, from_idx: int, to_idx: int) -> float:
+        if not len(self.cum) or from_idx < 0 or to_idx <= from_idx:
+            return 0.0
+        return float(self.cum[to_idx] - self.cum[from_idx])
+
+    def observe(self, lat: float, lng: float, completed_stops: List[str]) -> Optional[str]:
+        """處理一次定位，返回本次判定到達的站點（依站序第一個），沒有則 None"""
+        self.match(lat, lng)
+        arrived: Optional[str] = None
+        for name in self.stops:
+            coord = STATION_COORDS.get(name)
+            if not coord:
+                continue
+            distance = haversine_distance(lat, lng, coord["lat"], coord["lng"])
+            threshold = get_station_threshold(name)
+            was_in_zone = self.in_zone.get(name, False)
+            if was_in_zone:
+                self.in_zone[name] = distance <= threshold * STATION_EXIT_FACTOR
             else:
-                return 50
-        for stop_name in actual_stops_names:
-            if stop_name in completed_stops:
+                self.in_zone[name] = distance < threshold
+            if arrived or name in completed_stops:
                 continue
-            stop_coord = STATION_COORDS.get(stop_name)
-            if not stop_coord:
+            passed = False
+            st_idx = self.station_idx.get(name)
+            if st_idx is not None and self.cursor >= st_idx + STATION_PASS_MARGIN and distance < 100:
+                passed = True
+            reachable = True
+            if st_idx is not None:
+                # 路線上還很遠的站（例如回程飯店與起點相鄰）不因直線距離近而提前完成
+                reachable = self.remaining_distance(self.cursor, st_idx) <= threshold * STATION_EXIT_FACTOR + ROUTE_REACQUIRE_M
+            if (self.in_zone[name] and reachable) or passed:
+                arrived = name
+        return arrived
+
+# ========== 到站預估（ETA）==========
+# 歷史路段行駛時間：{"起站|迄站": {"小時": {"mean_s": float, "n": int}}}，存於 RTDB /eta_segment_stats
+ETA_SEGMENT_STATS: Dict[str, Dict[str, Dict[str, float]]] = {}
+ETA_STATS_LOCK = Lock()
+_eta_stats_loaded = False
+
+def _eta_segment_key(from_stop: str, to_stop: str) -> str:
+    # RTDB key 不可含 . $ # [ ] /
+    raw = f"{from_stop}|{to_stop}"
+    return re.sub(r"[.$#\[\]/]", "_", raw)
+
+def _load_eta_segment_stats() -> None:
+    global ETA_SEGMENT_STATS, _eta_stats_loaded
+    if _eta_stats_loaded:
+        return
+    try:
+        data = db.reference("/eta_segment_stats").get() or {}
+    except Exception as e:
+        log.warning(f"[eta] load stats failed: {e}")
+        data = {}
+    with ETA_STATS_LOCK:
+        ETA_SEGMENT_STATS = data if isinstance(data, dict) else {}
+        _eta_stats_loaded = True
+
+def _eta_historical_seconds(from_stop: str, to_stop: str, hour: int) -> Optional[float]:
+    with ETA_STATS_LOCK:
+        by_hour = ETA_SEGMENT_STATS.get(_eta_segment_key(from_stop, to_stop)) or {}
+        rec = by_hour.get(str(hour))
+        if not rec:
+            # 同時段沒有資料時使用所有時段加權平均
+            total_n = sum(float(r.get("n", 0)) for r in by_hour.values() if isinstance(r, dict))
+            if total_n <= 0:
+                return None
+            return sum(float(r.get("mean_s", 0)) * float(r.get("n", 0)) for r in by_hour.values() if isinstance(r, dict)) / total_n
+    return float(rec.get("mean_s", 0)) or None
+
+def _record_eta_segment_times(stop_times: List[Tuple[str, float]]) -> None:
+    """行程結束時將各路段實際行駛時間併入歷史表，並一次寫回 RTDB"""
+    if len(stop_times) < 2:
+        return
+    _load_eta_segment_stats()
+    updates: Dict[str, Any] = {}
+    with ETA_STATS_LOCK:
+        for (a, ta), (b, tb) in zip(stop_times, stop_times[1:]):
+            duration = tb - ta
+            if duration <= 0 or duration > 2 * 3600:
                 continue
-            stop_lat = stop_coord["lat"]
-            stop_lng = stop_coord["lng"]
-            distance = haversine_distance(lat, lng, stop_lat, stop_lng)
-            threshold = get_station_threshold(stop_name)
-            distance_check = distance < threshold
-            route_index_check = False
-            if route_path and len(route_path) > 0:
-                station_nearest_idx = 0
-                station_best_dist = float('inf')
-                for i, point in enumerate(route_path):
-                    dx = point.get("lat", 0) - stop_lat
-                    dy = point.get("lng", 0) - stop_lng
-                    dist = dx * dx + dy * dy
-                    if dist < station_best_dist:
-                        station_best_dist = dist
-                        station_nearest_idx = i
-                driver_nearest_idx = 0
-                driver_best_dist = float('inf')
-                for i, point in enumerate(route_path):
-                    dx = point.get("lat", 0) - lat
-                    dy = point.get("lng", 0) - lng
-                    dist = dx * dx + dy * dy
-                    if dist < driver_best_dist:
-                        driver_best_dist = dist
-                        driver_nearest_idx = i
-                if driver_nearest_idx > station_nearest_idx and distance < 100:
-                    route_index_check = True
-            if distance_check or route_index_check:
-                if stop_name not in completed_stops:
-                    completed_stops.append(stop_name)
-                    completed_stops_ref.set(completed_stops)
-                    next_stop = get_next_station(actual_stops_names, completed_stops)
-                    if next_stop:
-                        db.reference("/current_trip_station").set(next_stop)
-                    else:
-                        db.reference("/current_trip_station").set("所有站點已完成")
-                break
+            key = _eta_segment_key(a, b)
+            hour = str(datetime.fromtimestamp(ta).hour)
+            rec = ETA_SEGMENT_STATS.setdefault(key, {}).get(hour) or {"mean_s": 0.0, "n": 0}
+            n = min(int(rec.get("n", 0)) + 1, ETA_STATS_MAX_WEIGHT)
+            mean_s = float(rec.get("mean_s", 0.0)) + (duration - float(rec.get("mean_s", 0.0))) / n
+            rec = {"mean_s": round(mean_s, 1), "n": n}
+            ETA_SEGMENT_STATS[key][hour] = rec
+            updates[f"eta_segment_stats/{key}/{hour}"] = rec
+    if updates:
+        try:
+            db.reference("/").update(updates)
+        except Exception as e:
+            log.warning(f"[eta] save stats failed: {e}")
+
+class TripEtaTracker:
+    """
+    依路線剩餘距離、即時平滑車速（EWMA）與歷史路段時間估計各剩餘站點到站時間
+    每次定位只做 O(剩餘站數) 的計算
+    """
+    def __init__(self, geometry: RouteGeometry, stops: List[str]):
+        self.geometry = geometry
+        self.stops = list(stops)
+        self.speed_mps: Optional[float] = None
+        self.last_dist: Optional[float] = None
+        self.last_ts: Optional[float] = None
+        self.last_lat: Optional[float] = None
+        self.last_lng: Optional[float] = None
+        self.stop_times: List[Tuple[str, float]] = []
+        self.estimates: Dict[str, Dict[str, Any]] = {}
+        self.last_published = 0.0
+
+    def observe(self, lat: float, lng: float, now: float) -> None:
+        dist = float(self.geometry.cum[self.geometry.cursor]) if len(self.geometry.cum) else None
+        if self.last_ts is not None and now > self.last_ts:
+            if dist is not None and self.last_dist is not None:
+                moved = dist - self.last_dist
+            else:
+                moved = haversine_distance(self.last_lat, self.last_lng, lat, lng)
+            v = moved / (now - self.last_ts)
+            if 0 <= v <= ETA_MAX_SPEED_MPS:
+                self.speed_mps = v if self.speed_mps is None else ETA_SPEED_ALPHA * v + (1 - ETA_SPEED_ALPHA) * self.speed_mps
+        self.last_dist, self.last_ts, self.last_lat, self.last_lng = dist, now, lat, lng
+
+    def record_arrival(self, stop_name: str, now: float) -> None:
+        self.stop_times.append((stop_name, now))
+
+    def _leg_distance(self, from_stop: Optional[str], to_stop: str, lat: float, lng: float) -> float:
+        g = self.geometry
+        to_idx = g.station_idx.get(to_stop)
+        if from_stop is None:
+            if to_idx is not None and len(g.cum):
+                return g.remaining_distance(g.cursor, to_idx)
+            coord = STATION_COORDS.get(to_stop) or {"lat": lat, "lng": lng}
+            return haversine_distance(lat, lng, coord["lat"], coord["lng"]) * ETA_DETOUR_FACTOR
+        from_idx = g.station_idx.get(from_stop)
+        if from_idx is not None and to_idx is not None:
+            return g.remaining_distance(from_idx, to_idx)
+        a = STATION_COORDS.get(from_stop)
+        b = STATION_COORDS.get(to_stop)
+        if not a or not b:
+            return 0.0
+        return haversine_distance(a["lat"], a["lng"], b["lat"], b["lng"]) * ETA_DETOUR_FACTOR
+
+    def update(self, completed_stops: List[str], now: float) -> Dict[str, Dict[str, Any]]:
+        """重新計算所有剩餘站點的 ETA（絕對時間戳，毫秒）"""
+        lat, lng = self.last_lat, self.last_lng
+        if lat is None or lng is None:
+            return self.estimates
+        hour = datetime.fromtimestamp(now).hour
+        speed = max(self.speed_mps if self.speed_mps is not None else ETA_DEFAULT_SPEED_MPS, ETA_MIN_SPEED_MPS)
+        prev_stop = completed_stops[-1] if completed_stops else None
+        remaining = [s for s in self.stops if s not in completed_stops]
+        estimates: Dict[str, Dict[str, Any]] = {}
+        elapsed = 0.0
+        cumulative_m = 0.0
+        for i, stop in enumerate(remaining):
+            if i == 0:
+                leg_m = self._leg_distance(None, stop, lat, lng)
+                leg_s = leg_m / speed
+                if prev_stop:
+                    hist = _eta_historical_seconds(prev_stop, stop, hour)
+                    full_m = self._leg_distance(prev_stop, stop, lat, lng)
+                    if hist and full_m > 0:
+                        hist_s = hist * min(1.0, leg_m / full_m)
+                        leg_s = 0.5 * leg_s + 0.5 * hist_s
+            else:
+                leg_m = self._leg_distance(remaining[i - 1], stop, lat, lng)
+                hist = _eta_historical_seconds(remaining[i - 1], stop, hour)
+                leg_s = hist if hist else leg_m / max(speed, ETA_DEFAULT_SPEED_MPS)
+            elapsed += leg_s
+            cumulative_m += leg_m
+            estimates[stop] = {
+                "eta_ts": int((now + elapsed) * 1000),
+                "eta_seconds": int(round(elapsed)),
+                "distance_m": int(round(cumulative_m)),
+            }
+        self.estimates = estimates
+        return estimates
+
+class ActiveTripState:
+    """
+    當前行程的本機快取（在 trip_start 建立），站點到達檢測只讀這裡，
+    只有在站點完成時才寫回 RTDB
+    """
+    def __init__(self, trip_id: str, stops: List[str], route_path: List[Dict[str, float]], completed_stops: Optional[List[str]] = None):
+        self.trip_id = trip_id
+        self.stops = list(stops or [])
+        self.route_path = list(route_path or [])
+        self.completed_stops = list(completed_stops or [])
+        self.geometry = RouteGeometry(self.route_path, self.stops)
+        self.eta = TripEtaTracker(self.geometry, self.stops)
+        self.lock = Lock()
+
+    @classmethod
+    def load_from_rtdb(cls, trip_id: str) -> Optional["ActiveTripState"]:
+        """冷啟動（或行程在其他實例開始）時，從行程快照取出站點、路線與已完成站點"""
+        snapshot = _read_trip_snapshot()
+        if (snapshot.get("current_trip_id") or "") != trip_id:
+            return None
+        stations_info = snapshot.get("current_trip_stations") or {}
+        route_data = snapshot.get("current_trip_route") or {}
+        completed_stops = snapshot.get("current_trip_completed_stops") or []
+        route_path = (route_data.get("polyline") or {}).get("path", []) if isinstance(route_data, dict) else []
+        return cls(trip_id, stations_info.get("stops", []) if isinstance(stations_info, dict) else [], route_path, completed_stops)
+
+ACTIVE_TRIP_STATE: Optional[ActiveTripState] = None
+ACTIVE_TRIP_LOCK = Lock()
+
+def _set_active_trip_state(state: Optional[ActiveTripState]) -> None:
+    global ACTIVE_TRIP_STATE
+    with ACTIVE_TRIP_LOCK:
+        ACTIVE_TRIP_STATE = state
+
+def _end_active_trip_state() -> None:
+    """行程結束：將本趟各站實際到站時間併入 ETA 歷史表後清除快取"""
+    global ACTIVE_TRIP_STATE
+    with ACTIVE_TRIP_LOCK:
+        state = ACTIVE_TRIP_STATE
+        ACTIVE_TRIP_STATE = None
+    if state is not None:
+        try:
+            _record_eta_segment_times(state.eta.stop_times)
+        except Exception as e:
+            log.warning(f"[eta] record segment times failed: {e}")
+
+def _get_active_trip_eta(trip_id: str) -> Optional[Dict[str, Dict[str, Any]]]:
+    """本實例持有該行程時直接返回記憶體中的 ETA，否則返回 None"""
+    with ACTIVE_TRIP_LOCK:
+        state = ACTIVE_TRIP_STATE
+    if state is None or state.trip_id != trip_id:
+        return None
+    with state.lock:
+        return dict(state.eta.estimates)
+
+def _get_active_trip_state(trip_id: str) -> Optional[ActiveTripState]:
+    with ACTIVE_TRIP_LOCK:
+        state = ACTIVE_TRIP_STATE
+    if state is not None and state.trip_id == trip_id:
+        return state
+    try:
+        state = ActiveTripState.load_from_rtdb(trip_id)
+    except Exception as e:
+        log.warning(f"[trip_state] load error trip_id={trip_id}: {e}")
+        return None
+    if state is not None:
+        _set_active_trip_state(state)
+    return state
+
+def get_station_threshold(stop_name: str) -> float:
+    if "飯店" in stop_name or "Hotel" in stop_name:
+        return 60
+    elif "捷運" in stop_name or "MRT" in stop_name:
+        return 40
+    elif "火車" in stop_name or "Train" in stop_name:
+        return 40
+    else:
+        return 50
+
+def check_station_arrival(lat: float, lng: float, trip_id: str):
+    if not firebase_admin._apps:
+        return
+    try:
+        state = _get_active_trip_state(trip_id)
+        if state is None or not state.stops:
+            return
+        _load_eta_segment_stats()
+        now = time.time()
+        updates: Dict[str, Any] = {}
+        with state.lock:
+            stop_name = state.geometry.observe(lat, lng, state.completed_stops)
+            state.eta.observe(lat, lng, now)
+            if stop_name:
+                state.completed_stops.append(stop_name)
+                state.eta.record_arrival(stop_name, now)
+            completed_stops = list(state.completed_stops)
+            estimates = state.eta.update(completed_stops, now)
+            if stop_name or now - state.eta.last_published >= ETA_PUBLISH_INTERVAL:
+                state.eta.last_published = now
+                updates["current_trip_eta"] = estimates
+        if stop_name:
+            next_stop = get_next_station(state.stops, completed_stops)
+            updates["current_trip_completed_stops"] = completed_stops
+            updates["current_trip_station"] = next_stop if next_stop else "所有站點已完成"
+            _apply_trip_transition("station", updates, trip_id=trip_id)
+        elif updates:
+            db.reference("/").update(updates)
     except Exception as e:
         log.warning(f"check_station_arrival error: {e}", exc_info=True)
 
-def auto_complete_trip(trip_id: str = None, main_datetime: str = None):
-    if not trip_id and not main_datetime:
+def benchmark_station_arrival_payload(pings: int = 480, route_points: int = 400, past_trips: int = 30, ping_interval_s: float = 5.0) -> Dict[str, Any]:
+    """
+    站點到達檢測的 RTDB 傳輸量估算（以 JSON 位元組計）：
+    legacy = 每次 GPS 回報都 db.reference("/").get() 讀整個根目錄（軌跡逐次變長）
+    cached = 行程快取：回報本身不讀 RTDB，只有 ETA 定期發布與站點完成（狀態機交易讀寫 + 鏡像 + 鏡像後確認）時傳輸
+    """
+    stops = TRIP_STATIONS[:4]
+    route_path = [{"lat": 25.05 + i * 1e-4, "lng": 121.6 + i * 1e-4} for i in range(route_points)]
+    trip_state = {
+        "current_trip_id": "2025/01/01 08:30", "current_trip_status": "active", "current_trip_datetime": "2025/01/01 08:30",
+        "current_trip_route": {"stops": stops, "polyline": {"points": "x" * (route_points * 4), "path": route_path}},
+        "current_trip_stations": {"stops": stops}, "current_trip_station": stops[0], "current_trip_start_time": 0,
+        "current_trip_completed_stops": [], "last_trip_datetime": "",
+    }
+    root: Dict[str, Any] = dict(trip_state)
+    root.update({
+        "current_trip_fsm": {"version": 1, "status": "active", "trip_id": trip_state["current_trip_id"], "event": "start", "ts": 0, "state": trip_state},
+        "current_trip_path_history": [],
+        "driver_location": {"lat": 25.05, "lng": 121.6, "timestamp": 0},
+        "sheet_locks": {f"lock_{i}": {"holder": secrets.token_hex(8), "expires_at": 0} for i in range(50)},
+        "booking_seq": {f"2501{d:02d}": d for d in range(1, 29)},
+        "trip": {f"2501{i:04d}": {"route": {"path": route_path}} for i in range(past_trips)},
+        "gps_system_enabled": True,
+    })
+    state = ActiveTripState(trip_state["current_trip_id"], stops, route_path)
+    legacy_bytes = 0
+    cached_bytes = 0
+    stop_events = 0
+    eta_publishes = 0
+    last_published = float("-inf")
+    completed_every = max(1, pings // (len(stops) + 1))
+    for i in range(pings):
+        point = route_path[min(len(route_path) - 1, i * len(route_path) // pings)]
+        now = i * ping_interval_s
+        root["current_trip_path_history"].append({"lat": point["lat"], "lng": point["lng"], "timestamp": int(now * 1000)})
+        legacy_bytes += len(_dumps(root))
+        if i and i % completed_every == 0 and len(state.completed_stops) < len(stops):
+            state.completed_stops.append(stops[len(state.completed_stops)])
+            fsm = dict(root["current_trip_fsm"], state=dict(trip_state, current_trip_completed_stops=list(state.completed_stops)))
+            fsm_bytes = len(_dumps(fsm))
+            # 交易讀 + 交易寫 + 鏡像寫（state 全量）+ 鏡像後讀回確認版本
+            cached_bytes += fsm_bytes * 3 + len(_dumps(fsm["state"]))
+            stop_events += 1
+        elif now - last_published >= ETA_PUBLISH_INTERVAL:
+            estimates = {stop: {"eta_ts": 0, "eta_seconds": 600, "distance_m": 1200} for stop in stops}
+            cached_bytes += len(_dumps({"current_trip_eta": estimates}))
+            last_published = now
+            eta_publishes += 1
+    result = {
+        "pings": pings,
+        "legacy_bytes": legacy_bytes,
+        "legacy_bytes_per_ping": legacy_bytes // pings,
+        "cached_bytes": cached_bytes,
+        "stop_events": stop_events,
+        "eta_publishes": eta_publishes,
+        "reduction": round(legacy_bytes / cached_bytes, 1) if cached_bytes else None,
+    }
+    log.info(f"[bench] station arrival payload: {result}")
+    return result
+
+def _update_trip_mgmt_status(dt: datetime, status_text: str) -> bool:
+    """在 車次管理(櫃台)（或備品）找到該班次列，寫入出車狀態與最後更新時間"""
+    key = _trip_mgmt_key_from_dt(dt)
+    snapshot, rowno = _find_trip_mgmt_row(key)
+    cols = snapshot["cols"]
+    if not (rowno and cols["status"] >= 0 and cols["last"] >= 0):
         return False
-    main_dt_str = main_datetime or trip_id
-    dt = _parse_main_dt(main_dt_str)
-    if dt:
-        ws2 = None
-        target_rowno: Optional[int] = None
-        try:
-            try:
-                ws2 = open_ws("車次管理(櫃台)")
-            except Exception:
-                ws2 = open_ws("車次管理(備品)")
-            headers = ws2.row_values(6)
-            headers = [(h or "").strip() for h in headers]
-            def hidx(name: str) -> int:
-                try:
-                    return headers.index(name)
-                except ValueError:
-                    return -1
-            idx_date = hidx("日期")
-            idx_time = hidx("班次") if hidx("時間") < 0 else hidx("時間")
-            idx_status = hidx("出車狀態")
-            idx_last = hidx("最後更新")
-            target_date = dt.strftime("%Y/%m/%d")
-            alt_date = dt.strftime("%Y-%m-%d")
-            t1 = dt.strftime("%H:%M")
-            t2 = dt.strftime("%-H:%M") if hasattr(dt, "strftime") else t1
-            values = ws2.get_all_values()
-            for i in range(6, len(values)):
-                row = values[i]
-                d = (row[idx_date] if idx_date >= 0 and idx_date < len(row) else "").strip()
-                t_raw = (row[idx_time] if idx_time >= 0 and idx_time < len(row) else "").strip()
-                try:
-                    rp = t_raw.split(":")
-                    t_norm = f"{str(rp[0]).zfill(2)}:{rp[1]}" if len(rp) >= 2 else t_raw
-                except Exception:
-                    t_norm = t_raw
-                if (d in (target_date, alt_date)) and (t_raw in (t1, t2) or t_norm in (t1, t2)):
-                    target_rowno = i + 1
-                    break
-            if target_rowno and idx_status >= 0 and idx_last >= 0:
-                now_text = _tz_now().strftime("%Y/%m/%d %H:%M")
-                update_data = [{"range": gspread.utils.rowcol_to_a1(target_rowno, idx_status + 1), "values": [["已結束"]]}, {"range": gspread.utils.rowcol_to_a1(target_rowno, idx_last + 1), "values": [[now_text]]}]
-                ws2.batch_update(update_data, value_input_option="USER_ENTERED")
-                _invalidate_ws_cache("車次管理(櫃台)")
-                _invalidate_ws_cache("車次管理(備品)")
-        except Exception:
-            pass
+    return _write_trip_mgmt_status(snapshot, rowno, status_text, key)
+
+def _read_gps_system_enabled() -> bool:
+    cached = _get_cached_system_config()
+    if cached is not None:
+        e19 = (cached[0][0] if cached and cached[0] else "").strip().lower()
+        return e19 in ("true", "t", "yes", "1")
     try:
-        if not firebase_admin._apps:
-            service_account_path = "service_account.json"
-            if os.path.exists(service_account_path):
-                cred = credentials.Certificate(service_account_path)
-            else:
-                cred = credentials.ApplicationDefault()
-            db_url = os.environ.get("FIREBASE_RTDB_URL")
-            if not db_url:
-                project_id = os.environ.get("GOOGLE_CLOUD_PROJECT", "shuttle-system-487204")
-                db_url = f"https://{project_id}-default-rtdb.asia-southeast1.firebasedatabase.app/"
-            firebase_admin.initialize_app(cred, {"databaseURL": db_url})
-        try:
-            path_history_ref = db.reference("/current_trip_path_history")
-            path_history_ref.set([])
-        except Exception:
-            pass
-        db.reference("/current_trip_id").set("")
-        db.reference("/current_trip_route").set({})
-        db.reference("/current_trip_status").set("ended")
-        db.reference("/current_trip_path_history").set([])
-        try:
+        ws = open_ws(SHEET_NAME_SYSTEM)
+        e19 = (ws.acell("E19").value or "").strip().lower()
+        return e19 in ("true", "t", "yes", "1")
+    except Exception:
+        return True
+
+def _io_result(future, timeout_s: float, default: Any, label: str) -> Any:
+    """等待並行 I/O 結果；逾時或失敗時返回預設值（背景工作仍會繼續完成）"""
+    try:
+        return future.result(timeout=timeout_s)
+    except FuturesTimeoutError:
+        log.warning(f"[io] {label} timeout after {timeout_s}s")
+    except Exception as e:
+        log.warning(f"[io] {label} failed: {type(e).__name__}: {e}")
+    return default
+
+def _complete_trip_rtdb(expected_trip_id: Optional[str] = None) -> bool:
+    """RTDB end 轉換；返回 True 表示這次呼叫結束了行程"""
+    if not _init_firebase():
+        return False
+    last_trip_datetime = None
+    try:
+        # 以狀態機的 state 為準；尚未啟用狀態機時才讀根目錄
+        last_trip_datetime = db.reference("/current_trip_fsm/state/current_trip_datetime").get()
+        if last_trip_datetime is None and db.reference("/current_trip_fsm/state/current_trip_status").get() is None:
             last_trip_datetime = db.reference("/current_trip_datetime").get()
-            if last_trip_datetime:
-                db.reference("/last_trip_datetime").set(last_trip_datetime)
-        except Exception:
-            pass
-        db.reference("/current_trip_datetime").set("")
-        db.reference("/current_trip_stations").set({})
     except Exception:
         pass
+    return _apply_trip_transition("end", _trip_end_updates(last_trip_datetime), trip_id=expected_trip_id) is not None
+
+def auto_complete_trip(trip_id: str = None, main_datetime: str = None, only_if_current: bool = False):
+    """
+    結束行程（RTDB end 轉換成功後，車次管理表標記已結束）
+    only_if_current：排程觸發時使用，只有 RTDB 目前行程仍為 trip_id 時才結束，避免誤結束之後開始的行程
+    """
+    if not trip_id and not main_datetime:
+        return False
+    _cancel_trip_shutdown(trip_id)
+    main_dt_str = main_datetime or trip_id
+    dt = _parse_main_dt(main_dt_str)
+    rtdb_future = IO_EXECUTOR.submit(_complete_trip_rtdb, trip_id if only_if_current else None)
+    ended = _io_result(rtdb_future, TRIP_IO_TIMEOUT_SECONDS, False, "complete_trip.rtdb")
+    # 狀態機拒絕（行程已結束或已換成其他行程）時不寫車次管理表
+    if ended and dt:
+        sheet_future = IO_EXECUTOR.submit(_update_trip_mgmt_status, dt, "已結束")
+        _io_result(sheet_future, TRIP_IO_TIMEOUT_SECONDS, False, "complete_trip.sheet")
+    with ACTIVE_TRIP_LOCK:
+        held_trip_id = ACTIVE_TRIP_STATE.trip_id if ACTIVE_TRIP_STATE is not None else None
+    if not only_if_current or held_trip_id in (None, trip_id):
+        _end_active_trip_state()
     return True
 
 # ========== Driver API2 端點 ==========
@@ -2945,8 +5632,9 @@ def update_driver_location(loc: DriverLocation):
             ref.set(location_data)
             if loc.trip_id:
                 try:
-                    current_trip_id = db.reference("/current_trip_id").get()
-                    if current_trip_id == loc.trip_id:
+                    trip_snapshot = _read_trip_snapshot()
+                    _check_trip_deadline(trip_snapshot)
+                    if trip_snapshot.get("current_trip_id") == loc.trip_id:
                         path_history_ref = db.reference("/current_trip_path_history")
                         current_history = path_history_ref.get() or []
                         now_ts = int(time.time() * 1000)
@@ -2974,18 +5662,6 @@ def update_driver_location(loc: DriverLocation):
                     check_station_arrival(loc.lat, loc.lng, loc.trip_id)
                 except Exception:
                     pass
-            try:
-                trip_status = db.reference("/current_trip_status").get()
-                trip_start_time = db.reference("/current_trip_start_time").get()
-                trip_datetime = db.reference("/current_trip_datetime").get()
-                trip_id_ref = db.reference("/current_trip_id").get()
-                if trip_status == "active" and trip_start_time:
-                    now_ms = int(time.time() * 1000)
-                    elapsed_ms = now_ms - int(trip_start_time)
-                    if elapsed_ms >= AUTO_SHUTDOWN_MS:
-                        auto_complete_trip(trip_id=trip_id_ref or "", main_datetime=trip_datetime or "")
-            except Exception:
-                pass
     except Exception as e:
         log.error(f"Unexpected error in update_driver_location: {e}", exc_info=True)
     return {"status": "ok", "received": loc}
@@ -3015,33 +5691,88 @@ def get_driver_location():
         return {"lat": 0, "lng": 0, "timestamp": 0, "status": "error", "error_detail": str(e), "hint": "Check Cloud Run logs or FIREBASE_RTDB_URL env var."}
     return {"lat": 0, "lng": 0, "timestamp": 0, "status": "firebase_not_initialized"}
 
-@app.get("/api/driver/data", response_model=DriverAllData)
-def driver_get_all_data():
-    values, hmap = _get_sheet_data_main()
-    trips, trip_passengers, passenger_list = build_all_driver_data_optimized(values, hmap)
-    return DriverAllData(trips=trips, trip_passengers=trip_passengers, passenger_list=passenger_list)
-
-@app.get("/api/driver/trips", response_model=List[DriverTrip])
-def driver_get_trips():
-    values, hmap = _get_sheet_data_main()
-    return build_driver_trips(values, hmap)
-
-@app.get("/api/driver/trip_passengers", response_model=List[DriverPassenger])
-def driver_get_trip_passengers(trip_id: str = Query(..., description="主班次時間原始字串，例如 2025/12/08 18:30")):
-    values, hmap = _get_sheet_data_main()
-    return build_driver_trip_passengers(values, hmap, trip_id=trip_id)
-
-@app.get("/api/driver/passenger_list", response_model=List[DriverAllPassenger])
-def driver_get_passenger_list():
-    values, hmap = _get_sheet_data_main()
-    return build_driver_all_passengers(values, hmap)
+@app.get("/api/driver/data", response_class=Response, responses=_json_responses(DriverAllData))
+def driver_get_all_data(request: Request, since_version: Optional[str] = Query(None, description="上次取得的 version；提供時只返回差量")):
+    """
+    完整回應附帶 version；帶 since_version 且該版本仍在歷史中時，返回
+    {"version", "since_version", "delta": true, "trips" / "trip_passengers" / "passenger_list": {"upserted": {key: item}, "removed": [key]}}
+    版本已不在歷史中時退回完整回應
+    """
+    views = _get_driver_views()
+    if since_version:
+        base = _driver_views_base(since_version)
+        if base is not None:
+            return _conditional_response(request, _strong_etag(f"{views.version}.d.{since_version}"), lambda: views.delta_json(since_version, base))
+    return _conditional_response(request, _strong_etag(views.version), views.data_json)
+
+@app.get("/api/driver/trips", response_class=Response, responses=_json_responses(List[DriverTrip]))
+def driver_get_trips(request: Request):
+    views = _get_driver_views()
+    return _conditional_response(request, _strong_etag(f"{views.version}.trips"), views.trips_json)
+
+@app.get("/api/driver/trip_passengers", response_class=Response, responses=_json_responses(List[DriverPassenger]))
+def driver_get_trip_passengers(request: Request, trip_id: str = Query(..., description="主班次時間原始字串，例如 2025/12/08 18:30")):
+    views = _get_driver_views()
+    trip_key = hashlib.blake2b(trip_id.encode("utf-8"), digest_size=6).hexdigest()
+    return _conditional_response(request, _strong_etag(f"{views.version}.tp.{trip_key}"), lambda: views.trip_passengers_json(trip_id))
+
+@app.get("/api/driver/manifest")
+def driver_get_manifest(request: Request, trip_id: str = Query(..., description="主班次時間原始字串，例如 2025/12/08 18:30")):
+    """
+    離線核銷名單：用戶端在本機以 QR 內容的 SHA-256 查驗，結果再經 /api/driver/checkin_batch 同步
+    設定 MANIFEST_SIGNING_KEY 時，X-Manifest-Signature 為 body 原始位元組的 HMAC-SHA256（v1=hex），304 也附帶；
+    ETag 與司機視圖版本及子票快照版本綁定，兩者皆未變更時 304
+    """
+    views = _get_driver_views()
+    sub_snapshot = _get_sub_ticket_snapshot()
+    trip_key = hashlib.blake2b(trip_id.encode("utf-8"), digest_size=6).hexdigest()
+    # 名單在同一視圖與子票快照內只建一次；304 也需要簽章，故先取得
+    manifest = views.trip_manifest(trip_id, sub_snapshot)
+    if manifest is None:
+        raise HTTPException(status_code=404, detail="找不到此班次的乘客")
+    body, signature = manifest
+    response = _conditional_response(request, _strong_etag(f"{views.version}.{sub_snapshot['version']}.mf.{trip_key}"), body)
+    if signature is not None:
+        response.headers["X-Manifest-Signature"] = signature
+    return response
+
+@app.get("/api/driver/passenger_list", response_class=Response, responses=_json_responses(List[DriverAllPassenger]))
+def driver_get_passenger_list(request: Request):
+    views = _get_driver_views()
+    return _conditional_response(request, _strong_etag(f"{views.version}.pl"), views.passenger_list_json)
+
+CHECKIN_BATCH_MAX_SCANS = 200
+CHECKIN_IDEMPOTENCY_TTL_SECONDS = 24 * 3600
+CHECKIN_CLIENT_TS_MAX_SKEW_SECONDS = 300
+CHECKIN_CLIENT_TS_MAX_AGE_SECONDS = 6 * 3600
+# 批次核銷的冪等快取：idempotency_key → 第一次處理的結果，重送時直接回覆
+CHECKIN_IDEMPOTENCY = TTLResultCache(CHECKIN_IDEMPOTENCY_TTL_SECONDS, max_entries=20000)
+
+def _client_scan_time(client_ts_ms: Optional[float], now: datetime) -> datetime:
+    """離線暫存的掃碼以用戶端掃碼時間判斷班次時間窗；缺少、超前伺服器或過舊的時間改用伺服器時間"""
+    if client_ts_ms is None:
+        return now
+    try:
+        scanned_at = datetime.fromtimestamp(client_ts_ms / 1000.0)
+    except (OverflowError, OSError, ValueError):
+        return now
+    skew = (scanned_at - now).total_seconds()
+    if skew > CHECKIN_CLIENT_TS_MAX_SKEW_SECONDS or -skew > CHECKIN_CLIENT_TS_MAX_AGE_SECONDS:
+        return now
+    return min(scanned_at, now)
+
+def _apply_checkin_writes(values: List[List[str]], hmap: Dict[str, int], writes: Dict[int, Tuple[str, Dict[str, str]]]) -> None:
+    """合併寫回舊格式核銷；直接寫入成功時修補快照，排入待寫入佇列時由佇列提供狀態"""
+    if not writes:
+        return
+    if _write_booking_rows(writes, hmap):
+        _patch_main_snapshot(values, hmap, {rowno: updates for rowno, (_, updates) in writes.items()})
 
-@app.post("/api/driver/checkin", response_model=DriverCheckinResponse)
-def api_driver_checkin(req: DriverCheckinRequest):
-    code = (req.qrcode or "").strip()
-    if not code:
-        raise HTTPException(400, "缺少 qrcode")
-    
+def _process_checkin_scan(code: str, values: List[List[str]], hmap: Dict[str, int], scanned_at: datetime, writes: Dict[int, Tuple[str, Dict[str, str]]]) -> DriverCheckinResponse:
+    """
+    以同一份主表快照驗證並核銷一筆掃碼
+    子票核銷直接進 CHECKIN_CACHE；舊格式需寫回的欄位加入 writes（列號 → (預約編號, 欄位值)），由呼叫端合併寫回
+    """
     # 解析 QR Code
     qr_info = _parse_qr_code(code)
     if not qr_info:
@@ -3050,17 +5781,11 @@ def api_driver_checkin(req: DriverCheckinRequest):
     booking_id = qr_info["booking_id"]
     sub_index = qr_info.get("sub_index", 0)
     
-    # 查找 Sheet 中的預約（使用快取）
-    values, hmap = _get_sheet_data_main()
-    ws = open_ws(SHEET_NAME_MAIN)  # 仍需要 ws 對象用於更新
-    if "QRCode編碼" not in hmap:
-        raise HTTPException(500, "主表缺少『QRCode編碼』欄位")
-    
     # 根據是否為子票選擇查找方式
     rowno = None
     if sub_index > 0:
-        # 子票：在 QRCode編碼（JSON）中查找
-        rowno = _find_qrcode_row_json(values, hmap, booking_id, sub_index)
+        # 子票：在子票表中查找
+        rowno = _find_sub_ticket_row(values, hmap, booking_id, sub_index)
     else:
         # 舊格式：在 QRCode編碼（字符串）中查找
         rowno = _find_qrcode_row(values, hmap, code)
@@ -3088,11 +5813,10 @@ def api_driver_checkin(req: DriverCheckinRequest):
         log.warning(f"api_driver_checkin: 無法解析主班次時間: {main_raw}, booking_id: {booking_id}")
         return DriverCheckinResponse(status="error", message=f"主班次時間格式錯誤：{main_raw}", booking_id=booking_id or None)
     
-    # 時間範圍檢查
-    now = _tz_now()
-    diff_sec = (now - main_dt).total_seconds()
-    limit_before = 30 * 60
-    limit_after = 60 * 60
+    # 時間範圍檢查（以掃碼當下的時間判斷）
+    diff_sec = (scanned_at - main_dt).total_seconds()
+    limit_before = CHECKIN_WINDOW_BEFORE_SECONDS
+    limit_after = CHECKIN_WINDOW_AFTER_SECONDS
     if diff_sec > limit_after:
         pax_str = getv("確認人數") or getv("預約人數") or "1"
         pax = _safe_int(pax_str, 1)
@@ -3111,8 +5835,8 @@ def api_driver_checkin(req: DriverCheckinRequest):
     sub_ticket_pax = 0
     
     if sub_index > 0:
-        # 子票核銷：從 Sheet JSON 讀取子票信息
-        sub_tickets = _get_sub_tickets_from_sheet(booking_id, values, hmap)
+        # 子票核銷：從子票表讀取子票信息
+        sub_tickets = _get_sub_tickets(booking_id)
         target_ticket = None
         for t in sub_tickets:
             if t.get("sub_ticket_index") == sub_index:
@@ -3123,14 +5847,12 @@ def api_driver_checkin(req: DriverCheckinRequest):
             return DriverCheckinResponse(status="not_found", message="找不到對應的子票", booking_id=booking_id or None)
         
         # 檢查是否已核銷（檢查快取和 Sheet）
-        global CHECKIN_CACHE, CHECKIN_CACHE_LOCK
-        with CHECKIN_CACHE_LOCK:
-            cache_data = CHECKIN_CACHE.get(booking_id, {})
-            already_checked = sub_index in cache_data or target_ticket.get("status") == "checked_in"
+        cache_data = _pending_checkins_for(booking_id)
+        already_checked = sub_index in cache_data or target_ticket.get("status") == "checked_in"
         
         if already_checked:
             # 已核銷，返回當前狀態
-            status_text, checked_pax, total_pax = _calculate_mother_ticket_status(booking_id, values, hmap)
+            status_text, checked_pax, total_pax = _calculate_mother_ticket_status(booking_id)
             sub_ticket_pax = target_ticket.get("sub_ticket_pax", 0)
             return DriverCheckinResponse(
                 status="already_checked_in",
@@ -3147,9 +5869,9 @@ def api_driver_checkin(req: DriverCheckinRequest):
             )
         
         # 更新到內存快取（批量寫回）
-        if not _update_sub_ticket_status_in_cache(booking_id, sub_index, "driver"):
+        if not _update_sub_ticket_status_in_cache(booking_id, sub_index, "driver", checked_at=scanned_at.strftime("%Y-%m-%d %H:%M:%S")):
             # 如果已經在快取中，返回已核銷
-            status_text, checked_pax, total_pax = _calculate_mother_ticket_status(booking_id, values, hmap)
+            status_text, checked_pax, total_pax = _calculate_mother_ticket_status(booking_id)
             sub_ticket_pax = target_ticket.get("sub_ticket_pax", 0)
             return DriverCheckinResponse(
                 status="already_checked_in",
@@ -3166,15 +5888,14 @@ def api_driver_checkin(req: DriverCheckinRequest):
             )
         
         # 計算總狀態（包含快取中的狀態）
-        status_text, checked_pax, total_pax = _calculate_mother_ticket_status(booking_id, values, hmap)
+        status_text, checked_pax, total_pax = _calculate_mother_ticket_status(booking_id)
         ride_status = status_text
         sub_ticket_pax = target_ticket.get("sub_ticket_pax", 0)
-        
-        # 觸發異步刷新快取（不阻塞響應）
-        threading.Thread(target=_flush_checkin_cache, daemon=True).start()
     else:
         # 舊格式（未分票）：直接更新 Sheet
-        ride_status_current = getv("乘車狀態").strip()
+        # 快照不含同批次已排定與降級模式下尚未寫回的核銷，先看這兩處
+        staged = writes.get(rowno, ("", {}))[1]
+        ride_status_current = staged.get("乘車狀態") or _pending_updates_for(booking_id).get("乘車狀態") or getv("乘車狀態").strip()
         if ride_status_current and ("已上車" in ride_status_current or "上車" in ride_status_current):
             pax_str = getv("確認人數") or getv("預約人數") or "1"
             pax = _safe_int(pax_str, 1)
@@ -3182,7 +5903,7 @@ def api_driver_checkin(req: DriverCheckinRequest):
         
         updates["乘車狀態"] = "已上車"
         if "最後操作時間" in hmap:
-            updates["最後操作時間"] = _tz_now_str() + " 已上車(司機)"
+            updates["最後操作時間"] = scanned_at.strftime("%Y-%m-%d %H:%M:%S") + " 已上車(司機)"
         
         pax_str = getv("確認人數") or getv("預約人數") or "1"
         sub_ticket_pax = _safe_int(pax_str, 1)
@@ -3190,17 +5911,8 @@ def api_driver_checkin(req: DriverCheckinRequest):
         checked_pax = sub_ticket_pax
         ride_status = "已上車"
     
-    # 批量更新 Sheet
     if updates:
-        data = []
-        for col_name, val in updates.items():
-            if col_name in hmap:
-                ci = hmap[col_name]
-                data.append({"range": gspread.utils.rowcol_to_a1(rowno, ci), "values": [[val]]})
-        if data:
-            ws.batch_update(data, value_input_option="USER_ENTERED")
-    
-    _invalidate_sheet_cache()
+        writes[rowno] = (booking_id, updates)
     
     # 返回詳細狀態
     return DriverCheckinResponse(
@@ -3217,115 +5929,106 @@ def api_driver_checkin(req: DriverCheckinRequest):
         ride_status=ride_status if ride_status else None
     )
 
+@app.post("/api/driver/checkin", response_model=DriverCheckinResponse)
+@sheets_priority(SHEETS_PRIORITY_CHECKIN)
+def api_driver_checkin(req: DriverCheckinRequest):
+    code = (req.qrcode or "").strip()
+    if not code:
+        raise HTTPException(400, "缺少 qrcode")
+    
+    # 查找 Sheet 中的預約（使用快取）
+    values, hmap = _get_sheet_data_main()
+    if "QRCode編碼" not in hmap:
+        raise HTTPException(500, "主表缺少『QRCode編碼』欄位")
+    
+    writes: Dict[int, Tuple[str, Dict[str, str]]] = {}
+    resp = _process_checkin_scan(code, values, hmap, _tz_now(), writes)
+    _apply_checkin_writes(values, hmap, writes)
+    if resp.status == "success" and resp.sub_index:
+        # 觸發異步刷新快取（不阻塞響應）
+        threading.Thread(target=_flush_checkin_cache, daemon=True).start()
+    return resp
+
+@app.post("/api/driver/checkin_batch", response_model=DriverCheckinBatchResponse)
+@sheets_priority(SHEETS_PRIORITY_CHECKIN)
+def api_driver_checkin_batch(req: DriverCheckinBatchRequest):
+    """
+    離線暫存掃碼的批次核銷：依順序以同一份快照驗證，舊格式核銷合併為一次寫回，返回逐筆結果
+    同一 idempotency_key 重送時回覆第一次的結果，不重複核銷
+    """
+    if len(req.scans) > CHECKIN_BATCH_MAX_SCANS:
+        raise HTTPException(400, f"單次最多 {CHECKIN_BATCH_MAX_SCANS} 筆掃碼")
+    values, hmap = _get_sheet_data_main()
+    if "QRCode編碼" not in hmap:
+        raise HTTPException(500, "主表缺少『QRCode編碼』欄位")
+    
+    now = _tz_now()
+    writes: Dict[int, Tuple[str, Dict[str, str]]] = {}
+    results: List[DriverCheckinScanResult] = []
+    fresh: Dict[str, DriverCheckinResponse] = {}
+    for scan in req.scans:
+        key = scan.idempotency_key.strip()
+        previous = fresh.get(key) if key in fresh else CHECKIN_IDEMPOTENCY.get(key)
+        if previous is not None:
+            result = previous if isinstance(previous, DriverCheckinResponse) else DriverCheckinResponse(**previous)
+            results.append(DriverCheckinScanResult(idempotency_key=key, replayed=True, result=result))
+            continue
+        code = (scan.qrcode or "").strip()
+        if code:
+            result = _process_checkin_scan(code, values, hmap, _client_scan_time(scan.client_ts, now), writes)
+        else:
+            result = DriverCheckinResponse(status="error", message="缺少 qrcode")
+        fresh[key] = result
+        results.append(DriverCheckinScanResult(idempotency_key=key, replayed=False, result=result))
+    
+    _apply_checkin_writes(values, hmap, writes)
+    # 寫回成功（或已排入待寫入佇列）後才記錄冪等結果，寫回失敗時用戶端可用同一組 key 重送
+    for key, result in fresh.items():
+        CHECKIN_IDEMPOTENCY.put(key, result.model_dump())
+    if any(r.status == "success" and r.sub_index for r in fresh.values()):
+        threading.Thread(target=_flush_checkin_cache, daemon=True).start()
+    return DriverCheckinBatchResponse(results=results)
+
 @app.post("/api/driver/no_show")
+@sheets_priority(SHEETS_PRIORITY_CHECKIN)
 def api_driver_no_show(req: BookingIdRequest):
     values, hmap = _get_sheet_data_main()
-    ws = open_ws(SHEET_NAME_MAIN)
     target_rowno = _find_booking_row(values, hmap, req.booking_id)
     if not target_rowno:
         raise HTTPException(status_code=404, detail="找不到對應預約編號")
-    data = []
-    if "乘車狀態" in hmap:
-        data.append({"range": gspread.utils.rowcol_to_a1(target_rowno, hmap["乘車狀態"]), "values": [["No-show"]]})
-    if "最後操作時間" in hmap:
-        data.append({"range": gspread.utils.rowcol_to_a1(target_rowno, hmap["最後操作時間"]), "values": [[_tz_now_str() + " No-show(司機)"]]})
-    if data:
-        ws.batch_update(data, value_input_option="USER_ENTERED")
+    updates = {"乘車狀態": "No-show", "最後操作時間": _tz_now_str() + " No-show(司機)"}
+    written = _write_booking_updates(target_rowno, req.booking_id, updates, hmap)
     _invalidate_sheet_cache()
-    return {"status": "success"}
+    return {"status": "success", "queued": not written}
 
 @app.post("/api/driver/manual_boarding")
+@sheets_priority(SHEETS_PRIORITY_CHECKIN)
 def api_driver_manual_boarding(req: BookingIdRequest):
     values, hmap = _get_sheet_data_main()
-    ws = open_ws(SHEET_NAME_MAIN)
     target_rowno = _find_booking_row(values, hmap, req.booking_id)
     if not target_rowno:
         raise HTTPException(status_code=404, detail="找不到對應預約編號")
-    data = []
-    if "乘車狀態" in hmap:
-        data.append({"range": gspread.utils.rowcol_to_a1(target_rowno, hmap["乘車狀態"]), "values": [["已上車"]]})
-    if "最後操作時間" in hmap:
-        data.append({"range": gspread.utils.rowcol_to_a1(target_rowno, hmap["最後操作時間"]), "values": [[_tz_now_str() + " 人工驗票(司機)"]]})
-    if data:
-        ws.batch_update(data, value_input_option="USER_ENTERED")
+    updates = {"乘車狀態": "已上車", "最後操作時間": _tz_now_str() + " 人工驗票(司機)"}
+    written = _write_booking_updates(target_rowno, req.booking_id, updates, hmap)
     _invalidate_sheet_cache()
-    return {"status": "success"}
+    return {"status": "success", "queued": not written}
 
 @app.post("/api/driver/trip_status")
 def api_driver_trip_status(req: TripStatusRequest):
-    sheet_name = "車次管理(櫃台)"
-    try:
-        ws = open_ws(sheet_name)
-    except (gspread.exceptions.SpreadsheetNotFound, gspread.exceptions.WorksheetNotFound):
-        ws = open_ws("車次管理(備品)")
-    except Exception:
-        ws = open_ws("車次管理(備品)")
-    headers = ws.row_values(6)
-    headers = [(h or "").strip() for h in headers]
-    def hidx(name: str) -> int:
-        try:
-            return headers.index(name)
-        except ValueError:
-            return -1
-    idx_date = hidx("日期")
-    idx_time = hidx("時間")
-    if idx_time < 0:
-        idx_time = hidx("班次")
-    idx_status = hidx("出車狀態")
-    idx_last = hidx("最後更新")
-    if min(idx_date, idx_time, idx_status, idx_last) < 0:
-        raise HTTPException(status_code=400, detail="表頭缺少必要欄位")
     raw = req.main_datetime.strip()
     parts = raw.split(" ")
     if len(parts) < 2:
         raise HTTPException(status_code=400, detail="主班次時間格式錯誤")
-    target_date, target_time = parts[0], parts[1]
-    def norm_dates(d: str) -> list:
-        d = d.strip()
-        if "-" in d:
-            y, m, day = d.split("-")
-        else:
-            y, m, day = d.split("/")
-        m2 = str(m).zfill(2)
-        d2 = str(day).zfill(2)
-        return [f"{y}/{m2}/{d2}", f"{y}-{m2}-{d2}"]
-    def norm_time(t: str) -> list:
-        t = t.strip()
-        parts = t.split(":")
-        if len(parts) == 1:
-            return [t]
-        h = parts[0]
-        mm = parts[1] if len(parts) > 1 else "00"
-        ss = parts[2] if len(parts) > 2 else None
-        h2 = str(h).zfill(2)
-        res = [f"{h2}:{mm}", f"{int(h)}:{mm}"]
-        if ss is not None:
-            res.append(f"{h2}:{mm}:{ss}")
-            res.append(f"{int(h)}:{mm}:{ss}")
-        return res
-    t_dates = norm_dates(target_date)
-    t_times = norm_time(target_time)
-    values = ws.get_all_values()
-    target_rowno: Optional[int] = None
-    for i in range(6, len(values)):
-        row = values[i]
-        d = (row[idx_date] if idx_date < len(row) else "").strip()
-        t_raw = (row[idx_time] if idx_time < len(row) else "").strip()
-        try:
-            rp = t_raw.split(":")
-            t_norm = f"{str(rp[0]).zfill(2)}:{rp[1]}" if len(rp) >= 2 else t_raw
-        except Exception:
-            t_norm = t_raw
-        if (d in t_dates) and (t_raw in t_times or t_norm in t_times):
-            target_rowno = i + 1
-            break
+    key = _trip_mgmt_key(parts[0], parts[1])
+    if not key:
+        raise HTTPException(status_code=400, detail="主班次時間格式錯誤")
+    snapshot, target_rowno = _find_trip_mgmt_row(key)
+    if min(snapshot["cols"].values()) < 0:
+        raise HTTPException(status_code=400, detail="表頭缺少必要欄位")
     if not target_rowno:
         raise HTTPException(status_code=404, detail="找不到對應主班次時間")
-    now_text = _tz_now().strftime("%Y/%m/%d %H:%M")
-    data = [{"range": gspread.utils.rowcol_to_a1(target_rowno, idx_status + 1), "values": [[req.status]]}, {"range": gspread.utils.rowcol_to_a1(target_rowno, idx_last + 1), "values": [[now_text]]}]
-    ws.batch_update(data, value_input_option="USER_ENTERED")
-    _invalidate_ws_cache("車次管理(櫃台)")
-    _invalidate_ws_cache("車次管理(備品)")
+    if not _write_trip_mgmt_status(snapshot, target_rowno, req.status, key):
+        raise HTTPException(status_code=404, detail="找不到對應主班次時間")
     return {"status": "success"}
 
 @app.post("/api/driver/qrcode_info", response_model=QrInfoResponse)
@@ -3347,158 +6050,50 @@ def api_driver_google_trip_start(req: GoogleTripStartRequest):
     if not dt:
         raise HTTPException(status_code=400, detail="主班次時間格式錯誤")
     trip_id = dt.strftime("%Y/%m/%d %H:%M")
-    ws2 = None
-    target_rowno: Optional[int] = None
-    try:
-        try:
-            ws2 = open_ws("車次管理(櫃台)")
-        except Exception:
-            ws2 = open_ws("車次管理(備品)")
-        headers = ws2.row_values(6)
-        headers = [(h or "").strip() for h in headers]
-        def hidx(name: str) -> int:
-            try:
-                return headers.index(name)
-            except ValueError:
-                return -1
-        idx_date = hidx("日期")
-        idx_time = hidx("班次") if hidx("時間") < 0 else hidx("時間")
-        idx_status = hidx("出車狀態")
-        idx_last = hidx("最後更新")
-        target_date = dt.strftime("%Y/%m/%d")
-        alt_date = dt.strftime("%Y-%m-%d")
-        t1 = dt.strftime("%H:%M")
-        t2 = dt.strftime("%-H:%M") if hasattr(dt, "strftime") else t1
-        values = ws2.get_all_values()
-        for i in range(6, len(values)):
-            row = values[i]
-            d = (row[idx_date] if idx_date >= 0 and idx_date < len(row) else "").strip()
-            t_raw = (row[idx_time] if idx_time >= 0 and idx_time < len(row) else "").strip()
-            try:
-                rp = t_raw.split(":")
-                t_norm = f"{str(rp[0]).zfill(2)}:{rp[1]}" if len(rp) >= 2 else t_raw
-            except Exception:
-                t_norm = t_raw
-            if (d in (target_date, alt_date)) and (t_raw in (t1, t2) or t_norm in (t1, t2)):
-                target_rowno = i + 1
-                break
-        if target_rowno and idx_status >= 0 and idx_last >= 0:
-            now_text = _tz_now().strftime("%Y/%m/%d %H:%M")
-            update_data = [{"range": gspread.utils.rowcol_to_a1(target_rowno, idx_status + 1), "values": [["已發車"]]}, {"range": gspread.utils.rowcol_to_a1(target_rowno, idx_last + 1), "values": [[now_text]]}]
-            ws2.batch_update(update_data, value_input_option="USER_ENTERED")
-            _invalidate_ws_cache("車次管理(櫃台)")
-            _invalidate_ws_cache("車次管理(備品)")
-    except Exception:
-        pass
-    if req.driver_role == 'desk':
-        return GoogleTripStartResponse(trip_id=trip_id, share_url=None, stops=None)
-    try:
-        ws = open_ws(SHEET_NAME_SYSTEM)
-        e19 = (ws.acell("E19").value or "").strip().lower()
-        enabled = e19 in ("true", "t", "yes", "1")
-    except Exception:
-        enabled = True
-    if not enabled:
-        return GoogleTripStartResponse(trip_id=trip_id, share_url=None, stops=None)
-    STATION_MAP = {"1. 福泰大飯店 (去)": "福泰大飯店 Forte Hotel", "2. 南港捷運站": "南港展覽館捷運站 Nangang Exhibition Center - MRT Exit 3", "3. 南港火車站": "南港火車站 Nangang Train Station", "4. LaLaport 購物中心": "LaLaport Shopping Park", "5. 福泰大飯店 (回)": "福泰大飯店(回) Forte Hotel (Back)"}
     stops_names: List[str] = []
     if req.stops and len(req.stops) > 0:
         for app_station in req.stops:
-            mapped = STATION_MAP.get(app_station, app_station)
+            mapped = TRIP_STATION_MAP.get(app_station, app_station)
             if mapped:
                 stops_names.append(mapped)
     else:
-        STATIONS = ["福泰大飯店 Forte Hotel", "南港展覽館捷運站 Nangang Exhibition Center - MRT Exit 3", "南港火車站 Nangang Train Station", "LaLaport Shopping Park", "福泰大飯店(回) Forte Hotel (Back)"]
-        stops_names = STATIONS
-    COORDS = {"福泰大飯店 Forte Hotel": {"lat": 25.054964953523683, "lng": 121.63077275881052}, "南港展覽館捷運站 Nangang Exhibition Center - MRT Exit 3": {"lat": 25.055017007293404, "lng": 121.61818547695053}, "南港火車站 Nangang Train Station": {"lat": 25.052822671279454, "lng": 121.60771823129633}, "LaLaport Shopping Park": {"lat": 25.05629820919232, "lng": 121.61700981622211}, "福泰大飯店(回) Forte Hotel (Back)": {"lat": 25.054800375417987, "lng": 121.63117576557792}}
-    stops: List[Dict[str, float]] = []
-    for name in stops_names:
-        coord = COORDS.get(name)
-        if coord:
-            stops.append({"lat": coord["lat"], "lng": coord["lng"], "name": name})
-    polyline_obj: Dict[str, Any] = {}
-    try:
-        api_key = os.environ.get("GOOGLE_MAPS_API_KEY")
-        if api_key and len(stops) >= 2:
-            origin = f"{stops[0]['lat']},{stops[0]['lng']}"
-            destination = f"{stops[-1]['lat']},{stops[-1]['lng']}"
-            if len(stops) > 2:
-                wp = "|".join([f"{s['lat']},{s['lng']}" for s in stops[1:-1]])
-            else:
-                wp = ""
-            params = {"origin": origin, "destination": destination, "mode": "driving", "key": api_key}
-            if wp:
-                params["waypoints"] = wp
-            url = "https://maps.googleapis.com/maps/api/directions/json?" + urllib.parse.urlencode(params)
-            with urllib.request.urlopen(url, timeout=10) as resp:
-                data = json.loads(resp.read().decode("utf-8"))
-            if data.get("status") == "OK":
-                routes = data.get("routes", [])
-                if routes:
-                    points = routes[0].get("overview_polyline", {}).get("points", "")
-                    def _decode_polyline(poly: str) -> List[Dict[str, float]]:
-                        coords: List[Dict[str, float]] = []
-                        index, lat, lng = 0, 0, 0
-                        while index < len(poly):
-                            result, shift = 0, 0
-                            while True:
-                                b = ord(poly[index]) - 63
-                                index += 1
-                                result |= (b & 0x1f) << shift
-                                shift += 5
-                                if b < 0x20:
-                                    break
-                            dlat = ~(result >> 1) if (result & 1) else (result >> 1)
-                            lat += dlat
-                            result, shift = 0, 0
-                            while True:
-                                b = ord(poly[index]) - 63
-                                index += 1
-                                result |= (b & 0x1f) << shift
-                                shift += 5
-                                if b < 0x20:
-                                    break
-                            dlng = ~(result >> 1) if (result & 1) else (result >> 1)
-                            lng += dlng
-                            coords.append({"lat": lat / 1e5, "lng": lng / 1e5})
-                        return coords
-                    path = _decode_polyline(points) if points else []
-                    polyline_obj = {"points": points, "path": path}
-    except Exception:
-        pass
+        stops_names = list(TRIP_STATIONS)
+    stops = _route_stops(stops_names)
+    # 車次管理表寫入、系統開關讀取、路線取得彼此獨立，並行執行；總耗時約等於最慢的一項
+    sheet_future = IO_EXECUTOR.submit(_update_trip_mgmt_status, dt, "已發車")
+    if req.driver_role == 'desk':
+        _io_result(sheet_future, TRIP_IO_TIMEOUT_SECONDS, False, "trip_start.sheet")
+        return GoogleTripStartResponse(trip_id=trip_id, share_url=None, stops=None)
+    enabled_future = IO_EXECUTOR.submit(_read_gps_system_enabled)
+    route_future = IO_EXECUTOR.submit(_get_route_polyline, stops)
+    enabled = _io_result(enabled_future, TRIP_IO_TIMEOUT_SECONDS, True, "trip_start.gps_enabled")
+    if not enabled:
+        _io_result(sheet_future, TRIP_IO_TIMEOUT_SECONDS, False, "trip_start.sheet")
+        return GoogleTripStartResponse(trip_id=trip_id, share_url=None, stops=None)
+    polyline_obj: Dict[str, Any] = _io_result(route_future, TRIP_IO_TIMEOUT_SECONDS, {}, "trip_start.route") or {}
     try:
-        if not firebase_admin._apps:
-            service_account_path = "service_account.json"
-            if os.path.exists(service_account_path):
-                cred = credentials.Certificate(service_account_path)
-            else:
-                cred = credentials.ApplicationDefault()
-            db_url = os.environ.get("FIREBASE_RTDB_URL")
-            if not db_url:
-                project_id = os.environ.get("GOOGLE_CLOUD_PROJECT", "shuttle-system-487204")
-                db_url = f"https://{project_id}-default-rtdb.asia-southeast1.firebasedatabase.app/"
-            firebase_admin.initialize_app(cred, {"databaseURL": db_url})
-        payload = {"stops": stops}
-        if polyline_obj:
-            payload["polyline"] = polyline_obj
-        try:
-            db.reference("/current_trip_id").set(trip_id)
-            db.reference("/current_trip_status").set("active")
-            db.reference("/current_trip_datetime").set(req.main_datetime)
-            db.reference("/current_trip_route").set(payload)
-            db.reference("/gps_system_enabled").set(enabled)
-            db.reference("/current_trip_start_time").set(int(time.time() * 1000))
-            db.reference("/current_trip_completed_stops").set([])
-            STATIONS = ["福泰大飯店 Forte Hotel", "南港展覽館捷運站 Nangang Exhibition Center - MRT Exit 3", "南港火車站 Nangang Train Station", "LaLaport Shopping Park", "福泰大飯店(回) Forte Hotel (Back)"]
-            stations_info = {"stops": stops_names, "all_stations": STATIONS}
-            db.reference("/current_trip_stations").set(stations_info)
+        if _init_firebase():
+            payload = {"stops": stops}
+            if polyline_obj:
+                payload["polyline"] = polyline_obj
+            updates: Dict[str, Any] = {
+                "current_trip_id": trip_id,
+                "current_trip_datetime": req.main_datetime,
+                "current_trip_route": payload,
+                "gps_system_enabled": enabled,
+                "current_trip_start_time": int(time.time() * 1000),
+                "current_trip_completed_stops": [],
+                "current_trip_eta": {},
+                "current_trip_stations": {"stops": stops_names, "all_stations": TRIP_STATIONS},
+            }
             if stops_names and len(stops_names) > 0:
-                first_stop = stops_names[0]
-                db.reference("/current_trip_station").set(first_stop)
-        except Exception:
-            pass
-    except Exception:
-        pass
+                updates["current_trip_station"] = stops_names[0]
+            if _apply_trip_transition("start", updates, trip_id=trip_id) is not None:
+                _schedule_trip_shutdown(trip_id, req.main_datetime, updates["current_trip_start_time"])
+    except Exception as e:
+        log.warning(f"[trip_start] rtdb update failed: {type(e).__name__}: {e}")
+    _set_active_trip_state(ActiveTripState(trip_id, stops_names, (polyline_obj or {}).get("path", [])))
+    _io_result(sheet_future, TRIP_IO_TIMEOUT_SECONDS, False, "trip_start.sheet")
     return GoogleTripStartResponse(trip_id=trip_id, share_url=None, stops=stops or None)
 
 @app.post("/api/driver/google/trip_complete")
@@ -3589,8 +6184,25 @@ def api_driver_update_station(req: UpdateStationRequest):
                 project_id = os.environ.get("GOOGLE_CLOUD_PROJECT", "shuttle-system-487204")
                 db_url = f"https://{project_id}-default-rtdb.asia-southeast1.firebasedatabase.app/"
             firebase_admin.initialize_app(cred, {"databaseURL": db_url})
-        db.reference("/current_trip_station").set(req.current_station)
-        return {"status": "success", "current_station": req.current_station}
+        version = _apply_trip_transition("station", {"current_trip_station": req.current_station}, trip_id=req.trip_id)
+        if version is None:
+            raise HTTPException(status_code=409, detail="行程未進行中，無法更新站點")
+        return {"status": "success", "current_station": req.current_station, "version": version}
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"更新站點失敗: {str(e)}")
 
+if __name__ == "__main__":
+    import sys
+    if len(sys.argv) > 1 and sys.argv[1] == "precompute_routes":
+        count = precompute_route_cache()
+        log.info(f"[route_cache] precompute done: {count}/{len(_route_sequences_to_precompute())}")
+        sys.exit(0 if count else 1)
+    if len(sys.argv) > 1 and sys.argv[1] == "bench_parse":
+        rows = int(sys.argv[2]) if len(sys.argv) > 2 else 50000
+        print(json.dumps(benchmark_main_dt_parsing(rows), ensure_ascii=False))
+    if len(sys.argv) > 1 and sys.argv[1] == "bench_serialize":
+        print(json.dumps(benchmark_driver_serialization(), ensure_ascii=False))
+    if len(sys.argv) > 1 and sys.argv[1] == "bench_arrival":
+        print(json.dumps(benchmark_station_arrival_payload(), ensure_ascii=False))
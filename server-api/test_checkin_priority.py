@@ -0,0 +1,92 @@
+import os
+import tempfile
+import time
+from unittest import mock
+
+os.environ.setdefault("SHUTTLE_STATE_DIR", tempfile.mkdtemp(prefix="shuttle-state-"))
+
+import server as S
+from fastapi.testclient import TestClient
+
+HEADERS = ["預約編號", "乘車狀態", "QRCode編碼", "主班次時間", "姓名", "確認人數", "上車地點", "下車地點", "房號", "最後操作時間"]
+
+
+class FakeSubTicketSheet:
+    def __init__(self, rows):
+        self.rows = rows
+
+    def get_all_values(self):
+        return [list(r) for r in self.rows]
+
+
+class RecordingTransport:
+    """記錄每個 Sheets 請求送出時的優先序"""
+
+    def __init__(self, sub_ws):
+        self.sub_ws = sub_ws
+        self.calls = []
+
+    def values_get(self, range_name):
+        self.calls.append(("values_get", S._SHEETS_PRIORITY.get()))
+        return [r[:2] for r in self.sub_ws.rows]
+
+    def values_batch_update(self, data, value_input_option="USER_ENTERED"):
+        self.calls.append(("values_batch_update", S._SHEETS_PRIORITY.get()))
+
+
+def test_endpoint_triggered_flush_uses_checkin_priority():
+    now = S._tz_now()
+    main_dt = now.strftime("%Y/%m/%d %H:%M")
+    values = [[""] * len(HEADERS) for _ in range(S.HEADER_ROW_MAIN - 1)] + [HEADERS]
+    values.append(["S1", "未上車", "", main_dt, "A", "2", "福泰大飯店 Forte Hotel", "", "301", ""])
+    hmap = {h: i + 1 for i, h in enumerate(HEADERS)}
+    sub_ws = FakeSubTicketSheet([
+        S.SUB_TICKET_HEADERS,
+        ["S1", "1", "1", "FT:S1:1:a", "not_checked_in", ""],
+        ["S1", "2", "1", "FT:S1:2:b", "not_checked_in", ""],
+    ])
+    transport = RecordingTransport(sub_ws)
+    S._store_main_snapshot(values, hmap, now)
+    S._last_flush_time = 0
+    # TestClient 未進入 with 區塊不會觸發啟動事件；比照啟動流程開啟核銷日誌
+    S._replay_checkin_journal()
+    with mock.patch.object(S, "open_ws", lambda name: sub_ws), \
+            mock.patch.object(S, "_get_sheets_transport", lambda: transport), \
+            mock.patch.object(S, "_get_sheet_data_main", lambda: (S.SHEET_CACHE["values"], S.SHEET_CACHE["header_map"])):
+        resp = TestClient(S.app).post("/api/driver/checkin", json={"qrcode": "FT:S1:2:b"})
+        assert resp.json()["status"] == "success"
+        deadline = time.time() + 5
+        while not any(name == "values_batch_update" for name, _ in transport.calls) and time.time() < deadline:
+            time.sleep(0.05)
+    assert transport.calls, "flush did not reach the transport"
+    assert ("values_batch_update", S.SHEETS_PRIORITY_CHECKIN) in transport.calls
+    assert all(priority == S.SHEETS_PRIORITY_CHECKIN for _, priority in transport.calls)
+
+
+def test_manifest_follows_sub_ticket_snapshot():
+    now = S._tz_now()
+    main_dt = now.strftime("%Y/%m/%d %H:%M")
+    values = [[""] * len(HEADERS) for _ in range(S.HEADER_ROW_MAIN - 1)] + [HEADERS]
+    values.append(["S2", "未上車", "", main_dt, "B", "2", "福泰大飯店 Forte Hotel", "", "302", ""])
+    hmap = {h: i + 1 for i, h in enumerate(HEADERS)}
+    S._store_main_snapshot(values, hmap, now)
+    snapshot = S._build_sub_ticket_snapshot([
+        S.SUB_TICKET_HEADERS,
+        ["S2", "1", "1", "FT:S2:1:a", "not_checked_in", ""],
+        ["S2", "2", "1", "FT:S2:2:b", "not_checked_in", ""],
+    ], now)
+    S._store_sub_ticket_snapshot(snapshot)
+    client = TestClient(S.app)
+    with mock.patch.object(S, "_get_sheet_data_main", lambda: (S.SHEET_CACHE["values"], S.SHEET_CACHE["header_map"])):
+        first = client.get("/api/driver/manifest", params={"trip_id": main_dt})
+        assert first.status_code == 200
+        etag = first.headers["ETag"]
+        assert client.get("/api/driver/manifest", params={"trip_id": main_dt}, headers={"If-None-Match": etag}).status_code == 304
+        # 核銷寫回只修補子票快照，主表不變
+        S._patch_sub_ticket_snapshot(snapshot, [(3, now.strftime("%Y-%m-%d %H:%M:%S"))])
+        second = client.get("/api/driver/manifest", params={"trip_id": main_dt}, headers={"If-None-Match": etag})
+    assert second.status_code == 200
+    assert second.headers["ETag"] != etag
+    assert second.content != first.content
+    tickets = second.json()["tickets"]
+    assert tickets[S._manifest_ticket_key("FT:S2:2:b")][3] == 1
@@ -1482,6 +1482,22 @@ function showSuccessAnimation() {
   }, 3000);
 }
 
+/* ====== 冪等金鑰（book / modify / delete） ====== */
+// 內容相同的重送沿用同一個 Idempotency-Key，後端直接回覆第一次成功的結果，不會重複預約或扣容量
+const pendingOpsKeys = {};
+function opsIdempotencyKey(action, body) {
+  const prev = pendingOpsKeys[action];
+  if (prev && prev.body === body) return prev.key;
+  const key = window.crypto && crypto.randomUUID
+    ? crypto.randomUUID()
+    : `${Date.now()}-${Math.random().toString(36).slice(2)}`;
+  pendingOpsKeys[action] = { key, body };
+  return key;
+}
+function clearOpsIdempotencyKey(action) {
+  delete pendingOpsKeys[action];
+}
+
 /* ====== 送出預約 ====== */
 let bookingSubmitting = false;
 async function submitBooking() {
@@ -1547,14 +1563,16 @@ async function submitBooking() {
   showVerifyLoading(true);
 
   try {
+    const body = JSON.stringify({ action: "book", data: payload });
     const res = await fetch(OPS_URL, {
       method: "POST",
       mode: "cors",
       headers: {
         "Content-Type": "application/json",
-        Accept: "application/json"
+        Accept: "application/json",
+        "Idempotency-Key": opsIdempotencyKey("book", body)
       },
-      body: JSON.stringify({ action: "book", data: payload })
+      body
     });
 
     let result = null;
@@ -1608,6 +1626,8 @@ async function submitBooking() {
       ? `${QR_ORIGIN}/api/qr/${encodeURIComponent(result.qr_content)}`
       : result.qr_url || "";
 
+    clearOpsIdempotencyKey("book");
+
     // 後端已經確認成功、寫進 Sheet，也在後端開始寄信
     // 前端這裡只負責顯示票卡
     currentBookingData = {
@@ -3165,16 +3185,20 @@ async function deleteOrder(bookingId) {
   showConfirmDelete(bookingId, async () => {
     showLoading(true);
     try {
+      const body = JSON.stringify({
+        action: "delete",
+        data: {
+          booking_id: bookingId,
+          lang: getCurrentLang()
+        }
+      });
       const r = await fetch(OPS_URL, {
         method: "POST",
-        headers: { "Content-Type": "application/json" },
-        body: JSON.stringify({
-          action: "delete",
-          data: {
-            booking_id: bookingId,
-            lang: getCurrentLang()      
-          }
-        })
+        headers: {
+          "Content-Type": "application/json",
+          "Idempotency-Key": opsIdempotencyKey("delete", body)
+        },
+        body
       });
       let j = null;
       try {
@@ -3183,6 +3207,7 @@ async function deleteOrder(bookingId) {
         throw new Error(t("serverResponseParseFailed"));
       }
       if (j && j.status === "success") {
+        clearOpsIdempotencyKey("delete");
         showSuccessAnimation();
         setTimeout(async () => {
           const qBookIdEl = getElement("qBookId");
@@ -3488,10 +3513,14 @@ async function openModifyPage({ row, bookingId, rb, date, pick, drop, time, pax
       };
 
       // 3️⃣ 呼叫後端做 modify
+      const body = JSON.stringify({ action: "modify", data: payload });
       const r = await fetch(OPS_URL, {
         method: "POST",
-        headers: { "Content-Type": "application/json" },
-        body: JSON.stringify({ action: "modify", data: payload })
+        headers: {
+          "Content-Type": "application/json",
+          "Idempotency-Key": opsIdempotencyKey("modify", body)
+        },
+        body
       });
 
       let j = null;
@@ -3538,6 +3567,7 @@ async function openModifyPage({ row, bookingId, rb, date, pick, drop, time, pax
       }
 
       // 6️⃣ ✅ 修改成功：先重新查詢並更新列表
+      clearOpsIdempotencyKey("modify");
       const id = (getElement("qBookId")?.value || "").trim();
       const phoneInput = (getElement("qPhone")?.value || "").trim();
       const emailInput = (getElement("qEmail")?.value || "").trim();
@@ -4068,7 +4098,7 @@ async function renderLiveLocationPlaceholder() {
 
   // 檢查 GPS 系統總開關（從 booking-api 讀取，該 API 會從 Sheet 的「系統」E19 讀取）
   try {
-    const apiUrl = `${BASE_API_URL}/api/realtime/location`;
+    const apiUrl = `${BASE_API_URL}/api/realtime/location?path_format=encoded`;
     const r = await fetch(apiUrl);
     if (r.ok) {
       let data = null;
@@ -4326,9 +4356,42 @@ function initLiveLocation(mount) {
     return nearestIdx;
   }
 
+  // 解碼 Google Encoded Polyline（與後端 _decode_polyline / _encode_path_history 格式相同）
+  function decodePolyline(str) {
+    const coords = [];
+    let index = 0, lat = 0, lng = 0;
+    while (index < str.length) {
+      let result = 0, shift = 0, b;
+      do {
+        b = str.charCodeAt(index++) - 63;
+        result |= (b & 0x1f) << shift;
+        shift += 5;
+      } while (b >= 0x20);
+      lat += (result & 1) ? ~(result >> 1) : (result >> 1);
+      result = 0;
+      shift = 0;
+      do {
+        b = str.charCodeAt(index++) - 63;
+        result |= (b & 0x1f) << shift;
+        shift += 5;
+      } while (b >= 0x20);
+      lng += (result & 1) ? ~(result >> 1) : (result >> 1);
+      coords.push({ lat: lat / 1e5, lng: lng / 1e5 });
+    }
+    return coords;
+  }
+
+  function getPathHistory(data) {
+    const encoded = data.current_trip_path;
+    if (encoded && typeof encoded.points === "string" && encoded.points.length > 0) {
+      return decodePolyline(encoded.points);
+    }
+    return data.current_trip_path_history;
+  }
+
   function getProgressIndex(data, driverPos, path) {
     let progressIdx = -1;
-    const history = data.current_trip_path_history;
+    const history = getPathHistory(data);
     if (history && Array.isArray(history) && history.length > 0) {
       lastHistoryLength = history.length;
       const step = history.length > 200 ? 5 : 1;
@@ -5217,7 +5280,7 @@ function initLiveLocation(mount) {
   const fetchLocation = async () => {
     try {
       // 從 booking-api 讀取即時位置資料（作為備用方案）
-      const apiUrl = `${BASE_API_URL}/api/realtime/location`;
+      const apiUrl = `${BASE_API_URL}/api/realtime/location?path_format=encoded`;
       const r = await fetch(apiUrl);
       if (!r.ok) {
         updateStatus("#dc3545", t("rtStatusFailed"));